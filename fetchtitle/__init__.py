@@ -2,12 +2,21 @@ __version__ = '3.0dev'
 __url__ = 'https://github.com/lilydjwg/fetchtitle'
 
 import re
+import html
+import json
+from json.decoder import scanstring
+import time
 import struct
 import logging
-from collections import namedtuple
+import mimetypes
+import heapq
+import functools
+import itertools
+import contextlib
+from collections import namedtuple, deque
 from html.parser import HTMLParser
 from html.entities import entitydefs
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, urlunsplit
 import asyncio
 
 import aiohttp
@@ -37,7 +46,88 @@ def strip_and_collapse_whitespace(s):
   # http://www.w3.org/TR/html5/infrastructure.html#strip-and-collapse-whitespace
   return re.sub('[ \t\n\r\f]+', ' ', s).strip(' \t\n\r\f')
 
-class HtmlTitleParser(HTMLParser):
+_default_ports = {'http': 80, 'https': 443}
+
+def normalize_url(url):
+  '''normalize an URL for use as a cache key
+
+  The scheme and host are lowercased, the default port is dropped, and an
+  empty path becomes "/". The fragment is kept as URLFinders may use it.
+  '''
+  try:
+    p = urlsplit(url.strip())
+    port = p.port
+  except ValueError:
+    return url
+
+  scheme = p.scheme.lower()
+  netloc = (p.hostname or '').rstrip('.')
+  if ':' in netloc:
+    # IPv6 literal
+    netloc = '[%s]' % netloc
+  if port is not None and port != _default_ports.get(scheme):
+    netloc = '%s:%d' % (netloc, port)
+  if p.username is not None:
+    userinfo = p.username
+    if p.password is not None:
+      userinfo += ':' + p.password
+    netloc = '%s@%s' % (userinfo, netloc)
+
+  return urlunsplit((scheme, netloc, p.path or '/', p.query, p.fragment))
+
+_attr_re = re.compile(
+  rb'''([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?''')
+
+def _parse_attrs(attrtext):
+  '''attributes of a tag as str, with values still encoded (as latin1)'''
+  attrs = {}
+  for m in _attr_re.finditer(attrtext):
+    value = m.group(2) or m.group(3) or m.group(4) or b''
+    attrs[m.group(1).decode('latin1').lower()] = value.decode('latin1')
+  return attrs
+
+class _MetaCollector:
+  '''collect the content of the <meta> tags named in `meta_fields`
+
+  Fields are matched against the property or name attribute, ignoring case;
+  a field ending with "*" (e.g. "twitter:*") matches names starting with
+  the rest of it. `meta_done` becomes true once every field is found, or
+  when <body> starts or the document ends.
+  '''
+  meta_fields = frozenset()
+  meta_done = False
+  _meta_raw = None
+
+  @property
+  def meta(self):
+    '''the fields found, decoded'''
+    if not self._meta_raw:
+      return {}
+    charset = self.charset or self.default_charset
+    return {
+      name: strip_and_collapse_whitespace(html.unescape(
+        value.encode('latin1').decode(charset, errors='replace')))
+      for name, value in self._meta_raw.items()
+    }
+
+  def _collect_meta(self, attrs):
+    name = attrs.get('property') or attrs.get('name')
+    if not name or 'content' not in attrs:
+      return
+    name = name.lower()
+    if self._meta_raw is None:
+      self._meta_raw = {}
+    elif name in self._meta_raw:
+      return
+
+    fields = self.meta_fields
+    if name in fields or any(
+      f.endswith('*') and name.startswith(f[:-1]) for f in fields):
+      self._meta_raw[name] = attrs['content']
+      if all(f in self._meta_raw for f in fields):
+        self.meta_done = True
+
+class HtmlTitleParser(_MetaCollector, HTMLParser):
   charset = title = None
   default_charset = 'utf-8'
   result = None
@@ -56,10 +146,16 @@ class HtmlTitleParser(HTMLParser):
       self.close()
 
   def close(self):
+    self.meta_done = True
     self._check_result(force=True)
     super().close()
 
   def handle_starttag(self, tag, attrs):
+    if tag == 'meta' and self.meta_fields and not self.meta_done:
+      # the undecoded values; strip "<meta" and ">"
+      raw = self.get_starttag_text().encode('latin1')
+      self._collect_meta(_parse_attrs(raw[5:-1]))
+
     # Google Search uses wrong meta info
     # Baidu Cache declared charset twice. The former is correct.
     if tag == 'meta' and not self.charset:
@@ -72,6 +168,8 @@ class HtmlTitleParser(HTMLParser):
         self.charset = get_charset_from_ctype(attrs.get('content', ''))
     elif tag == 'title':
       self._title_coming = True
+    elif tag == 'body':
+      self.meta_done = True
 
     if not self._title_coming:
       self._check_result()
@@ -113,42 +211,360 @@ class HtmlTitleParser(HTMLParser):
        and self.title:
       # always use 'replace' because surrogateescape may not be used elsewhere
       error_handler = 'replace'
+      # join adjacent bytes first: a character may be split between feeds
+      pieces = [b''.join(g) if bytes_ else ''.join(g)
+                for bytes_, g in itertools.groupby(
+                  self.title, lambda x: isinstance(x, bytes))]
       self.result = strip_and_collapse_whitespace(''.join(
         x if isinstance(x, str) else x.decode(
           self.charset or self.default_charset,
           errors = error_handler,
-        ) for x in self.title
+        ) for x in pieces
       ))
 
+class HtmlTitleScanner(_MetaCollector):
+  '''A faster drop-in replacement of HtmlTitleParser
+
+  Instead of tokenizing the whole document, it searches the raw bytes for
+  comments, <meta>, <title>, <script> and <style> only, carrying an
+  incomplete tag over to the next chunk.
+  '''
+  charset = title = None
+  default_charset = 'utf-8'
+  result = None
+  max_tag_size = 64 * 1024
+
+  _markup_re = re.compile(
+    rb'<(?:(!--)|(/?)(title|meta|script|style|body)(?=[\s/>]))', re.I)
+  _tag_end_re = re.compile(rb'''(?:[^>"']|"[^"]*"|'[^']*')*>''')
+  _inner_tag_re = re.compile(rb'<!--.*?-->|<[a-zA-Z/!?][^>]*>', re.S)
+  _comment_end_re = re.compile(rb'-->')
+  _end_tag_res = {
+    name: re.compile(rb'</' + name + rb'(?=[\s/>])', re.I)
+    for name in (b'title', b'script', b'style')
+  }
+
+  def __init__(self):
+    self.title = []
+    self._buf = b''
+    # the end marker of the comment / raw text element we are in
+    self._end_re = None
+    self._title_pieces = None
+
+  def feed(self, bytesdata):
+    if not bytesdata:
+      self.close()
+      return
+
+    buf = self._buf + bytesdata if self._buf else bytesdata
+    self._buf = buf[self._scan(buf):]
+
+  def close(self):
+    if self._title_pieces is not None:
+      self._title_pieces.append(self._buf)
+      self._end_title()
+    self._buf = b''
+    self.meta_done = True
+    self._check_result(force=True)
+
+  def _scan(self, buf):
+    pos = 0
+    n = len(buf)
+    while self.result is None or (self.meta_fields and not self.meta_done):
+      if self._end_re is not None:
+        m = self._end_re.search(buf, pos)
+        if m is None:
+          # keep enough for a split end marker
+          keep = max(pos, n - 16)
+          if self._title_pieces is not None:
+            self._title_pieces.append(buf[pos:keep])
+          return keep
+
+        if self._title_pieces is not None:
+          self._title_pieces.append(buf[pos:m.start()])
+        if self._end_re is self._comment_end_re:
+          pos = m.end()
+        else:
+          t = self._tag_end_re.match(buf, m.end())
+          if t is None:
+            if n - m.start() <= self.max_tag_size:
+              return m.start()
+            pos = m.end()
+          else:
+            pos = t.end()
+        self._end_re = None
+        if self._title_pieces is not None:
+          self._end_title()
+        continue
+
+      m = self._markup_re.search(buf, pos)
+      if m is None:
+        # keep enough for a split "<script"
+        return max(pos, n - 8)
+
+      if m.group(1):
+        self._end_re = self._comment_end_re
+        pos = m.end()
+        continue
+
+      t = self._tag_end_re.match(buf, m.end())
+      if t is None:
+        if n - m.start() <= self.max_tag_size:
+          return m.start()
+        # never closed; skip it
+        pos = m.end()
+        continue
+      pos = t.end()
+
+      if m.group(2):
+        # end tag outside of its element
+        continue
+      name = m.group(3).lower()
+      if name == b'meta':
+        self._handle_meta(buf[m.end():t.end()-1])
+      elif name == b'body':
+        self.meta_done = True
+      elif name == b'title':
+        self._title_pieces = []
+        self._end_re = self._end_tag_res[name]
+      else:
+        self._end_re = self._end_tag_res[name]
+
+    return pos
+
+  def _handle_meta(self, attrtext):
+    # see HtmlTitleParser.handle_starttag
+    want_meta = self.meta_fields and not self.meta_done
+    if self.charset and not want_meta:
+      return
+    attrs = _parse_attrs(attrtext)
+    if want_meta:
+      self._collect_meta(attrs)
+    if self.charset:
+      return
+
+    if attrs.get('charset', False):
+      self.charset = attrs['charset']
+    elif attrs.get('http-equiv', '').lower() == 'content-type':
+      self.charset = get_charset_from_ctype(attrs.get('content', ''))
+    self._check_result()
+
+  def _end_title(self):
+    data = b''.join(self._title_pieces)
+    self._title_pieces = None
+    data = self._inner_tag_re.sub(b'', data)
+    if data:
+      self.title.append(data)
+    self._check_result()
+
+  def _check_result(self, *, force=False):
+    if self.result is not None:
+      return
+
+    if (force or self.charset is not None) \
+       and self.title:
+      title = b''.join(self.title).decode(
+        self.charset or self.default_charset, errors='replace')
+      self.result = strip_and_collapse_whitespace(html.unescape(title))
+
 class SingletonFactory:
   def __init__(self, name):
     self.name = name
   def __repr__(self):
     return '<%s>' % self.name
+  def __reduce__(self):
+    # unpickle to the module-level instance of the same name
+    return self.name
 
 MediaType = namedtuple('MediaType', 'type size dimension')
 defaultMediaType = MediaType('application/octet-stream', None, None)
 
+# (pattern matched at the start of a document, media type)
+_magic_table = (
+  (rb'\x89PNG\r\n\x1a\n', 'image/png'),
+  (rb'\xff\xd8\xff', 'image/jpeg'),
+  (rb'GIF8[79]a', 'image/gif'),
+  (rb'RIFF.{4}WEBP', 'image/webp'),
+  (rb'BM.{4}\x00\x00\x00\x00', 'image/bmp'),
+  (rb'\x00\x00\x01\x00', 'image/x-icon'),
+  (rb'%PDF-', 'application/pdf'),
+  (rb'PK\x03\x04', 'application/zip'),
+  (rb'\x1f\x8b\x08', 'application/gzip'),
+  (rb'Rar!\x1a\x07', 'application/vnd.rar'),
+  (rb"7z\xbc\xaf'\x1c", 'application/x-7z-compressed'),
+  (rb'\x7fELF', 'application/x-executable'),
+  (rb'.{4}ftyp', 'video/mp4'),
+  (rb'\x1a\x45\xdf\xa3', 'video/webm'),
+  (rb'OggS\x00', 'application/ogg'),
+  (rb'ID3[\x02-\x04]|\xff[\xfb\xf3\xf2]', 'audio/mpeg'),
+  (rb'fLaC', 'audio/flac'),
+  (rb'(?:\xef\xbb\xbf)?[ \t\r\n\f]*(?i:<!doctype\s+html|<html|<head|<title)',
+   'text/html'),
+)
+_magic_re = re.compile(
+  b'|'.join(b'(%s)' % pat for pat, _ in _magic_table), re.S)
+# content types that tell nothing about the content
+_generic_types = frozenset((
+  '', 'application/octet-stream', 'binary/octet-stream',
+  'application/unknown', 'application/x-unknown', 'unknown/unknown',
+  'text/plain',
+))
+
+def sniff_type(data):
+  '''guess the media type of a document from its first bytes'''
+  m = _magic_re.match(data)
+  if m:
+    return _magic_table[m.lastindex - 1][1]
+
 TooManyRedirection = SingletonFactory('TooManyRedirection')
 Timeout = SingletonFactory('Timeout')
 TitleTooFaraway = SingletonFactory('TitleTooFaraway')
+CircuitOpen = SingletonFactory('CircuitOpen')
 
 logger = logging.getLogger('fetchtitle')
 
 Result = namedtuple(
   'Result',
-  'info status_code url_visited finder',
+  'info status_code url_visited finder stats meta',
+  defaults = (None, None),
 )
+Result.meta.__doc__ = 'the <meta> fields found, when meta_fields are asked for'
+
+
+class HopStats:
+  '''timings (in seconds) and reading statistics of one hop
+
+  `connect` includes the TLS handshake; `ttfb` is from the connection being
+  ready to the response headers being received. Fields stay None when they
+  don't apply (e.g. `dns` for a reused connection) or when the session
+  wasn't created with `stats_trace_config()`.
+  '''
+  dns = connect = ttfb = elapsed = None
+  reused_connection = False
+  bytes_read = chunks = 0
+  parser_cpu = 0.0
+
+  _dns_start = _connect_start = _request_start = _conn_ready = None
+
+  def __init__(self, url):
+    self.url = url
+    self._start = time.perf_counter()
+
+  def __repr__(self):
+    return '<HopStats %s: %s>' % (self.url, ', '.join(
+      '%s=%r' % (k, getattr(self, k)) for k in (
+        'dns', 'connect', 'ttfb', 'elapsed', 'reused_connection',
+        'bytes_read', 'chunks', 'parser_cpu',
+      )))
+
+  def feed(self, finder, data):
+    self.bytes_read += len(data)
+    t = time.thread_time()
+    try:
+      return finder(data)
+    finally:
+      self.parser_cpu += time.thread_time() - t
+
+  def finish(self):
+    self.elapsed = time.perf_counter() - self._start
+
+  def take_over(self, other):
+    '''copy what `other` measured for the hop it fetched for us'''
+    for k in ('dns', 'connect', 'ttfb', 'reused_connection',
+              'bytes_read', 'chunks', 'parser_cpu'):
+      setattr(self, k, getattr(other, k))
+
+class Stats:
+  '''per-hop statistics of a TitleFetcher run, in the order of url_visited'''
+  cached = False
+  elapsed = None
+
+  def __init__(self):
+    self.hops = []
+
+  def __repr__(self):
+    return '<Stats elapsed=%r cached=%r hops=%r>' % (
+      self.elapsed, self.cached, self.hops)
+
+  @property
+  def bytes_read(self):
+    return sum(h.bytes_read for h in self.hops)
+
+  @property
+  def parser_cpu(self):
+    return sum(h.parser_cpu for h in self.hops)
+
+async def _on_dns_start(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None:
+    hop._dns_start = time.perf_counter()
+
+async def _on_dns_end(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None and hop._dns_start is not None:
+    hop.dns = time.perf_counter() - hop._dns_start
+
+async def _on_connect_start(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None:
+    hop._connect_start = time.perf_counter()
+
+async def _on_connect_end(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None and hop._connect_start is not None:
+    hop._conn_ready = time.perf_counter()
+    hop.connect = hop._conn_ready - hop._connect_start
+
+async def _on_connection_reused(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None:
+    hop.reused_connection = True
+    hop._conn_ready = time.perf_counter()
+
+async def _on_request_start(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None:
+    hop._request_start = time.perf_counter()
+
+async def _on_request_end(session, ctx, params):
+  hop = ctx.trace_request_ctx
+  if hop is not None:
+    since = hop._conn_ready or hop._request_start
+    if since is not None:
+      hop.ttfb = time.perf_counter() - since
+
+def stats_trace_config():
+  '''a TraceConfig for sessions used by fetchers that collect stats'''
+  tc = aiohttp.TraceConfig()
+  tc.on_dns_resolvehost_start.append(_on_dns_start)
+  tc.on_dns_resolvehost_end.append(_on_dns_end)
+  tc.on_connection_create_start.append(_on_connect_start)
+  tc.on_connection_create_end.append(_on_connect_end)
+  tc.on_connection_reuseconn.append(_on_connection_reused)
+  tc.on_request_start.append(_on_request_start)
+  tc.on_request_end.append(_on_request_end)
+  return tc
 
 class Redirected(Exception):
-  def __init__(self, newurl, skip_urlfinder=False):
+  # (fetcher, HopStats) of the hop that raised it, if shared by SingleFlight
+  shared = None
+
+  def __init__(self, newurl, skip_urlfinder=False, via=()):
     self.newurl = newurl
     self.skip_urlfinder = skip_urlfinder
+    # URLs on the way to newurl that were skipped, e.g. thanks to a cache
+    self.via = via
+
+class _Retry(Exception):
+  '''make the request of a hop again, e.g. without a Range header'''
 
 class ContentFinder:
-  buf = b''
+  # how many bytes at most the finder needs to see, None if unknown
+  max_bytes = None
+
   def __init__(self, mediatype):
     self._mt = mediatype
+    self.buf = bytearray()
 
   @classmethod
   def match_type(cls, mediatype):
@@ -161,8 +577,10 @@ class ContentFinder:
 
 class TitleFinder(ContentFinder):
   parser = None
+  parser_class = HtmlTitleParser
   pos = 0
   maxpos = 1024 * 1024  # look at most around 1M as the title may be too long
+  max_bytes = maxpos
 
   @staticmethod
   def _match_type(ctype):
@@ -170,9 +588,21 @@ class TitleFinder(ContentFinder):
 
   def __init__(self, mediatype):
     charset = get_charset_from_ctype(mediatype.type)
-    self.parser = HtmlTitleParser()
+    self.parser = self.parser_class()
     self.parser.charset = charset
 
+  def want_meta(self, fields):
+    '''also collect these <meta> fields, into `meta`
+
+    The title is then returned only once they are all found, or <body> has
+    started.
+    '''
+    self.parser.meta_fields = frozenset(f.lower() for f in fields)
+
+  @property
+  def meta(self):
+    return self.parser.meta
+
   def __call__(self, data):
     if data:
       self.pos += len(data)
@@ -183,92 +613,227 @@ class TitleFinder(ContentFinder):
       else:
         data = b''
     self.parser.feed(data)
-    if self.parser.result:
+    if self.parser.result and (
+      not self.parser.meta_fields or self.parser.meta_done):
       return self.parser.result
     elif exceeded > 0:
       logger.warn('searched %d bytes but did not find title', self.maxpos)
       return TitleTooFaraway
 
+class FastTitleFinder(TitleFinder):
+  parser_class = HtmlTitleScanner
+
 class PNGFinder(ContentFinder):
   _mime = 'image/png'
+  max_bytes = 24
   def __call__(self, data):
     if data is None:
       return self._mt
 
-    self.buf += data
-    if len(self.buf) < 24:
+    buf = self.buf
+    buf += data[:24 - len(buf)]
+    if len(buf) < 24:
       # can't decide yet
       return
-    if self.buf[:16] != b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR':
-      logging.warn('Bad PNG signature and header: %r', self.buf[:16])
+    if buf[:16] != b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR':
+      logging.warn('Bad PNG signature and header: %r', bytes(buf[:16]))
       return self._mt._replace(dimension='Bad PNG')
     else:
-      s = struct.unpack('!II', self.buf[16:24])
+      s = struct.unpack_from('!II', buf, 16)
       return self._mt._replace(dimension=s)
 
 class JPEGFinder(ContentFinder):
   _mime = 'image/jpeg'
-  isfirst = True
+  # all Start Of Frame markers (baseline, extended, progressive, lossless,
+  # differential, arithmetic); 0xc4, 0xc8 and 0xcc are DHT, JPG and DAC
+  _sof_markers = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+  _started = False
+  # payload bytes of the current segment still to be skipped
+  _skip = 0
+
   def __call__(self, data):
     if data is None:
       return self._mt
 
-    # http://www.64lines.com/jpeg-width-height
-    if data:
-      self.buf += data
+    # https://www.w3.org/Graphics/JPEG/itu-t81.pdf, Annex B
+    if self._skip:
+      if len(data) <= self._skip:
+        self._skip -= len(data)
+        return
+      data = memoryview(data)[self._skip:]
+      self._skip = 0
+
+    if self.buf:
+      # a marker cut off by the end of the last chunk, a few bytes at most
+      data = self.buf + data
+    # walk the chunk in place; only an incomplete marker is kept
+    buf = memoryview(data)
+    pos = 0
 
-    if self.isfirst is True:
-      # finding header
-      if len(self.buf) < 5:
+    if not self._started:
+      if len(buf) < 3:
+        self.buf = bytearray(buf)
         return
-      if self.buf[:3] != b'\xff\xd8\xff':
-        logging.warn('Bad JPEG signature: %r', self.buf[:3])
+      if buf[:3] != b'\xff\xd8\xff':
+        logging.warn('Bad JPEG signature: %r', bytes(buf[:3]))
         return self._mt._replace(dimension='Bad JPEG')
-      else:
-        self.blocklen = self.buf[4] * 256 + self.buf[5] + 2
-        self.buf = self.buf[2:]
-        self.isfirst = False
+      self._started = True
+      pos = 2
 
-    if self.isfirst is False:
-      # receiving a block. 4 is for next block size
-      if len(self.buf) < self.blocklen + 4:
-        return
-      buf = self.buf
-      if buf[0] != 0xff:
-        logging.warn('Bad JPEG: %r', self.buf[:self.blocklen])
+    n = len(buf)
+    while n - pos >= 2:
+      if buf[pos] != 0xff:
+        logging.warn('Bad JPEG: %r', bytes(buf[pos:pos+16]))
         return self._mt._replace(dimension='Bad JPEG')
-      if buf[1] == 0xc0 or buf[1] == 0xc2:
-        s = buf[7] * 256 + buf[8], buf[5] * 256 + buf[6]
-        return self._mt._replace(dimension=s)
-      else:
-        # not Start Of Frame, retry with next block
-        self.buf = buf = buf[self.blocklen:]
-        self.blocklen = buf[2] * 256 + buf[3] + 2
-        return self(b'')
+      marker = buf[pos+1]
+      if marker == 0xff:
+        # fill byte
+        pos += 1
+        continue
+      if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+        # standalone markers without a length
+        pos += 2
+        continue
+      if marker in (0xd9, 0xda):
+        logging.warn('Bad JPEG: no Start Of Frame before %s',
+                     'EOI' if marker == 0xd9 else 'SOS')
+        return self._mt._replace(dimension='Bad JPEG')
+
+      if marker in self._sof_markers:
+        if n - pos < 9:
+          break
+        h, w = struct.unpack_from('!HH', buf, pos + 5)
+        return self._mt._replace(dimension=(w, h))
+
+      if n - pos < 4:
+        break
+      seglen = buf[pos+2] << 8 | buf[pos+3]
+      if seglen < 2:
+        logging.warn('Bad JPEG: segment length %d', seglen)
+        return self._mt._replace(dimension='Bad JPEG')
+      end = pos + 2 + seglen
+      if end > n:
+        # skip the rest of the segment without buffering it
+        self._skip = end - n
+        pos = n
+        break
+      pos = end
+
+    self.buf = bytearray(buf[pos:])
 
 class GIFFinder(ContentFinder):
   _mime = 'image/gif'
+  max_bytes = 10
   def __call__(self, data):
     if data is None:
       return self._mt
 
-    self.buf += data
-    if len(self.buf) < 10:
+    buf = self.buf
+    buf += data[:10 - len(buf)]
+    if len(buf) < 10:
       # can't decide yet
       return
-    if self.buf[:3] != b'GIF':
-      logging.warn('Bad GIF signature: %r', self.buf[:3])
+    if buf[:3] != b'GIF':
+      logging.warn('Bad GIF signature: %r', bytes(buf[:3]))
       return self._mt._replace(dimension='Bad GIF')
     else:
-      s = struct.unpack('<HH', self.buf[6:10])
+      s = struct.unpack_from('<HH', buf, 6)
       return self._mt._replace(dimension=s)
 
+class _FinderFeed:
+  '''sniffing a document and feeding it to its finder, without the reading
+
+  For TitleFetcher and the WARC extractor. `match` gives the finder for a
+  MediaType, `declared` tells whether the type came with the document. If
+  `sniffing`, pass the first sniff_bytes (or the whole document if shorter)
+  to sniff(), then `mt` and `finder` are final. Then feed() the data, which
+  may start with those bytes, and b'' at the end, until it returns a result
+  or `done` is set.
+  '''
+  done = False
+
+  def __init__(self, mt, match, *, declared=True, sniff=True):
+    self.mt = mt
+    self.finder = match(mt)
+    self._match = match
+    self._basetype = mt.type.split(';', 1)[0].strip().lower()
+    self._generic = not declared or self._basetype in _generic_types
+    self.sniffing = bool(sniff and (self.finder or self._generic))
+    self.nread = 0
+
+  def sniff(self, head):
+    sniffed = sniff_type(head)
+    if sniffed is None or sniffed == self._basetype:
+      return
+    f = self._match(self.mt._replace(type=sniffed))
+    # a generic (or missing) type is replaced even if no finder cares;
+    # others only if the finder changes, e.g. application/xhtml+xml
+    # sniffed as text/html
+    if self._generic or type(f) is not type(self.finder):
+      logger.debug('sniffed %s, not %s', sniffed, self._basetype)
+      self.mt = self.mt._replace(type=sniffed)
+      self.finder = f
+
+  def feed(self, data, feed=None):
+    '''the finder's result, or None; `feed(finder, data)` calls the finder'''
+    f = self.finder
+    self.nread += len(data)
+    t = f(data) if feed is None else feed(f, data)
+    if t is None and data and f.max_bytes is not None \
+       and self.nread > f.max_bytes:
+      logger.debug('%r has read enough (%d bytes)', f, self.nread)
+      t = f(b'')
+      if t is None:
+        self.done = True
+    if not data:
+      self.done = True
+    return t
+
 class TitleFetcher:
+  # the whole run, including all redirections
   timeout = 15
+  # establishing a connection (TCP and TLS), for each hop
+  connect_timeout = 3
+  # from sending a request (including connecting) to receiving the headers
+  first_byte_timeout = 10
+  # waiting for the next piece of data
+  idle_timeout = 10
+  _deadline = None
   max_follows = 10
   _content_finders = (TitleFinder, PNGFinder, JPEGFinder, GIFFinder)
   _url_finders = ()
   __our_session = False
+  cache = None
+  singleflight = None
+  redirect_cache = None
+  sniff = True
+  # at least this many bytes are read before sniffing
+  sniff_bytes = 32
+  range_requests = False
+  # read at most this many unneeded bytes to keep a connection
+  drain_limit = 16 * 1024
+  stats = None
+  _hop = None
+  host_health = None
+  _cancelled_host = None
+  # the host of the hop being requested; a hop shared with a SingleFlight
+  # is still in flight when our timeout fires
+  _requesting_host = None
+  # <meta> fields for TitleFinders to collect; see TitleFinder.want_meta
+  meta_fields = None
+  # a scheduler.HostScheduler, and the priority to wait in it with
+  scheduler = None
+  priority = 5
+  # a hedging.Hedging to race slow hops with a second attempt
+  hedging = None
+  # retry once after a 429 / 503 if Retry-After asks for at most this long
+  retry_wait = 5
+  _retried = False
+  # (Result, validators) of an expired cache entry being revalidated
+  _stale = None
+  # validators of the response the result comes from, for the cache
+  validators = None
+  revalidated = False
   user_agent = UserAgent
 
   @property
@@ -276,21 +841,55 @@ class TitleFetcher:
     if not self._session:
       s = aiohttp.ClientSession(headers={
         'User-Agent': self.user_agent,
-      })
+      }, trace_configs=[stats_trace_config()] if self.stats else None)
       self.__our_session = True
       self._session = s
     return self._session
 
   def __init__(self, url, *,
                session=None, timeout=None,
+               connect_timeout=None, first_byte_timeout=None,
+               idle_timeout=None,
                max_follows=None,
-               content_finders=None, url_finders=None):
+               content_finders=None, url_finders=None,
+               cache=None, singleflight=None, redirect_cache=None,
+               range_requests=None, sniff=None, collect_stats=False,
+               host_health=None, meta_fields=None, scheduler=None,
+               priority=None, hedging=None):
     self._session = session
+    if cache is not None:
+      self.cache = cache
+    if singleflight is not None:
+      self.singleflight = singleflight
+    if redirect_cache is not None:
+      self.redirect_cache = redirect_cache
 
     if timeout is not None:
       self.timeout = timeout
+    if connect_timeout is not None:
+      self.connect_timeout = connect_timeout
+    if first_byte_timeout is not None:
+      self.first_byte_timeout = first_byte_timeout
+    if idle_timeout is not None:
+      self.idle_timeout = idle_timeout
     if max_follows is not None:
       self.max_follows = max_follows
+    if range_requests is not None:
+      self.range_requests = range_requests
+    if sniff is not None:
+      self.sniff = sniff
+    if collect_stats:
+      self.stats = Stats()
+    if host_health is not None:
+      self.host_health = host_health
+    if meta_fields is not None:
+      self.meta_fields = meta_fields
+    if scheduler is not None:
+      self.scheduler = scheduler
+    if priority is not None:
+      self.priority = priority
+    if hedging is not None:
+      self.hedging = hedging
 
     if content_finders is not None:
       self._content_finders = content_finders
@@ -301,9 +900,43 @@ class TitleFetcher:
     self.url_visited = []
 
   async def run(self, proxy=None):
+    '''`proxy` is a proxy URL, or a proxies.ProxyPool to pick from per hop'''
+    start = time.perf_counter()
+    if self.cache is None:
+      r = await self._run(proxy)
+    else:
+      variant = self._cache_variant()
+      entry = await self.cache.lookup(self.url, variant=variant)
+      if entry is not None and entry[2]:
+        logger.debug('cache hit for %s', self.url)
+        r = entry[0]
+        self.url_visited = list(r.url_visited)
+        r = r._replace(url_visited=self.url_visited)
+        if self.stats is not None:
+          self.stats.cached = True
+      else:
+        if entry is not None and entry[0].url_visited:
+          # expired, but may be revalidated
+          self._stale = entry[0], entry[1]
+        r = await self._run(proxy)
+        await self.cache.set(
+          self.url, r, validators=self.validators, variant=variant)
+
+    if self.stats is not None:
+      self.stats.elapsed = time.perf_counter() - start
+      r = r._replace(stats=self.stats)
+    return r
+
+  def _cache_variant(self):
+    # results with <meta> fields aren't the same as those without
+    if self.meta_fields:
+      return 'meta=' + ','.join(sorted({f.lower() for f in self.meta_fields}))
+
+  async def _run(self, proxy):
     r = None
     url = self.url
     skip_urlfinder = False
+    self._deadline = asyncio.get_running_loop().time() + self.timeout
 
     try:
       async with async_timeout.timeout(self.timeout):
@@ -317,9 +950,14 @@ class TitleFetcher:
           except Redirected as e:
             url = e.newurl
             skip_urlfinder = e.skip_urlfinder
+            for u in e.via:
+              self._skipped_hop(u)
             continue
           break
     except asyncio.TimeoutError:
+      host = self._cancelled_host or self._requesting_host
+      if self.host_health is not None and host is not None:
+        self.host_health.failure(host)
       return Result(Timeout, 0, self.url_visited, None)
     finally:
       await self.close()
@@ -331,62 +969,407 @@ class TitleFetcher:
         TooManyRedirection, 0, self.url_visited, None,
       )
 
+  def _skipped_hop(self, url):
+    self.url_visited.append(url)
+    if self.stats is not None:
+      hop = HopStats(url)
+      hop.finish()
+      self.stats.hops.append(hop)
+
   async def _one_url(self, url, *, skip_urlfinder, proxy):
     logger.debug('processing url: %s', url)
     self.url_visited.append(url)
+    if self.stats is not None:
+      hop = self._hop = HopStats(url)
+      self.stats.hops.append(hop)
 
-    if not skip_urlfinder:
-      for finder in self._url_finders:
-        f = finder.match_url(url, self.session, self)
-        if f:
-          logger.debug('%r matched with url %s', f, url)
-          info = await f.run()
-          return Result(info, 0, self.url_visited, f)
-
-    async with self.session.get(
-      url, allow_redirects = False, ssl = False,
-      proxy = proxy,
-    ) as r:
-
-      if r.status in (301, 302, 303, 307, 308):
-        newurl = r.headers.get('Location')
-        newurl = urljoin(url, newurl)
-        logger.debug('redirected to %s', newurl)
-        raise Redirected(newurl)
-
-      ctype = r.headers.get('Content-Type', 'text/html')
-      l = r.headers.get('Content-Length', None)
-      if l:
-        l = int(l)
-      mt = defaultMediaType._replace(type=ctype, size=l)
-      logger.debug('media type: %r', mt)
-      for finder in self._content_finders:
-        f = finder.match_type(mt)
-        if f:
-          logger.debug('finder %r matches', f)
-          break
+    try:
+      if self.singleflight is None:
+        return await self._fetch_url(
+          url, skip_urlfinder=skip_urlfinder, proxy=proxy)
+
+      # the hop may be shared with other fetchers, which have different
+      # url_visited lists (and stats)
+      try:
+        r, shared = await self.singleflight.do(
+          self._flight_key(url, skip_urlfinder, proxy),
+          lambda: self._fetch_shared(
+            url, skip_urlfinder=skip_urlfinder, proxy=proxy),
+        )
+      except Redirected as e:
+        if e.shared is not None:
+          self._take_over(*e.shared)
+        raise
+      self._take_over(*shared)
+      return r._replace(url_visited=self.url_visited, stats=None)
+    finally:
+      if self.stats is not None:
+        hop.finish()
+
+  def _flight_key(self, url, skip_urlfinder, proxy):
+    # only fetchers that would get the same result share a hop
+    meta_fields = self.meta_fields
+    if meta_fields:
+      meta_fields = frozenset(f.lower() for f in meta_fields)
+    return (
+      normalize_url(url), skip_urlfinder, proxy,
+      tuple(self._content_finders), tuple(self._url_finders), meta_fields,
+      tuple(f.max_bytes for f in self._content_finders),
+      self.range_requests, self.sniff,
+    )
+
+  async def _fetch_shared(self, url, **kwargs):
+    # the result, and what the others sharing the hop take over from it
+    shared = self, self._hop
+    try:
+      r = await self._fetch_url(url, **kwargs)
+    except Redirected as e:
+      e.shared = shared
+      raise
+    return r, shared
+
+  def _take_over(self, leader, hop):
+    '''the side effects of a hop that leader fetched for us'''
+    if leader is self:
+      return
+    self.validators = leader.validators
+    self.revalidated = leader.revalidated
+    self.range_requests = leader.range_requests
+    if self._hop is not None and hop is not None:
+      self._hop.take_over(hop)
+
+  async def _fetch_url(self, url, *, skip_urlfinder, proxy):
+    if not skip_urlfinder and self._url_finders:
+      index = url_finder_index(tuple(self._url_finders))
+      f = index.match_url(url, self.session, self)
+      if f:
+        logger.debug('%r matched with url %s', f, url)
+        f.timeout = self._hop_timeout()
+        f.scheduler, f.priority = self.scheduler, self.priority
+        stale = self._stale_for(url)
+        if stale is not None and stale[0].finder is not None \
+           and _finder_class(stale[0].finder) is type(f):
+          f.cached_info, f.validators = stale[0].info, stale[1]
+        info = await f.run()
+        self.validators = f.validators
+        if f.not_modified:
+          self.revalidated = True
+        return Result(info, 0, self.url_visited, f)
+
+    if self.redirect_cache is not None:
+      chain, looped = self.redirect_cache.resolve(url)
+      if looped:
+        logger.debug('cached redirections from %s form a loop', url)
+        return Result(TooManyRedirection, 0, self.url_visited, None)
+      if chain:
+        logger.debug('cached redirections to %s', chain[-1])
+        raise Redirected(chain[-1], via=chain[:-1])
+
+    while True:
+      try:
+        return await self._request(url, proxy)
+      except _Retry:
+        # the same hop again, not another one of max_follows
+        continue
+
+  async def _request(self, url, proxy):
+    budget = self._range_budget(url) if self.range_requests else None
+    if budget is not None:
+      # one more byte than needed so that finders can tell the document is
+      # longer than what they will look at
+      headers = {'Range': 'bytes=0-%d' % budget}
+    else:
+      headers = None
+
+    stale = self._stale_for(url)
+    if stale is not None:
+      headers = dict(headers or ())
+      headers.update(conditional_headers(stale[1]))
+
+    hop = self._hop
+    health = self.host_health
+    try:
+      host = urlsplit(url).hostname
+    except ValueError:
+      host = None
+    if health is not None and not health.allow(host):
+      logger.debug('circuit for %s is open', host)
+      return Result(CircuitOpen, 0, self.url_visited, None)
+
+    requesting = False
+    try:
+      async with _slot(self.scheduler, host, self.priority):
+        requesting = True
+        self._requesting_host = host
+        get = self.session.get
+        if hasattr(proxy, 'pick'):
+          # a proxies.ProxyPool; a hedged attempt goes through another one
+          get = functools.partial(_via_pool, get, proxy, host, [])
+        if self.hedging is not None:
+          get = functools.partial(self.hedging.get, get)
+        timeout = self._hop_timeout()
+        async with async_timeout.timeout(
+          self._remaining(self.first_byte_timeout)):
+          r = await get(
+            url, allow_redirects = False, ssl = False,
+            proxy = proxy, headers = headers,
+            trace_request_ctx = hop, timeout = timeout,
+          )
+        async with r:
+          if health is not None:
+            health.success(host)
+          return await self._handle_response(url, r, headers, hop, stale)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError):
+      if health is not None:
+        health.failure(host)
+      raise
+    except asyncio.CancelledError:
+      # Our timeout cancels us too (see _run), and counts if the host was
+      # being waited for (not the scheduler). Other cancellations, e.g. by
+      # fetch_many's caller, say nothing about the host.
+      if health is not None and requesting and self._remaining() == 0:
+        self._cancelled_host = host
+      raise
+    finally:
+      self._requesting_host = None
+
+  async def _handle_response(self, url, r, headers, hop, stale):
+    if stale is not None and r.status == 304:
+      logger.debug('%s not modified', url)
+      self.revalidated = True
+      self.validators = get_validators(r.headers) or stale[1]
+      result = stale[0]
+      return result._replace(url_visited=self.url_visited)
+
+    if r.status in (429, 503) and self.scheduler is not None:
+      self._throttled(url, r)
+
+    if r.status in (301, 302, 303, 307, 308):
+      newurl = r.headers.get('Location')
+      newurl = urljoin(url, newurl)
+      logger.debug('redirected to %s', newurl)
+      # cookie-setting redirections may end differently next time
+      if self.redirect_cache is not None \
+         and 'Set-Cookie' not in r.headers \
+         and 'no-store' not in r.headers.get('Cache-Control', ''):
+        self.redirect_cache.add(url, newurl, r.status)
+      raise Redirected(newurl)
+
+    if headers is not None and 'Range' in headers and r.status == 416:
+      # empty documents, or servers that don't like our range
+      logger.debug('range not satisfiable, retry without it')
+      self.range_requests = False
+      raise _Retry
+
+    status = r.status
+    partial = headers is not None and 'Range' in headers and status == 206
+    ctype = r.headers.get('Content-Type', 'text/html')
+    l = r.headers.get('Content-Length', None)
+    if l:
+      l = int(l)
+    if partial:
+      # we asked for the range, so present it as the whole document
+      status = 200
+      l = self._get_range_total(r.headers.get('Content-Range', ''))
+    mt = defaultMediaType._replace(type=ctype, size=l)
+    logger.debug('media type: %r', mt)
+    feed = _FinderFeed(
+      mt, self._match_content_finder,
+      declared='Content-Type' in r.headers, sniff=self.sniff)
+
+    data = None
+    if feed.sniffing:
+      data = await self._read_head(r, hop)
+      feed.sniff(data)
+    f = feed.finder
 
-      if not f:
-        return Result(mt, r.status, self.url_visited, None)
+    if not f:
+      if data:
+        await self._abort_response(r, len(data))
+      return Result(feed.mt, status, self.url_visited, None)
 
-      while True:
+    while True:
+      if data is None:
         data = await r.content.readany()
-        t = f(data)
+        if hop is not None:
+          hop.chunks += 1
+      t = feed.feed(data, None if hop is None else hop.feed)
+      if t is not None:
+        if data:
+          await self._abort_response(r, feed.nread)
+        self.validators = get_validators(r.headers)
+        meta = f.meta if self.meta_fields and hasattr(f, 'meta') else None
+        return Result(t, status, self.url_visited, f, meta=meta)
+      if feed.done:
+        break
+      data = None
 
-        if t is not None:
-          return Result(t, r.status, self.url_visited, f)
+    if partial and not data and (l is None or feed.nread < l):
+      # the range ran out before the finder was done
+      logger.debug('%r needs more than the range, retry without it', f)
+      self.range_requests = False
+      raise _Retry
+    return Result(None, status, self.url_visited, f)
 
-        if not data:
-          break
+  def _throttled(self, url, r):
+    from .scheduler import parse_retry_after
+    delay = parse_retry_after(r.headers.get('Retry-After'))
+    if delay is None:
+      return
+    host = urlsplit(url).hostname
+    self.scheduler.retry_after(host, delay)
+    if not self._retried and delay <= self.retry_wait:
+      # the retry waits in the scheduler
+      logger.debug('%s asks to retry after %ds', url, delay)
+      self._retried = True
+      raise _Retry
+
+  def _stale_for(self, url):
+    if self._stale is not None \
+       and normalize_url(url) == normalize_url(self._stale[0].url_visited[-1]):
+      return self._stale
+
+  def _remaining(self, limit=None):
+    '''time left before the deadline, capped by limit'''
+    if self._deadline is None:
+      return limit
+    remaining = max(self._deadline - asyncio.get_running_loop().time(), 0)
+    if limit is None:
+      return remaining
+    return min(limit, remaining)
 
-      return Result(None, r.status, self.url_visited, f)
+  def _hop_timeout(self):
+    return aiohttp.ClientTimeout(
+      total = self._remaining(),
+      sock_connect = self._remaining(self.connect_timeout),
+      sock_read = self.idle_timeout,
+    )
+
+  def _match_content_finder(self, mt):
+    for finder in self._content_finders:
+      f = finder.match_type(mt)
+      if f:
+        logger.debug('finder %r matches', f)
+        if self.meta_fields and hasattr(f, 'want_meta'):
+          f.want_meta(self.meta_fields)
+        return f
+
+  async def _read_head(self, r, hop):
+    head = b''
+    while len(head) < self.sniff_bytes:
+      data = await r.content.readany()
+      if hop is not None:
+        hop.chunks += 1
+      if not data:
+        break
+      head += data
+    return head
+
+  def _range_budget(self, url):
+    # what the finder for the type the URL suggests needs (HTML if it
+    # suggests none); a wrong guess is retried without the range
+    try:
+      path = urlsplit(url).path
+    except ValueError:
+      return
+    ctype = mimetypes.guess_type(path)[0] or 'text/html'
+    mt = defaultMediaType._replace(type=ctype)
+    for finder in self._content_finders:
+      f = finder.match_type(mt)
+      if f:
+        return f.max_bytes
+
+  @staticmethod
+  def _get_range_total(content_range):
+    # bytes 0-1023/4096, the total may be "*"
+    total = content_range.rpartition('/')[2].strip()
+    if total.isdigit():
+      return int(total)
+
+  async def _abort_response(self, r, nread):
+    # The connection can go back to the pool only if the rest of the body
+    # is read, which is worth it when little is left, e.g. when the server
+    # honoured our Range header.
+    l = r.content_length
+    if l is not None and l - nread <= self.drain_limit \
+       and 'Content-Encoding' not in r.headers:
+      try:
+        await r.content.read()
+        return
+      except aiohttp.ClientError:
+        pass
+    r.close()
 
   async def close(self):
     if self.__our_session and self._session:
       await self._session.close()
       self._session = None
 
+def get_validators(headers):
+  '''the ETag and Last-Modified of a response, None if there are none'''
+  if 'no-store' in headers.get('Cache-Control', ''):
+    return
+  validators = {}
+  etag = headers.get('ETag')
+  if etag:
+    validators['etag'] = etag
+  last_modified = headers.get('Last-Modified')
+  if last_modified:
+    validators['last_modified'] = last_modified
+  return validators or None
+
+def conditional_headers(validators):
+  headers = {}
+  if validators.get('etag'):
+    headers['If-None-Match'] = validators['etag']
+  if validators.get('last_modified'):
+    headers['If-Modified-Since'] = validators['last_modified']
+  return headers
+
+def _finder_class(finder):
+  return finder if isinstance(finder, type) else type(finder)
+
+async def _via_pool(get, pool, host, tried, url, *, proxy, **kwargs):
+  while True:
+    proxy = pool.pick(host, exclude=tried)
+    tried.append(proxy)
+    start = time.perf_counter()
+    ok = None
+    try:
+      r = await get(url, proxy=proxy, **kwargs)
+      ok = True
+      return r
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError):
+      ok = False
+      # nothing was received, so try another proxy
+      if len(tried) > pool.retries or \
+         not set(pool.candidates(host)).difference(tried):
+        raise
+      logger.debug('proxy %s failed for %s, trying another', proxy, url)
+    finally:
+      pool.report(proxy, time.perf_counter() - start, ok)
+
+@contextlib.asynccontextmanager
+async def _slot(scheduler, host, priority):
+  if scheduler is None:
+    yield
+  else:
+    async with scheduler.slot(host, priority):
+      yield
+
 class URLFinder:
+  # an aiohttp.ClientTimeout for what's left of the fetcher's time
+  timeout = None
+  # the fetcher's scheduler.HostScheduler, if any, and its priority
+  scheduler = None
+  priority = None
+  # When revalidating a cached result, the cached info and its validators.
+  # After a get() with revalidate=True, validators are those of the
+  # response, and not_modified tells whether cached_info is still good.
+  cached_info = None
+  validators = None
+  not_modified = False
+
   def __init__(self, url, session, match=None):
     self.session = session
     self.url = url
@@ -402,5 +1385,495 @@ class URLFinder:
        cls._match_url(url, session, fetcher):
       return cls(url, session, fetcher)
 
+  @contextlib.asynccontextmanager
+  async def get(self, url, *, revalidate=False, **kwargs):
+    '''session.get within the fetcher's deadline
+
+    With `revalidate`, the request is made conditional on the validators of
+    the cached result, if any; on a 304 response `not_modified` is set and
+    the finder should return `cached_info`.
+    '''
+    if self.timeout is not None:
+      kwargs.setdefault('timeout', self.timeout)
+    if revalidate and self.validators:
+      headers = dict(kwargs.get('headers') or ())
+      headers.update(conditional_headers(self.validators))
+      kwargs['headers'] = headers
+
+    try:
+      host = urlsplit(url).hostname
+    except ValueError:
+      host = None
+    async with _slot(self.scheduler, host, self.priority), \
+               self.session.get(url, **kwargs) as res:
+      if revalidate:
+        if res.status == 304 and self.validators:
+          self.not_modified = True
+          self.validators = get_validators(res.headers) or self.validators
+        else:
+          self.validators = get_validators(res.headers)
+      yield res
+
+  async def read_html(self, res, meta_fields=(), *,
+                      parser_class=HtmlTitleScanner,
+                      limit=TitleFinder.maxpos):
+    '''stream an HTML response through a title parser and return it
+
+    Reading stops once the parser has the title and `meta_fields`, or
+    after `limit` bytes. The parser has `result` (the title) and `meta`.
+    '''
+    parser = _new_parser(parser_class, res.headers, meta_fields)
+    nread = 0
+    while nread < limit:
+      data = await res.content.readany()
+      if not data:
+        break
+      nread += len(data)
+      parser.feed(data)
+      if parser.result and (not meta_fields or parser.meta_done):
+        return parser
+    parser.close()
+    return parser
+
+  async def read_script(self, res, *, id=None, pattern=None, path=(),
+                        limit=16 * 1024 * 1024):
+    '''find a <script> block in a response and decode the JSON in it
+
+    The block is the first one whose start tag has the given `id`, or
+    matches the bytes regex `pattern`. Reading stops as soon as it ends.
+    The JSON starts at the first "{" or "[" in the block, so blocks like
+    `window.__STATE__ = {...};` work too. With `path`, a sequence of keys
+    and list indices, only the value there is returned; see json_at_path.
+    '''
+    scanner = ScriptScanner(id=id, pattern=pattern)
+    nread = 0
+    while nread < limit:
+      data = await res.content.readany()
+      if not data:
+        break
+      nread += len(data)
+      if scanner.feed(data):
+        break
+    else:
+      raise ValueError('script block not found in %d bytes' % limit)
+    if scanner.text is None:
+      raise ValueError('script block not found')
+
+    charset = get_charset_from_ctype(
+      res.headers.get('Content-Type', '')) or 'utf-8'
+    return json_at_path(scanner.text.decode(charset, errors='replace'), path)
+
   async def run(self):
     raise NotImplementedError
+
+class ScriptScanner:
+  '''pick the content of a <script> block out of HTML fed in chunks
+
+  See URLFinder.read_script. After `feed()` returns true, `text` has the
+  content of the block (if the document ends before it does, `text` stays
+  None).
+  '''
+  max_tag_size = 64 * 1024
+  text = None
+  _skipping = False
+  _tail = b''
+
+  _start_re = re.compile(rb'<script(?=[\s>])[^>]*>', re.I)
+  _end_re = re.compile(rb'</script(?=[\s/>])', re.I)
+
+  def __init__(self, *, id=None, pattern=None):
+    if id is not None:
+      self._tag_re = re.compile(
+        rb'''\sid\s*=\s*(["']?)%s\1(?=[\s/>])''' % re.escape(id.encode()),
+        re.I)
+    elif pattern is not None:
+      self._tag_re = re.compile(pattern)
+    else:
+      self._tag_re = None
+    self._buf = b''
+    self._pieces = None
+
+  def feed(self, data):
+    if self._pieces is not None:
+      return self._feed_block(data)
+
+    buf = self._buf + data if self._buf else data
+    pos = 0
+    while True:
+      if self._skipping:
+        # inside another script, where "<script" may be in a string
+        m = self._end_re.search(buf, pos)
+        if m is None:
+          self._buf = buf[max(pos, len(buf) - 8):]
+          return False
+        pos = m.end()
+        self._skipping = False
+
+      m = self._start_re.search(buf, pos)
+      if m is None:
+        break
+      pos = m.end()
+      if self._tag_re is None or self._tag_re.search(m.group()):
+        self._pieces = []
+        self._buf = b''
+        return self._feed_block(buf[pos:])
+      self._skipping = True
+
+    # keep a start tag that may be split
+    lt = buf.rfind(b'<', pos)
+    if lt >= 0 and len(buf) - lt <= self.max_tag_size:
+      self._buf = buf[lt:]
+    else:
+      self._buf = b''
+    return False
+
+  def _feed_block(self, data):
+    # the end tag may start in what came before
+    tail = self._tail
+    m = self._end_re.search(tail + data)
+    if m is None:
+      self._pieces.append(data)
+      self._tail = (tail + data)[-8:]
+      return False
+    end = m.start() - len(tail)
+    if end < 0:
+      self.text = b''.join(self._pieces)[:end]
+    else:
+      self._pieces.append(data[:end])
+      self.text = b''.join(self._pieces)
+    self._pieces = None
+    return True
+
+_ws_re = re.compile(r'[ \t\n\r]*')
+_json_scalar_re = re.compile(r'[^,}\]\s]*')
+_json_decoder = json.JSONDecoder()
+
+def json_at_path(text, path=()):
+  '''decode the JSON value at `path` (keys and list indices) in text
+
+  Text before the first "{" or "[" and after the value is ignored. Values
+  beside the path are dropped as soon as they are skipped over, so only
+  the requested one is kept.
+  '''
+  m = re.search(r'[\[{]', text)
+  if m is None:
+    raise ValueError('no JSON found')
+  pos = m.start()
+  try:
+    for key in path:
+      if text[pos] == '{':
+        pos = _json_find_key(text, pos, key)
+      elif text[pos] == '[' and isinstance(key, int):
+        pos = _json_find_index(text, pos, key)
+      else:
+        raise KeyError(key)
+  except IndexError:
+    raise ValueError('truncated JSON') from None
+  return _json_decoder.raw_decode(text, pos)[0]
+
+def _json_find_key(text, pos, key):
+  # pos is at "{"; return the position of the value of key
+  pos = _ws_re.match(text, pos + 1).end()
+  if text[pos] == '}':
+    raise KeyError(key)
+  while True:
+    if text[pos] != '"':
+      raise ValueError('bad JSON at %d' % pos)
+    name, pos = scanstring(text, pos + 1)
+    pos = _ws_re.match(text, pos).end()
+    if text[pos] != ':':
+      raise ValueError('bad JSON at %d' % pos)
+    pos = _ws_re.match(text, pos + 1).end()
+    if name == key:
+      return pos
+    pos = _ws_re.match(text, _json_skip(text, pos)).end()
+    if text[pos] == '}':
+      raise KeyError(key)
+    if text[pos] != ',':
+      raise ValueError('bad JSON at %d' % pos)
+    pos = _ws_re.match(text, pos + 1).end()
+
+def _json_find_index(text, pos, index):
+  # pos is at "["
+  pos = _ws_re.match(text, pos + 1).end()
+  for _ in range(index):
+    if text[pos] == ']':
+      raise KeyError(index)
+    pos = _ws_re.match(text, _json_skip(text, pos)).end()
+    if text[pos] != ',':
+      raise KeyError(index)
+    pos = _ws_re.match(text, pos + 1).end()
+  if text[pos] == ']':
+    raise KeyError(index)
+  return pos
+
+def _json_skip(text, pos):
+  # return the end of the value at pos
+  c = text[pos]
+  if c == '"':
+    return scanstring(text, pos + 1)[1]
+  if c not in '[{':
+    return _json_scalar_re.match(text, pos).end()
+  # decoding in C and dropping the value is faster than matching brackets
+  # in Python
+  return _json_decoder.raw_decode(text, pos)[1]
+
+def parse_html(data, meta_fields=(), *, headers=None,
+               parser_class=HtmlTitleScanner):
+  '''parse a whole HTML document with a title parser and return it'''
+  parser = _new_parser(parser_class, headers or {}, meta_fields)
+  parser.feed(data)
+  parser.close()
+  return parser
+
+def _new_parser(parser_class, headers, meta_fields):
+  parser = parser_class()
+  parser.charset = get_charset_from_ctype(headers.get('Content-Type', ''))
+  parser.meta_fields = frozenset(f.lower() for f in meta_fields)
+  return parser
+
+class URLFinderIndex:
+  '''Find the URLFinder for an URL without trying every one of them
+
+  Finders whose `_url_pat` starts with a literal scheme and host are
+  bucketed by (scheme, host), and the patterns in a bucket are combined into
+  one regex that tells the first finder that may match. Other finders are
+  tried for every URL. The result is the same as trying all finders in
+  order, provided that an overridden `match_url` only narrows what
+  `_url_pat` matches (as GithubFinder does); finders that can't promise
+  this should set `_indexed = False`.
+  '''
+  _pat_prefix_re = re.compile(
+    r'\^?(?P<scheme>https\?|https|http)://'
+    r'(?P<host>[A-Za-z0-9-]+(?:\\\.[A-Za-z0-9-]+)*)'
+    r'(?:/|:|\$|\\\?|$)')
+  _url_prefix_re = re.compile(
+    r'([A-Za-z][A-Za-z0-9+.-]*)://(?:[^/?#@]*@)?([^/?#:]*)')
+
+  def __init__(self, finders):
+    self._generic = []
+    buckets = {}
+    for i, finder in enumerate(finders):
+      keys = self._keys_for(finder)
+      if keys is None:
+        self._generic.append((i, finder))
+      else:
+        for key in keys:
+          buckets.setdefault(key, []).append((i, finder))
+
+    self._buckets = {
+      key: (self._combine(entries), entries)
+      for key, entries in buckets.items()
+    }
+
+  def _keys_for(self, finder):
+    pat = getattr(finder, '_url_pat', None)
+    if pat is None or hasattr(finder, '_match_url') \
+       or not getattr(finder, '_indexed', True):
+      return
+
+    m = self._pat_prefix_re.match(pat.pattern)
+    if not m:
+      return
+    host = m.group('host').replace('\\.', '.').lower()
+    scheme = m.group('scheme')
+    if scheme == 'https?':
+      schemes = ('http', 'https')
+    else:
+      schemes = (scheme,)
+    return [(s, host) for s in schemes]
+
+  @staticmethod
+  def _combine(entries):
+    flags = {finder._url_pat.flags for _, finder in entries}
+    if len(flags) != 1:
+      return
+    parts = []
+    for n, (_, finder) in enumerate(entries):
+      pattern = finder._url_pat.pattern
+      if '(?P=' in pattern or re.search(r'\\[1-9]', pattern):
+        # backreferences would break when groups are renumbered
+        return
+      # group names may clash between patterns
+      pattern = pattern.replace('(?P<', '(?P<_%d_' % n)
+      parts.append('(?P<_f%d>%s)' % (n, pattern))
+    try:
+      return re.compile('|'.join(parts), flags.pop())
+    except re.error:
+      return
+
+  def candidates(self, url):
+    '''the finders that may match url, in their original order'''
+    entries = ()
+    m = self._url_prefix_re.match(url)
+    if m:
+      bucket = self._buckets.get((m.group(1).lower(), m.group(2).lower()))
+      if bucket is not None:
+        pat, entries = bucket
+        if pat is not None:
+          m = pat.match(url)
+          if m is None:
+            entries = ()
+          else:
+            # the outermost group closes last
+            entries = entries[int(m.lastgroup[2:]):]
+
+    if not self._generic:
+      return [finder for _, finder in entries]
+    return [finder for _, finder in heapq.merge(self._generic, entries)]
+
+  def match_url(self, url, session, fetcher):
+    for finder in self.candidates(url):
+      f = finder.match_url(url, session, fetcher)
+      if f:
+        return f
+
+@functools.lru_cache(maxsize=32)
+def url_finder_index(finders):
+  '''the (cached) URLFinderIndex of a tuple of URLFinders'''
+  return URLFinderIndex(finders)
+
+class _HostLimiter:
+  def __init__(self, limit):
+    self.limit = limit
+    self._sems = {}
+
+  @contextlib.asynccontextmanager
+  async def hold(self, url):
+    if not self.limit:
+      yield
+      return
+
+    try:
+      host = urlsplit(url).hostname
+    except ValueError:
+      host = None
+
+    entry = self._sems.get(host)
+    if entry is None:
+      entry = self._sems[host] = [asyncio.Semaphore(self.limit), 0]
+    entry[1] += 1
+    try:
+      async with entry[0]:
+        yield
+    finally:
+      entry[1] -= 1
+      if not entry[1]:
+        del self._sems[host]
+
+async def _iter_urls(urls):
+  if hasattr(urls, '__aiter__'):
+    async for url in urls:
+      yield url
+  else:
+    for url in urls:
+      yield url
+
+async def fetch_many(urls, *, concurrency=20, per_host=4, ordered=False,
+                     session=None, proxy=None, fetcher=TitleFetcher,
+                     with_index=False, processes=None, **kwargs):
+  '''Fetch a (possibly endless, possibly async) iterable of URLs
+
+  At most `concurrency` fetches are in flight (or, if `ordered`, waiting to
+  be yielded) at any time, and at most `per_host` of them share the same
+  starting host. Results are yielded as they finish, or in input order if
+  `ordered` is true. An exception raised by a fetch is yielded as the info
+  of its Result instead of aborting the whole batch. With `with_index`,
+  (index, Result) pairs are yielded, index being the position of the URL in
+  `urls`.
+
+  With `processes` > 1, URLs are sharded by host over that many worker
+  processes; see `fetchtitle.multiproc.fetch_sharded`.
+
+  Other keyword arguments are passed to `fetcher`.
+  '''
+  if processes is not None and processes > 1:
+    if session is not None:
+      raise ValueError('a session cannot be shared between processes')
+    from .multiproc import fetch_sharded
+    async for r in fetch_sharded(
+      urls, processes=processes, concurrency=concurrency, per_host=per_host,
+      ordered=ordered, with_index=with_index, proxy=proxy, fetcher=fetcher,
+      **kwargs,
+    ):
+      yield r
+    return
+
+  our_session = session is None
+  if our_session:
+    session = aiohttp.ClientSession(
+      connector = aiohttp.TCPConnector(
+        limit = concurrency, limit_per_host = per_host or 0,
+      ),
+      headers = {'User-Agent': fetcher.user_agent},
+      trace_configs = [stats_trace_config()]
+                      if kwargs.get('collect_stats') else None,
+    )
+  limiter = _HostLimiter(per_host)
+
+  async def one(i, url):
+    f = fetcher(url, session=session, **kwargs)
+    try:
+      async with limiter.hold(url):
+        return i, await f.run(proxy=proxy)
+    except Exception as e:
+      logger.debug('error fetching %s: %r', url, e)
+      return i, Result(e, 0, f.url_visited or [url], None)
+
+  it = _iter_urls(urls).__aiter__()
+  exhausted = False
+  pending = deque()
+  index = 0
+  # The next URL is awaited alongside the fetches, so that results are
+  # yielded while a slow source (a pipe, a queue) has nothing new to give.
+  next_url = None
+
+  async def get_url():
+    try:
+      return await it.__anext__()
+    except StopAsyncIteration:
+      return None
+
+  try:
+    while True:
+      if next_url is None and not exhausted and len(pending) < concurrency:
+        next_url = asyncio.ensure_future(get_url())
+      if not pending and next_url is None:
+        break
+
+      waiting = {pending[0]} if ordered and pending else set(pending)
+      if next_url is not None:
+        waiting.add(next_url)
+      done, _ = await asyncio.wait(
+        waiting, return_when=asyncio.FIRST_COMPLETED)
+
+      if next_url in done:
+        url = next_url.result()
+        next_url = None
+        if url is None:
+          exhausted = True
+        else:
+          pending.append(asyncio.ensure_future(one(index, url)))
+          index += 1
+
+      if ordered:
+        while pending and pending[0].done():
+          r = pending.popleft().result()
+          yield r if with_index else r[1]
+      else:
+        for fu in done:
+          if fu in pending:
+            pending.remove(fu)
+            r = fu.result()
+            yield r if with_index else r[1]
+  finally:
+    if next_url is not None:
+      next_url.cancel()
+      pending.append(next_url)
+    for fu in pending:
+      fu.cancel()
+    if pending:
+      await asyncio.wait(pending)
+    await it.aclose()
+    if our_session:
+      await session.close()
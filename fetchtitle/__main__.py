@@ -1,17 +1,25 @@
+import os
+import sys
+import json
+import time
+import queue
 import logging
 import asyncio
+import threading
+import argparse
 
-from . import TitleFetcher
+from . import TitleFetcher, fetch_many
 from .fixups import fixup
+from .serialize import result_to_json
 
 logger = logging.getLogger(__name__)
 
-async def main(urls, *, url_finders=None):
+def _setup(url_finders):
   fixup()
 
-  from .extrafinders import GithubFinder, GithubUserFinder, ZhihuZhuanlan, NeteaseMusic, SogouImage
+  from .extrafinders import default_url_finders
   if not url_finders:
-    url_finders = (GithubFinder, GithubUserFinder, ZhihuZhuanlan, NeteaseMusic, SogouImage)
+    url_finders = default_url_finders
 
   try:
     from nicelogger import enable_pretty_logging
@@ -19,18 +27,18 @@ async def main(urls, *, url_finders=None):
   except ImportError:
     pass
 
-  futures = [
-    TitleFetcher(url, url_finders=url_finders).run()
-    for url in urls
-  ]
-  for fu in asyncio.as_completed(futures):
-    try:
-      result = await fu
-    except Exception:
-      logger.exception('an error occurred')
-      continue
+  return url_finders
 
+async def main(urls, *, url_finders=None, **kwargs):
+  url_finders = _setup(url_finders)
+
+  async for result in fetch_many(urls, url_finders=url_finders, **kwargs):
     info = result.info
+    if isinstance(info, Exception):
+      logger.error('an error occurred with %s',
+                   result.url_visited[0], exc_info=info)
+      continue
+
     urls = result.url_visited
     status_code = result.status_code
 
@@ -38,6 +46,139 @@ async def main(urls, *, url_finders=None):
     logger.info('done: [%d] %s <- %s',
                 status_code, info, url)
 
+async def _read_urls(f):
+  '''yield the URLs in f, one per line
+
+  Lines are read by a thread and handed over through a queue, so that a URL
+  is yielded as soon as its line is in, even when f is a pipe.
+  '''
+  loop = asyncio.get_running_loop()
+  lines = queue.Queue(1024)
+  stop = threading.Event()
+
+  def put(item):
+    while not stop.is_set():
+      try:
+        lines.put(item, timeout=0.5)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def read():
+    try:
+      for line in iter(f.readline, ''):
+        if not put(line):
+          return
+    except Exception as e:
+      put(e)
+    else:
+      put(None)
+
+  def get():
+    while not stop.is_set():
+      try:
+        return lines.get(timeout=0.5)
+      except queue.Empty:
+        pass
+
+  threading.Thread(target=read, daemon=True).start()
+  try:
+    while True:
+      try:
+        line = lines.get_nowait()
+      except queue.Empty:
+        line = await loop.run_in_executor(None, get)
+      if line is None:
+        break
+      if isinstance(line, Exception):
+        raise line
+      line = line.strip()
+      if line and not line.startswith('#'):
+        yield line
+  finally:
+    stop.set()
+
+class Checkpoint:
+  '''which URLs of the input are done
+
+  `done` URLs at the start of the input are, and so are the ones in `ahead`,
+  which are those finished out of order.
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.done = 0
+    self.ahead = set()
+    if path is not None and os.path.exists(path):
+      with open(path) as f:
+        d = json.load(f)
+      self.done = d['done']
+      self.ahead = set(d['ahead'])
+
+  def is_done(self, pos):
+    return pos < self.done or pos in self.ahead
+
+  def mark(self, pos):
+    self.ahead.add(pos)
+    while self.done in self.ahead:
+      self.ahead.remove(self.done)
+      self.done += 1
+
+  def save(self):
+    if self.path is None:
+      return
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'done': self.done, 'ahead': sorted(self.ahead)}, f)
+    os.replace(tmp, self.path)
+
+async def bulk(f, out, *, checkpoint=None, url_finders=None,
+               checkpoint_interval=1, **kwargs):
+  '''fetch the URLs in f, writing one JSON object per result to out
+
+  Output order is completion order; each object has the position of its
+  URL in the input as `index`. With `checkpoint`, progress is saved to that
+  file every `checkpoint_interval` seconds, and URLs recorded as done there
+  are skipped, so an interrupted run can be resumed with the same input.
+  Results written after the last save may be written again on resume.
+  '''
+  url_finders = _setup(url_finders)
+  ckpt = Checkpoint(checkpoint)
+  # fetch_many index -> (input position, URL)
+  inputs = {}
+
+  async def urls():
+    pos = 0
+    n = 0
+    async for url in _read_urls(f):
+      if not ckpt.is_done(pos):
+        inputs[n] = pos, url
+        n += 1
+        yield url
+      pos += 1
+
+  last_save = time.monotonic()
+  try:
+    async for i, r in fetch_many(
+      urls(), url_finders=url_finders, collect_stats=True,
+      with_index=True, **kwargs,
+    ):
+      pos, url = inputs.pop(i)
+      d = {'index': pos, 'url': url}
+      d.update(result_to_json(r))
+      out.write(json.dumps(d, ensure_ascii=False) + '\n')
+      # whoever reads out (maybe a pipe) gets each result as it's done
+      out.flush()
+      ckpt.mark(pos)
+
+      now = time.monotonic()
+      if checkpoint is not None and now - last_save >= checkpoint_interval:
+        ckpt.save()
+        last_save = now
+  finally:
+    out.flush()
+    ckpt.save()
+
 def test():
   urls = (
     'http://lilydjwg.is-programmer.com/',
@@ -77,16 +218,80 @@ def test():
   )
   asyncio.run(main(urls))
 
+def parse_args():
+  parser = argparse.ArgumentParser(
+    prog='python -m fetchtitle',
+    description='fetch titles of URLs',
+  )
+  parser.add_argument('urls', nargs='*', metavar='URL',
+                      help='URLs to fetch, or "test" to run the self test')
+  parser.add_argument('-i', '--input', metavar='FILE',
+                      help='read URLs from FILE ("-" for stdin), one per '
+                      'line, and write results as JSON lines to stdout')
+  parser.add_argument('--checkpoint', metavar='FILE',
+                      help='with --input, save progress to and resume from '
+                      'FILE')
+  parser.add_argument('-c', '--concurrency', type=int, default=20,
+                      help='fetches in flight (default: %(default)s)')
+  parser.add_argument('--per-host', type=int, default=4,
+                      help='fetches in flight per host (default: '
+                      '%(default)s)')
+  parser.add_argument('--rate', type=float,
+                      help='start at most this many requests per second '
+                      'to each host, and honour Retry-After')
+  parser.add_argument('-p', '--processes', type=int,
+                      help='shard fetches over this many worker processes')
+  parser.add_argument('-t', '--timeout', type=float,
+                      help='timeout per URL in seconds')
+  parser.add_argument('--connect-timeout', type=float,
+                      default=TitleFetcher.connect_timeout,
+                      help='timeout to connect, per hop (default: '
+                      '%(default)ss)')
+  parser.add_argument('--first-byte-timeout', type=float,
+                      default=TitleFetcher.first_byte_timeout,
+                      help='timeout for response headers, per hop '
+                      '(default: %(default)ss)')
+  parser.add_argument('--idle-timeout', type=float,
+                      default=TitleFetcher.idle_timeout,
+                      help='timeout for each read (default: %(default)ss)')
+  args = parser.parse_args()
+  if args.input is None and not args.urls:
+    parser.error('no urls given.')
+  if args.input is not None and args.urls:
+    parser.error('URLs given with --input')
+  if args.checkpoint is not None and args.input is None:
+    parser.error('--checkpoint needs --input')
+  return args
+
 if __name__ == "__main__":
-  import sys
+  args = parse_args()
   # make errors shorter
   sys.setrecursionlimit(100)
+  kwargs = {
+    'concurrency': args.concurrency,
+    'per_host': args.per_host,
+    'processes': args.processes,
+    'connect_timeout': args.connect_timeout,
+    'first_byte_timeout': args.first_byte_timeout,
+    'idle_timeout': args.idle_timeout,
+  }
+  if args.timeout is not None:
+    kwargs['timeout'] = args.timeout
+  if args.rate is not None:
+    from .scheduler import HostScheduler
+    kwargs['scheduler'] = HostScheduler(
+      args.per_host, rate=args.rate, burst=max(1, args.rate))
   try:
-    if len(sys.argv) == 1:
-      sys.exit('no urls given.')
-    elif sys.argv[1] == 'test':
+    if args.input is not None:
+      if args.input == '-':
+        f = sys.stdin
+      else:
+        f = open(args.input, errors='surrogateescape')
+      with f:
+        asyncio.run(bulk(f, sys.stdout, checkpoint=args.checkpoint, **kwargs))
+    elif args.urls == ['test']:
       test()
     else:
-      asyncio.run(main(sys.argv[1:]))
+      asyncio.run(main(args.urls, **kwargs))
   except KeyboardInterrupt:
-    print('Interrupted.')
+    print('Interrupted.', file=sys.stderr)
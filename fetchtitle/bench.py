@@ -0,0 +1,352 @@
+'''Offline benchmarks against a local server with pathological fixtures
+
+Run with `python -m fetchtitle.bench`; see `--help` for options.
+'''
+
+import os
+import sys
+import time
+import json
+import zlib
+import struct
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import subprocess
+import multiprocessing
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+from . import (
+  TitleFetcher, TitleFinder, FastTitleFinder,
+  fetch_many,
+)
+
+logger = logging.getLogger(__name__)
+
+BENCH_DOMAIN = 'bench.test'
+
+def _page(title, *, head=b'', body=b'', charset=None):
+  meta = b'<meta charset="%s">' % charset.encode() if charset else b''
+  return (b'<!DOCTYPE html><html><head>' + meta + head +
+          b'<title>' + title + b'</title></head><body>' + body +
+          b'</body></html>')
+
+def _jpeg(width, height, app_segments):
+  parts = [b'\xff\xd8']
+  for _ in range(app_segments):
+    parts.append(b'\xff\xe2' + struct.pack('!H', 0xffff) + b'\0' * 0xfffd)
+  parts.append(b'\xff\xc0' + struct.pack('!HBHHB', 11, 8, height, width, 1))
+  parts.append(b'\x01\x11\x00\xff\xd9')
+  return b''.join(parts)
+
+def _gzip_bomb(size):
+  c = zlib.compressobj(9, zlib.DEFLATED, 31)
+  parts = [c.compress(b'<!DOCTYPE html><html><head>')]
+  chunk = b' ' * (1024 * 1024)
+  for _ in range(size // len(chunk)):
+    parts.append(c.compress(chunk))
+  parts.append(c.compress(b'<title>boom</title>'))
+  parts.append(c.flush())
+  return b''.join(parts)
+
+CHARSET_TITLE = '基准测试 ベンチ 벤치마크'
+CHARSETS = ('utf-8', 'gb18030', 'big5', 'shift_jis', 'euc-kr')
+
+def make_app():
+  '''the fixture server'''
+  far_page = _page(
+    b'too far', head=b'<!-- %s -->' % (b'x' * (1100 * 1024)))
+  jpeg = _jpeg(1024, 768, 12)
+  bomb = _gzip_bomb(64 * 1024 * 1024)
+  charset_pages = {}
+  for cs in CHARSETS:
+    title = CHARSET_TITLE.encode(cs, errors='xmlcharrefreplace')
+    charset_pages[cs] = _page(title, charset=cs)
+
+  routes = web.RouteTableDef()
+
+  @routes.get('/plain/{n}')
+  async def plain(request):
+    return web.Response(
+      body = _page(b'page ' + request.match_info['n'].encode(),
+                   body=b'<p>hello</p>' * 200),
+      content_type = 'text/html',
+    )
+
+  @routes.get('/far')
+  async def far(request):
+    return web.Response(body=far_page, content_type='text/html')
+
+  @routes.get('/trickle')
+  async def trickle(request):
+    r = web.StreamResponse(headers={'Content-Type': 'text/html'})
+    await r.prepare(request)
+    await r.write(b'<!DOCTYPE html><html><head>')
+    for _ in range(20):
+      await asyncio.sleep(0.05)
+      await r.write(b'<!-- %s -->' % (b'.' * 500))
+    await r.write(b'<title>trickle</title></head>')
+    await r.write_eof()
+    return r
+
+  @routes.get('/redirect/{n}')
+  async def redirect(request):
+    n = int(request.match_info['n'])
+    if n <= 0:
+      raise web.HTTPFound('/plain/redirected')
+    raise web.HTTPFound('/redirect/%d' % (n - 1))
+
+  @routes.get('/jpeg')
+  async def jpeg_app(request):
+    return web.Response(body=jpeg, content_type='image/jpeg')
+
+  @routes.get('/gzip-bomb')
+  async def gzip_bomb(request):
+    return web.Response(body=bomb, headers={
+      'Content-Type': 'text/html',
+      'Content-Encoding': 'gzip',
+    })
+
+  @routes.get('/charset/{cs}')
+  async def charset(request):
+    return web.Response(
+      body = charset_pages[request.match_info['cs']],
+      content_type = 'text/html',
+    )
+
+  app = web.Application()
+  app.add_routes(routes)
+  return app
+
+def _serve(sock, ready):
+  logging.getLogger('aiohttp.access').disabled = True
+  app = make_app()
+  async def on_startup(app):
+    ready.set()
+  app.on_startup.append(on_startup)
+  web.run_app(app, sock=sock, print=None)
+
+def start_server(timeout=10):
+  '''start the fixture server in a child process, return (process, port)
+
+  It returns once the server is up.
+  '''
+  sock = socket.socket()
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind(('127.0.0.1', 0))
+  sock.listen(1024)
+  port = sock.getsockname()[1]
+  ready = multiprocessing.Event()
+  p = multiprocessing.Process(target=_serve, args=(sock, ready), daemon=True)
+  p.start()
+  sock.close()
+  if not ready.wait(timeout):
+    p.terminate()
+    p.join()
+    raise RuntimeError('the fixture server did not start')
+  return p, port
+
+class LoopbackResolver(AbstractResolver):
+  '''resolve every host under BENCH_DOMAIN to 127.0.0.1
+
+  Each alias gets its own connection pool, so thousands of hosts can be
+  simulated with a single server.
+  '''
+  async def resolve(self, host, port=0, family=socket.AF_INET):
+    if host != BENCH_DOMAIN and not host.endswith('.' + BENCH_DOMAIN):
+      raise OSError('%s is not a benchmark host' % host)
+    return [{
+      'hostname': host, 'host': '127.0.0.1', 'port': port,
+      'family': socket.AF_INET, 'proto': 0,
+      'flags': socket.AI_NUMERICHOST,
+    }]
+
+  async def close(self):
+    pass
+
+def scenarios(port, *, count, hosts):
+  base = 'http://%s:%d' % (BENCH_DOMAIN, port)
+  return {
+    'plain': [base + '/plain/%d' % i for i in range(count)],
+    'far': [base + '/far'] * max(count // 10, 1),
+    'trickle': [base + '/trickle'] * max(count // 10, 1),
+    'redirect': [base + '/redirect/8'] * count,
+    'jpeg': [base + '/jpeg'] * count,
+    'gzip-bomb': [base + '/gzip-bomb'] * max(count // 10, 1),
+    'charset': [
+      base + '/charset/' + CHARSETS[i % len(CHARSETS)]
+      for i in range(count)
+    ],
+    'hosts': [
+      'http://h%d.%s:%d/plain/%d' % (i, BENCH_DOMAIN, port, i)
+      for i in range(hosts)
+    ],
+  }
+
+def _percentile(sorted_values, q):
+  if not sorted_values:
+    return float('nan')
+  i = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+  return sorted_values[i]
+
+def _maxrss_mib(who=resource.RUSAGE_SELF):
+  # ru_maxrss is in KiB on Linux; it's the peak of the whole process so far
+  return resource.getrusage(who).ru_maxrss / 1024
+
+def _rss_mib():
+  '''the current resident set size, None where it's unknown'''
+  try:
+    with open('/proc/self/statm') as f:
+      pages = int(f.read().split()[1])
+  except (OSError, ValueError, IndexError):
+    return None
+  return pages * resource.getpagesize() / 1024 / 1024
+
+class _TimedFetcher(TitleFetcher):
+  latencies = None
+
+  async def run(self, proxy=None):
+    t = time.perf_counter()
+    try:
+      return await super().run(proxy)
+    finally:
+      self.latencies.append(time.perf_counter() - t)
+
+async def bench_fetcher(urls, *, concurrency, per_host, content_finders):
+  latencies = []
+  fetcher = type('Fetcher', (_TimedFetcher,), {'latencies': latencies})
+  connector = aiohttp.TCPConnector(
+    limit = concurrency, limit_per_host = per_host,
+    resolver = LoopbackResolver(),
+  )
+  errors = 0
+  rss = _rss_mib()
+  async with aiohttp.ClientSession(connector=connector) as session:
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    async for r in fetch_many(
+      urls, concurrency=concurrency, per_host=per_host, session=session,
+      fetcher=fetcher, content_finders=content_finders,
+    ):
+      if isinstance(r.info, Exception):
+        errors += 1
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+  latencies.sort()
+  return {
+    'urls': len(urls),
+    'errors': errors,
+    'urls_per_sec': len(urls) / wall,
+    'p50_ms': _percentile(latencies, 0.5) * 1000,
+    'p99_ms': _percentile(latencies, 0.99) * 1000,
+    'cpu_ms_per_url': cpu / len(urls) * 1000,
+    # what the scenario left in memory; the peak is over all scenarios so far
+    'rss_delta_mib': None if rss is None else _rss_mib() - rss,
+    'peak_rss_mib': _maxrss_mib(),
+  }
+
+def bench_main_entry(urls):
+  '''run `python -m fetchtitle` over urls in a child process'''
+  before = resource.getrusage(resource.RUSAGE_CHILDREN)
+  wall = time.perf_counter()
+  subprocess.run(
+    [sys.executable, '-m', 'fetchtitle'] + urls,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False,
+  )
+  wall = time.perf_counter() - wall
+  after = resource.getrusage(resource.RUSAGE_CHILDREN)
+  cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+  return {
+    'urls': len(urls),
+    'urls_per_sec': len(urls) / wall,
+    'cpu_ms_per_url': cpu / len(urls) * 1000,
+    # the largest child so far, which is this one unless it's the server
+    'peak_rss_mib': after.ru_maxrss / 1024,
+  }
+
+def _print_row(name, stats):
+  delta = stats.get('rss_delta_mib')
+  print('%-10s %6d urls %9.1f url/s  p50 %8.1f ms  p99 %8.1f ms  '
+        'cpu %7.2f ms/url  rss %+7.1f MiB  max rss so far %7.1f MiB%s' % (
+          name, stats['urls'], stats['urls_per_sec'],
+          stats.get('p50_ms', float('nan')),
+          stats.get('p99_ms', float('nan')),
+          stats['cpu_ms_per_url'],
+          float('nan') if delta is None else delta, stats['peak_rss_mib'],
+          '  (%d errors)' % stats['errors'] if stats.get('errors') else '',
+        ))
+
+async def run_benchmarks(args, port):
+  content_finders = list(TitleFetcher._content_finders)
+  if args.fast:
+    content_finders[content_finders.index(TitleFinder)] = FastTitleFinder
+
+  all_scenarios = scenarios(port, count=args.count, hosts=args.hosts)
+  names = args.scenario or list(all_scenarios)
+  results = {}
+  for name in names:
+    stats = await bench_fetcher(
+      all_scenarios[name],
+      concurrency = args.concurrency,
+      per_host = 0 if name == 'hosts' else args.per_host,
+      content_finders = tuple(content_finders),
+    )
+    results[name] = stats
+    if not args.json:
+      _print_row(name, stats)
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog='python -m fetchtitle.bench',
+    description='benchmark fetchtitle against a local fixture server',
+  )
+  parser.add_argument('-s', '--scenario', action='append',
+                      help='run only this scenario (repeatable)')
+  parser.add_argument('-n', '--count', type=int, default=200,
+                      help='URLs per scenario (default: %(default)s)')
+  parser.add_argument('--hosts', type=int, default=2000,
+                      help='distinct hosts in the "hosts" scenario '
+                      '(default: %(default)s)')
+  parser.add_argument('-c', '--concurrency', type=int, default=100)
+  parser.add_argument('--per-host', type=int, default=20)
+  parser.add_argument('--fast', action='store_true',
+                      help='use FastTitleFinder instead of TitleFinder')
+  parser.add_argument('--main', action='store_true',
+                      help='also benchmark the `python -m fetchtitle` '
+                      'entry point')
+  parser.add_argument('--json', action='store_true',
+                      help='print results as JSON')
+  args = parser.parse_args()
+  # "title too far away" and the like are expected here
+  logging.basicConfig(level=logging.ERROR)
+
+  server, port = start_server()
+  try:
+    results = asyncio.run(run_benchmarks(args, port))
+
+    if args.main:
+      # the entry point resolves names for real, so use the address
+      urls = ['http://127.0.0.1:%d/plain/%d' % (port, i)
+              for i in range(args.count)]
+      results['__main__'] = stats = bench_main_entry(urls)
+      if not args.json:
+        _print_row('__main__', stats)
+  finally:
+    server.terminate()
+    server.join()
+
+  if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+  if os.name != 'posix':
+    sys.exit('the benchmarks need a POSIX system')
+  main()
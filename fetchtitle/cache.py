@@ -0,0 +1,357 @@
+import time
+import json
+import sqlite3
+import functools
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import Timeout, TooManyRedirection, CircuitOpen, normalize_url
+from .serialize import result_to_json, result_from_json
+
+logger = logging.getLogger(__name__)
+
+class _BaseResultCache:
+  def __init__(self, ttl, timeout_ttl, redirection_ttl, stale_ttl):
+    self.ttl = ttl
+    self.timeout_ttl = timeout_ttl
+    self.redirection_ttl = redirection_ttl
+    self.stale_ttl = stale_ttl
+
+  async def get(self, url, *, variant=None):
+    entry = await self.lookup(url, variant=variant)
+    if entry is not None and entry[2]:
+      return entry[0]
+
+  def ttl_for(self, result):
+    if result.info is CircuitOpen:
+      # it says nothing about the URL itself
+      return 0
+    elif result.info is Timeout:
+      return self.timeout_ttl
+    elif result.info is TooManyRedirection:
+      return self.redirection_ttl
+    else:
+      return self.ttl
+
+def _key(url, variant):
+  key = normalize_url(url)
+  if variant:
+    key += ' ' + variant
+  return key
+
+class ResultCache(_BaseResultCache):
+  '''An in-process LRU cache of Results with per-entry expiry
+
+  `ttl` is used for ordinary results, while `timeout_ttl` and
+  `redirection_ttl` apply to Timeout and TooManyRedirection results, which
+  are usually worth retrying sooner. A TTL of 0 disables caching for that
+  kind of result.
+
+  Results stored with validators (ETag / Last-Modified of the response they
+  came from) are kept `stale_ttl` seconds longer, so that they can be
+  revalidated with a conditional request.
+
+  Results of the same URL differ with the <meta> fields asked for;
+  TitleFetcher passes them as the `variant` of an entry.
+  '''
+  def __init__(self, maxsize=1024, *, ttl=3600,
+               timeout_ttl=60, redirection_ttl=300, stale_ttl=86400,
+               clock=time.monotonic):
+    super().__init__(ttl, timeout_ttl, redirection_ttl, stale_ttl)
+    self.maxsize = maxsize
+    self._clock = clock
+    self._data = OrderedDict()
+
+    self.hits = self.misses = self.stale = 0
+    self.evictions = self.expirations = 0
+
+  def __len__(self):
+    return len(self._data)
+
+  async def lookup(self, url, *, variant=None):
+    '''return (result, validators, fresh), or None if nothing usable'''
+    key = _key(url, variant)
+    entry = self._data.get(key)
+    if entry is not None:
+      result, expires, validators = entry
+      now = self._clock()
+      if expires > now:
+        self._data.move_to_end(key)
+        self.hits += 1
+        return result, validators, True
+      if validators and expires + self.stale_ttl > now:
+        self.misses += 1
+        self.stale += 1
+        return result, validators, False
+      del self._data[key]
+      self.expirations += 1
+
+    self.misses += 1
+    return None
+
+  async def set(self, url, result, validators=None, *, variant=None):
+    ttl = self.ttl_for(result)
+    if not ttl or not self.maxsize:
+      return
+
+    key = _key(url, variant)
+    self._data[key] = result, self._clock() + ttl, validators
+    self._data.move_to_end(key)
+    while len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+      self.evictions += 1
+
+  def clear(self):
+    self._data.clear()
+
+  @property
+  def stats(self):
+    return {
+      'size': len(self._data),
+      'hits': self.hits,
+      'misses': self.misses,
+      'stale': self.stale,
+      'evictions': self.evictions,
+      'expirations': self.expirations,
+    }
+
+class SQLiteCache(_BaseResultCache):
+  '''A ResultCache stored in an SQLite database
+
+  Several processes may share the same database file (it is used in WAL
+  mode). Database work is done in a private thread so it doesn't block the
+  event loop. Expired entries, and the entries expiring first when there
+  are more than `max_entries`, are purged every `purge_every` writes.
+  '''
+  purge_every = 1000
+
+  def __init__(self, path, *, ttl=3600, timeout_ttl=60,
+               redirection_ttl=300, stale_ttl=86400, max_entries=100000):
+    super().__init__(ttl, timeout_ttl, redirection_ttl, stale_ttl)
+    self.path = path
+    self.max_entries = max_entries
+    self._settings = dict(
+      ttl=ttl, timeout_ttl=timeout_ttl, redirection_ttl=redirection_ttl,
+      stale_ttl=stale_ttl, max_entries=max_entries,
+    )
+    self._db = None
+    self._executor = ThreadPoolExecutor(
+      max_workers=1, thread_name_prefix='fetchtitle-sqlite')
+    self._writes = 0
+
+    self.hits = self.misses = self.stale = 0
+    self.expirations = self.purged = 0
+
+  def __reduce__(self):
+    # e.g. to another process: open the same database there
+    return functools.partial(type(self), self.path, **self._settings), ()
+
+  def _connect(self):
+    db = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                         isolation_level=None)
+    # must come before the table is created
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('''CREATE TABLE IF NOT EXISTS results (
+      key TEXT PRIMARY KEY,
+      expires REAL NOT NULL,
+      data TEXT NOT NULL,
+      validators TEXT
+    )''')
+    columns = [row[1] for row in db.execute('PRAGMA table_info(results)')]
+    if 'validators' not in columns:
+      db.execute('ALTER TABLE results ADD COLUMN validators TEXT')
+    db.execute('''CREATE INDEX IF NOT EXISTS results_expires
+                  ON results (expires)''')
+    return db
+
+  def _run(self, func, *args):
+    def wrapper():
+      if self._db is None:
+        self._db = self._connect()
+      return func(self._db, *args)
+    return asyncio.get_running_loop().run_in_executor(self._executor, wrapper)
+
+  async def lookup(self, url, *, variant=None):
+    '''return (result, validators, fresh), or None if nothing usable'''
+    row = await self._run(_db_get, _key(url, variant))
+    if row is not None:
+      data, expires, validators = row
+      now = time.time()
+      fresh = expires > now
+      if fresh or validators and expires + self.stale_ttl > now:
+        try:
+          r = result_from_json(json.loads(data))
+          if validators:
+            validators = json.loads(validators)
+        except (ValueError, KeyError):
+          logger.warning('bad cache entry for %s', url, exc_info=True)
+        else:
+          if fresh:
+            self.hits += 1
+          else:
+            self.misses += 1
+            self.stale += 1
+          return r, validators or None, fresh
+      else:
+        self.expirations += 1
+
+    self.misses += 1
+    return None
+
+  async def set(self, url, result, validators=None, *, variant=None):
+    ttl = self.ttl_for(result)
+    if not ttl:
+      return
+
+    data = json.dumps(result_to_json(result), ensure_ascii=False)
+    if validators:
+      validators = json.dumps(validators)
+    await self._run(
+      _db_set, _key(url, variant), time.time() + ttl, data, validators)
+
+    self._writes += 1
+    if self._writes % self.purge_every == 0:
+      await self.purge()
+
+  async def purge(self):
+    self.purged += await self._run(
+      _db_purge, time.time(), self.stale_ttl, self.max_entries)
+
+  async def clear(self):
+    await self._run(_db_clear)
+
+  async def close(self):
+    def close():
+      if self._db is not None:
+        self._db.close()
+        self._db = None
+    await asyncio.get_running_loop().run_in_executor(self._executor, close)
+    self._executor.shutdown(wait=False)
+
+  @property
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'stale': self.stale,
+      'expirations': self.expirations,
+      'purged': self.purged,
+    }
+
+def _db_get(db, key):
+  return db.execute(
+    'SELECT data, expires, validators FROM results WHERE key = ?',
+    (key,)).fetchone()
+
+def _db_set(db, key, expires, data, validators):
+  db.execute(
+    '''INSERT OR REPLACE INTO results (key, expires, data, validators)
+       VALUES (?, ?, ?, ?)''',
+    (key, expires, data, validators))
+
+def _db_purge(db, now, stale_ttl, max_entries):
+  db.execute('BEGIN IMMEDIATE')
+  try:
+    n = db.execute(
+      '''DELETE FROM results WHERE expires <= ?
+         AND (validators IS NULL OR expires <= ?)''',
+      (now, now - stale_ttl)).rowcount
+    count = db.execute('SELECT count(*) FROM results').fetchone()[0]
+    if count > max_entries:
+      n += db.execute('''DELETE FROM results WHERE key IN (
+        SELECT key FROM results ORDER BY expires LIMIT ?)''',
+        (count - max_entries,)).rowcount
+  except BaseException:
+    db.execute('ROLLBACK')
+    raise
+  db.execute('COMMIT')
+  db.execute('PRAGMA incremental_vacuum')
+  return n
+
+def _db_clear(db):
+  db.execute('DELETE FROM results')
+
+class RedirectCache:
+  '''Remember HTTP redirections so that later fetches can skip known hops
+
+  301 and 308 redirections are kept for `permanent_ttl` seconds, other ones
+  for `temporary_ttl`.
+  '''
+  permanent_statuses = (301, 308)
+
+  def __init__(self, maxsize=4096, *, permanent_ttl=86400,
+               temporary_ttl=300, clock=time.monotonic):
+    self.maxsize = maxsize
+    self.permanent_ttl = permanent_ttl
+    self.temporary_ttl = temporary_ttl
+    self._clock = clock
+    self._data = OrderedDict()
+
+    self.hits = self.misses = self.evictions = 0
+
+  def __len__(self):
+    return len(self._data)
+
+  def add(self, url, newurl, status):
+    if status in self.permanent_statuses:
+      ttl = self.permanent_ttl
+    else:
+      ttl = self.temporary_ttl
+    if not ttl or not self.maxsize:
+      return
+
+    key = normalize_url(url)
+    self._data[key] = newurl, self._clock() + ttl
+    self._data.move_to_end(key)
+    while len(self._data) > self.maxsize:
+      self._data.popitem(last=False)
+      self.evictions += 1
+
+  def _get(self, key):
+    entry = self._data.get(key)
+    if entry is None:
+      return
+    newurl, expires = entry
+    if expires > self._clock():
+      return newurl
+    del self._data[key]
+
+  def get(self, url):
+    newurl = self._get(normalize_url(url))
+    if newurl is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return newurl
+
+  def resolve(self, url):
+    '''follow cached redirections from url
+
+    Return the list of known hops after url, and whether they end up in a
+    loop.
+    '''
+    key = normalize_url(url)
+    seen = {key}
+    chain = []
+    while True:
+      newurl = self._get(key)
+      if newurl is None:
+        break
+      chain.append(newurl)
+      key = normalize_url(newurl)
+      if key in seen:
+        return chain, True
+      seen.add(key)
+
+    if chain:
+      self.hits += 1
+    else:
+      self.misses += 1
+    return chain, False
+
+  def clear(self):
+    self._data.clear()
@@ -1,17 +1,11 @@
 import re
 import logging
-import json
-
-try:
-  from lxml.html import fromstring
-  has_lxml = True
-except ImportError:
-  has_lxml = False
 
 from . import (
   URLFinder,
   HtmlTitleParser,
   Redirected,
+  parse_html,
 )
 
 logger = logging.getLogger(__name__)
@@ -28,7 +22,9 @@ class GithubFinder(URLFinder):
   async def run(self):
     m = self.match
     url = self._api_pat.format(**m.groupdict())
-    async with self.session.get(url) as res:
+    async with self.get(url, revalidate=True) as res:
+      if self.not_modified:
+        return self.cached_info
       if res.status == 404:
         logger.debug('got 404 from GitHub API, retry with original URL')
         raise Redirected(self.url, skip_urlfinder=True)
@@ -44,7 +40,7 @@ class SogouImage(URLFinder):
   _img_pat = re.compile(r' src="(\S+\.png)" border=0')
 
   async def run(self):
-    async with self.session.get(self.url) as res:
+    async with self.get(self.url) as res:
       body = await res.text()
       m = self._img_pat.search(body)
       if m:
@@ -61,11 +57,13 @@ class Imagebin(URLFinder):
 
 class WeixinCopy(URLFinder):
   _url_pat = re.compile(r'http://mp\.weixin\.qq\.com/s\?')
-  _src_pat = re.compile(r"var\s+msg_source_url\s+=\s+'([^']+)'")
+  _src_pat = re.compile(rb"var\s+msg_source_url\s+=\s+'([^']+)'")
+  _meta_fields = ('og:title', 'og:article:author')
 
   async def run(self):
-    async with self.session.get(self.url) as res:
-      body = await res.text()
+    async with self.get(self.url) as res:
+      # the source URL is in a script near the end
+      body = await res.read()
       m = self._src_pat.findall(body)
       if m:
         src = m[-1].decode('latin1')
@@ -74,10 +72,9 @@ class WeixinCopy(URLFinder):
       else:
         src = None
 
-      body = await res.text()
-      doc = fromstring(body)
-      title = doc.xpath('//meta[@property="og:title"]')[0].get('content')
-      author = doc.xpath('//meta[@property="og:article:author"]')[0].get('content')
+      meta = parse_html(body, self._meta_fields, headers=res.headers).meta
+      title = meta.get('og:title')
+      author = meta.get('og:article:author')
 
       return '%s - %s ' % (title, author), src
 
@@ -88,21 +85,15 @@ class NeteaseMusic(URLFinder):
     raise Redirected('https://music.163.com/%s' % self.match.group(1))
 
 class ZhihuZhuanlan(URLFinder):
-  if has_lxml:
-    _url_pat = re.compile(r'https?://zhuanlan\.zhihu\.com/p/(?P<id>\d+)')
-  else:
-    _url_pat = re.compile(r'a^')
+  _url_pat = re.compile(r'https?://zhuanlan\.zhihu\.com/p/(?P<id>\d+)')
 
   async def run(self):
     id = self.match.group('id')
-    async with self.session.get(self.url) as res:
-      page = await res.text()
-      doc = fromstring(page)
-      static = doc.xpath('//script[@id="js-initialData"]')[0]
-      content = json.loads(static.text)['initialState']
-
-      article = content['entities']['articles'][id]
-      return article
+    async with self.get(self.url) as res:
+      return await self.read_script(
+        res, id='js-initialData',
+        path=('initialState', 'entities', 'articles', id),
+      )
 
 class RustCrate(URLFinder):
   _url_pat = re.compile(r'https?://crates\.io/crates/(?P<crate>[^/#]+)/?')
@@ -111,6 +102,13 @@ class RustCrate(URLFinder):
     url = 'https://crates.io/api/v1/crates/{crate}'
     url = url.format_map(self.match.groupdict())
 
-    async with self.session.get(url) as res:
+    async with self.get(url, revalidate=True) as res:
+      if self.not_modified:
+        return self.cached_info
       info = await res.json()
       return info
+
+# what the command line and the server use
+default_url_finders = (
+  GithubFinder, GithubUserFinder, ZhihuZhuanlan, NeteaseMusic, SogouImage,
+)
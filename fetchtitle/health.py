@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+class _HostState:
+  __slots__ = ('failures', 'open_until', 'cooldown', 'probe_since')
+
+  def __init__(self):
+    self.failures = 0
+    self.open_until = None
+    self.cooldown = 0
+    self.probe_since = None
+
+class HostHealth:
+  '''A per-host circuit breaker
+
+  After `failures` consecutive connection errors, resets or timeouts from a
+  host, its circuit opens: TitleFetcher answers CircuitOpen for it at once
+  for `cooldown` seconds. Then a single probe request is let through
+  (half-open); if it succeeds the circuit closes, otherwise it opens again
+  for twice as long, up to `max_cooldown`.
+  '''
+  def __init__(self, failures=5, *, cooldown=30, max_cooldown=600,
+               maxsize=10000, clock=time.monotonic):
+    self.threshold = failures
+    self.cooldown = cooldown
+    self.max_cooldown = max_cooldown
+    self.maxsize = maxsize
+    self._clock = clock
+    self._hosts = OrderedDict()
+
+    self.opened = self.rejected = self.probes = 0
+
+  def __len__(self):
+    return len(self._hosts)
+
+  def is_open(self, host):
+    st = self._hosts.get(host)
+    return st is not None and st.open_until is not None
+
+  def allow(self, host):
+    st = self._hosts.get(host)
+    if st is None or st.open_until is None:
+      return True
+
+    now = self._clock()
+    if now < st.open_until:
+      self.rejected += 1
+      return False
+    # half-open: one probe at a time, but don't wait forever for a probe
+    # that never reported back
+    if st.probe_since is not None and now - st.probe_since < st.cooldown:
+      self.rejected += 1
+      return False
+    st.probe_since = now
+    self.probes += 1
+    return True
+
+  def success(self, host):
+    self._hosts.pop(host, None)
+
+  def failure(self, host):
+    st = self._hosts.get(host)
+    if st is None:
+      st = self._hosts[host] = _HostState()
+      while len(self._hosts) > self.maxsize:
+        self._hosts.popitem(last=False)
+    else:
+      self._hosts.move_to_end(host)
+
+    st.failures += 1
+    if st.probe_since is not None:
+      st.cooldown = min(st.cooldown * 2, self.max_cooldown)
+    elif st.failures >= self.threshold:
+      if st.open_until is None:
+        self.opened += 1
+      st.cooldown = self.cooldown
+    else:
+      return
+    st.probe_since = None
+    st.open_until = self._clock() + st.cooldown
+
+  @property
+  def stats(self):
+    return {
+      'tracked': len(self._hosts),
+      'open': sum(st.open_until is not None for st in self._hosts.values()),
+      'opened': self.opened,
+      'rejected': self.rejected,
+      'probes': self.probes,
+    }
@@ -0,0 +1,157 @@
+import time
+import socket
+import asyncio
+import logging
+import ipaddress
+from collections import deque
+
+import aiohttp
+from yarl import URL
+
+logger = logging.getLogger(__name__)
+
+class Hedging:
+  '''Race a second request against a hop that is slow to answer
+
+  When a hop has no response headers after `delay()` seconds, the time
+  `percentile` of recent hops took (within `min_delay` and `max_delay`;
+  `initial_delay` until `min_samples` hops are seen), a second attempt is
+  made. It goes to another address of the host when it has more than one
+  and `other_address` is true (and no proxy is used), otherwise over a new
+  connection, or through another proxy of a proxies.ProxyPool. The first
+  response wins and the other attempt is cancelled.
+
+  Share one instance between TitleFetchers (`hedging=...`) so that the
+  delay follows their latencies. Counters: `hops`, `hedged` (second
+  attempts made), `hedge_won` and `primary_won` (among hedged hops).
+  '''
+  def __init__(self, percentile=0.95, *, min_delay=0.05, max_delay=2,
+               initial_delay=0.5, window=1000, min_samples=20,
+               other_address=True, resolver=None):
+    self.percentile = percentile
+    self.min_delay = min_delay
+    self.max_delay = max_delay
+    self.initial_delay = initial_delay
+    self.min_samples = min_samples
+    self.other_address = other_address
+    self._resolver = resolver
+    self._samples = deque(maxlen=window)
+    self._delay = None
+
+    self.hops = self.hedged = self.hedge_won = self.primary_won = 0
+
+  def delay(self):
+    if len(self._samples) < self.min_samples:
+      return self.initial_delay
+    if self._delay is None:
+      samples = sorted(self._samples)
+      i = min(len(samples) - 1, int(self.percentile * len(samples)))
+      self._delay = min(self.max_delay, max(self.min_delay, samples[i]))
+    return self._delay
+
+  def record(self, seconds):
+    self._samples.append(seconds)
+    # recomputed now and then, not for every hop
+    if len(self._samples) % 16 == 0:
+      self._delay = None
+
+  @property
+  def stats(self):
+    return {
+      'hops': self.hops,
+      'hedged': self.hedged,
+      'hedge_won': self.hedge_won,
+      'primary_won': self.primary_won,
+      'delay': self.delay(),
+    }
+
+  async def get(self, request, url, **kwargs):
+    '''request(url, **kwargs), hedged; request is e.g. a session's get'''
+    self.hops += 1
+    start = time.perf_counter()
+    primary = asyncio.ensure_future(_call(request, url, kwargs))
+    second = winner = None
+    try:
+      done, _ = await asyncio.wait((primary,), timeout=self.delay())
+      if done:
+        winner = primary
+        self.record(time.perf_counter() - start)
+        return primary.result()
+
+      logger.debug('hedging %s after %.3fs', url, self.delay())
+      self.hedged += 1
+      second = asyncio.ensure_future(self._second(request, url, kwargs))
+      pending = {primary, second}
+      while pending:
+        done, pending = await asyncio.wait(
+          pending, return_when=asyncio.FIRST_COMPLETED)
+        for fu in (primary, second):
+          if fu in done and not fu.cancelled() and not fu.exception():
+            winner = fu
+            break
+        if winner is not None:
+          break
+
+      self.record(time.perf_counter() - start)
+      if winner is None:
+        # both failed; report what happened to the first one
+        winner = primary
+        return primary.result()
+      if winner is second:
+        self.hedge_won += 1
+      else:
+        self.primary_won += 1
+      return winner.result()
+
+    finally:
+      # also when we are cancelled, e.g. by the fetcher's timeouts
+      for fu in (primary, second):
+        if fu is None or fu is winner:
+          continue
+        if not fu.done():
+          fu.cancel()
+        elif not fu.cancelled() and not fu.exception():
+          # answered too, but late
+          fu.result().close()
+
+  async def _second(self, request, url, kwargs):
+    if self.other_address and kwargs.get('proxy') is None:
+      try:
+        url, kwargs = await self._to_other_address(url, kwargs)
+      except OSError as e:
+        logger.debug('cannot resolve %s: %r', url, e)
+    return await request(url, **kwargs)
+
+  async def _to_other_address(self, url, kwargs):
+    u = URL(url)
+    host = u.raw_host
+    if not host or _is_ip(host):
+      return url, kwargs
+    if self._resolver is None:
+      self._resolver = aiohttp.ThreadedResolver()
+    infos = await self._resolver.resolve(
+      host, u.port, family=socket.AF_UNSPEC)
+    addresses = list(dict.fromkeys(info['host'] for info in infos))
+    if len(addresses) < 2:
+      return url, kwargs
+
+    # the connector tries addresses in order, so the first is likely the
+    # one that is slow
+    headers = dict(kwargs.get('headers') or ())
+    headers['Host'] = u.raw_host if u.is_default_port() \
+                      else '%s:%d' % (u.raw_host, u.port)
+    kwargs = dict(kwargs, headers=headers)
+    if u.scheme == 'https':
+      kwargs['server_hostname'] = host
+    logger.debug('trying %s at %s', url, addresses[1])
+    return str(u.with_host(addresses[1])), kwargs
+
+async def _call(request, url, kwargs):
+  return await request(url, **kwargs)
+
+def _is_ip(host):
+  try:
+    ipaddress.ip_address(host)
+  except ValueError:
+    return False
+  return True
@@ -0,0 +1,198 @@
+'''Run fetches in several worker processes
+
+Parsing happens on the event loop's thread, so a single process tops out
+at one core. `fetch_many(urls, processes=N)` shards URLs by host over N
+worker processes, each with its own event loop and session, and merges the
+results back.
+'''
+
+import zlib
+import queue
+import pickle
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from urllib.parse import urlsplit
+
+from . import fetch_many, _iter_urls, _finder_class
+
+logger = logging.getLogger(__name__)
+
+def shard_of(url, n):
+  '''the worker a URL goes to; all URLs of a host go to the same one'''
+  try:
+    host = urlsplit(url).hostname or ''
+  except ValueError:
+    host = ''
+  return zlib.crc32(host.encode('utf-8', 'surrogatepass')) % n
+
+def _portable(r):
+  '''make a Result picklable: finders become classes, odd errors plain'''
+  if r.finder is not None:
+    r = r._replace(finder=_finder_class(r.finder))
+  if isinstance(r.info, BaseException):
+    try:
+      pickle.loads(pickle.dumps(r.info))
+    except Exception:
+      r = r._replace(info=Exception(
+        '%s: %s' % (type(r.info).__name__, r.info)))
+  return r
+
+def _worker(inq, outq, kwargs):
+  try:
+    asyncio.run(_work(inq, outq, kwargs))
+  except KeyboardInterrupt:
+    pass
+
+async def _work(inq, outq, kwargs):
+  loop = asyncio.get_running_loop()
+  # fetch_many index -> our caller's index
+  indices = {}
+
+  async def urls():
+    n = 0
+    while True:
+      item = await loop.run_in_executor(None, inq.get)
+      if item is None:
+        break
+      indices[n] = item[0]
+      n += 1
+      yield item[1]
+
+  async for i, r in fetch_many(urls(), with_index=True, **kwargs):
+    outq.put((indices.pop(i), _portable(r)))
+
+async def fetch_sharded(urls, *, processes, concurrency=20, per_host=4,
+                        ordered=False, with_index=False, **kwargs):
+  '''fetch_many over `processes` worker processes
+
+  `concurrency` applies to each process. Other arguments are as for
+  fetch_many, but need to be picklable; each worker gets its own copy (so
+  e.g. a ResultCache isn't shared, while an SQLiteCache is). Results have
+  finder classes instead of finder instances. Worker processes are
+  spawned, so the main module must be importable without side effects.
+  '''
+  ctx = multiprocessing.get_context('spawn')
+  outq = ctx.Queue()
+  inqs = []
+  workers = []
+  worker_kwargs = dict(kwargs, concurrency=concurrency, per_host=per_host)
+  for _ in range(processes):
+    inq = ctx.Queue()
+    p = ctx.Process(target=_worker, args=(inq, outq, worker_kwargs),
+                    daemon=True)
+    p.start()
+    inqs.append(inq)
+    workers.append(p)
+
+  loop = asyncio.get_running_loop()
+  closing = False
+
+  def get():
+    while not closing:
+      try:
+        return outq.get(timeout=0.5)
+      except queue.Empty:
+        if not all(p.is_alive() for p in workers):
+          raise RuntimeError('a worker process died')
+
+  it = _iter_urls(urls).__aiter__()
+  exhausted = False
+  # (index, url) waiting for room in their worker, so that a busy worker
+  # doesn't hold up URLs for the others; at most max_waiting in all
+  waiting = [deque() for _ in range(processes)]
+  nwaiting = 0
+  max_waiting = concurrency * processes
+  index = 0
+  inflight = [0] * processes
+  # index -> worker, for fetches not yet yielded
+  owner = {}
+  # finished out of order, when ordered
+  finished = {}
+  next_index = 0
+  done = False
+  # The next URL and the next result are awaited together, as in
+  # fetch_many, so that a slow source doesn't hold up the results.
+  next_url = None
+  got = None
+
+  async def get_url():
+    try:
+      return await it.__anext__()
+    except StopAsyncIteration:
+      return None
+
+  def dispatch(w):
+    nonlocal nwaiting
+    q = waiting[w]
+    while q and inflight[w] < concurrency:
+      inqs[w].put(q.popleft())
+      inflight[w] += 1
+      nwaiting -= 1
+
+  def finish(i):
+    w = owner.pop(i)
+    inflight[w] -= 1
+    dispatch(w)
+
+  try:
+    while True:
+      if next_url is None and not exhausted and nwaiting < max_waiting:
+        next_url = asyncio.ensure_future(get_url())
+      if got is None and owner:
+        got = loop.run_in_executor(None, get)
+      if next_url is None and got is None:
+        break
+
+      ready, _ = await asyncio.wait(
+        {fu for fu in (next_url, got) if fu is not None},
+        return_when=asyncio.FIRST_COMPLETED)
+
+      if next_url in ready:
+        url = next_url.result()
+        next_url = None
+        if url is None:
+          exhausted = True
+        else:
+          w = shard_of(url, processes)
+          owner[index] = w
+          waiting[w].append((index, url))
+          nwaiting += 1
+          index += 1
+          dispatch(w)
+
+      if got not in ready:
+        continue
+      i, r = got.result()
+      got = None
+      if ordered:
+        finished[i] = r
+        while next_index in finished:
+          r = finished.pop(next_index)
+          finish(next_index)
+          yield (next_index, r) if with_index else r
+          next_index += 1
+      else:
+        finish(i)
+        yield (i, r) if with_index else r
+    done = True
+
+  finally:
+    closing = True
+    for inq in inqs:
+      if done:
+        inq.put(None)
+      else:
+        inq.cancel_join_thread()
+    for p in workers:
+      if not done:
+        p.terminate()
+      p.join(5)
+      if p.is_alive():
+        logger.warning('worker %d did not exit, killing it', p.pid)
+        p.kill()
+    if next_url is not None:
+      next_url.cancel()
+      await asyncio.wait([next_url])
+    await it.aclose()
@@ -0,0 +1,171 @@
+import time
+import random
+import logging
+from fnmatch import fnmatchcase
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class _ProxyState:
+  __slots__ = ('latency', 'errors', 'failures', 'ejected_until', 'strikes',
+               'inflight', 'used')
+
+  def __init__(self):
+    # moving averages of the seconds to response headers and of the
+    # failure rate
+    self.latency = None
+    self.errors = 0.0
+    self.failures = 0
+    self.ejected_until = None
+    # ejections since it last worked
+    self.strikes = 0
+    self.inflight = 0
+    self.used = 0
+
+class ProxyPool:
+  '''A pool of proxies to pick from for each hop
+
+  Pass it as the `proxy` of TitleFetcher.run or fetch_many. Each hop goes
+  through the proxy with the lowest expected time: the moving average
+  latency (weight `alpha` for new samples), raised by its moving error
+  rate and by the requests it has in flight. Proxies not tried yet go
+  first. A host sticks to the proxy it last used while that one is within
+  `stickiness` times the best, to reuse warm connections (which aiohttp
+  pools per proxy); now and then (`explore`) a random proxy is tried to
+  keep estimates fresh.
+
+  A request that fails to get a response through a proxy is tried again
+  through another one, up to `retries` times. After `failures` errors in a
+  row a proxy is ejected for `eject_for` seconds, doubling each time it
+  fails again, up to `max_eject`.
+
+  `routes` is a sequence of (host glob, proxies) pairs, e.g.
+  `[('*.example.cn', ['http://cn-1:3128'])]`; the first matching one
+  restricts the proxies for a host. None in a list of proxies means a
+  direct connection.
+  '''
+  def __init__(self, proxies, *, routes=(), alpha=0.3, retries=1,
+               failures=3, eject_for=30, max_eject=600, stickiness=1.5,
+               explore=0.02, maxsize=10000, clock=time.monotonic):
+    self._states = OrderedDict((p, _ProxyState()) for p in proxies)
+    if not self._states:
+      raise ValueError('no proxies given')
+    self._routes = []
+    for pattern, route_proxies in routes:
+      route_proxies = list(route_proxies)
+      unknown = [p for p in route_proxies if p not in self._states]
+      if unknown:
+        raise ValueError('proxies not in the pool: %r' % unknown)
+      self._routes.append((pattern.lower(), route_proxies))
+    self.alpha = alpha
+    self.retries = retries
+    self.threshold = failures
+    self.eject_for = eject_for
+    self.max_eject = max_eject
+    self.stickiness = stickiness
+    self.explore = explore
+    self.maxsize = maxsize
+    self._clock = clock
+    # host -> the proxy it last used
+    self._affinity = OrderedDict()
+
+    self.ejections = 0
+
+  def __len__(self):
+    return len(self._states)
+
+  def candidates(self, host):
+    host = (host or '').lower()
+    for pattern, proxies in self._routes:
+      if fnmatchcase(host, pattern):
+        return proxies
+    return list(self._states)
+
+  def pick(self, host, exclude=()):
+    '''the proxy for a request to host; report() must follow'''
+    candidates = [p for p in self.candidates(host) if p not in exclude] \
+                 or self.candidates(host)
+    now = self._clock()
+    available = [p for p in candidates if self._available(p, now)]
+    if not available:
+      # all ejected; the one back first is the best bet
+      proxy = min(candidates, key=lambda p: self._states[p].ejected_until)
+    elif len(available) > 1 and random.random() < self.explore:
+      proxy = random.choice(available)
+    else:
+      proxy = min(available, key=self._score)
+      # (None is a direct connection, not a missing affinity)
+      sticky = self._affinity.get(host, proxy)
+      if sticky in available and sticky != proxy and \
+         self._score(sticky) <= self._score(proxy) * self.stickiness:
+        proxy = sticky
+
+    st = self._states[proxy]
+    st.inflight += 1
+    st.used += 1
+    self._affinity[host] = proxy
+    self._affinity.move_to_end(host)
+    while len(self._affinity) > self.maxsize:
+      self._affinity.popitem(last=False)
+    return proxy
+
+  def report(self, proxy, latency=None, ok=True):
+    '''the outcome of a request through proxy
+
+    `ok` is None when the request was abandoned: only its latency so far
+    counts then.
+    '''
+    st = self._states[proxy]
+    st.inflight -= 1
+    a = self.alpha
+    if latency is not None:
+      if st.latency is None:
+        st.latency = latency
+      elif ok is not None or latency > st.latency:
+        # an abandoned request only tells it takes at least this long
+        st.latency = st.latency * (1 - a) + latency * a
+    if ok is None:
+      return
+    if ok:
+      st.errors *= 1 - a
+      st.failures = st.strikes = 0
+      st.ejected_until = None
+      return
+
+    st.errors = st.errors * (1 - a) + a
+    now = self._clock()
+    if not self._available(proxy, now):
+      # started before the ejection
+      return
+    st.failures += 1
+    if st.failures >= self.threshold:
+      duration = min(self.max_eject, self.eject_for * 2 ** st.strikes)
+      logger.info('ejecting proxy %s for %ds', proxy, duration)
+      st.ejected_until = now + duration
+      st.strikes += 1
+      # one more failure after it's back ejects it again
+      st.failures = self.threshold - 1
+      self.ejections += 1
+
+  @property
+  def stats(self):
+    now = self._clock()
+    return {
+      proxy: {
+        'latency': st.latency,
+        'errors': st.errors,
+        'inflight': st.inflight,
+        'used': st.used,
+        'ejected': not self._available(proxy, now),
+      } for proxy, st in self._states.items()
+    }
+
+  def _available(self, proxy, now):
+    until = self._states[proxy].ejected_until
+    return until is None or until <= now
+
+  def _score(self, proxy):
+    st = self._states[proxy]
+    if st.latency is None:
+      return 0
+    return st.latency * (1 + st.inflight) / max(0.05, 1 - st.errors)
@@ -0,0 +1,477 @@
+'''Record responses to an archive and replay them without the network
+
+A RecordingSession wraps an aiohttp session and saves every response it
+gets, with the body chunks as they were read (their boundaries and arrival
+times), or the error the request failed with. A ReplaySession reads such an
+archive and answers requests from it, at full speed or at the recorded
+pace. Both go wherever a session does:
+
+  session = RecordingSession('run.gz')
+  async for r in fetch_many(urls, session=session): ...
+  await session.close()
+
+  async for r in fetch_many(urls, session=ReplaySession('run.gz')): ...
+
+Only what was read is recorded. A replayed body that wasn't read to its
+end (`complete`) stalls where the recording stopped, as it did when the
+finders had enough or a timeout hit; with a `timeout` whose sock_read is
+set, it fails like aiohttp does after that long. A request cancelled before
+its response came (e.g. by TitleFetcher's first_byte_timeout) is recorded
+too, and never answers when replayed.
+
+The archive is gzipped; each exchange is a line of JSON (url, status,
+reason, headers, `time` to the response headers, `chunks` as [time, size]
+pairs, `complete`, and `error` and `error_type` for a failed request or
+body) followed by the body bytes. Replayed errors are RecordedErrors, of
+the recorded class too when it is aiohttp's, asyncio's or a builtin one.
+
+`python -m fetchtitle.replay record ARCHIVE URL...` records a run, and
+`python -m fetchtitle.replay replay ARCHIVE [URL...]` replays it.
+'''
+
+import sys
+import json
+import builtins
+import gzip
+import time
+import asyncio
+import logging
+import argparse
+from collections import namedtuple, defaultdict
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from . import UserAgent, get_charset_from_ctype
+
+logger = logging.getLogger(__name__)
+
+Exchange = namedtuple('Exchange', 'url status reason headers time chunks '
+                      'complete error error_type')
+Exchange.__doc__ = '''a recorded request
+
+`headers` is a list of (name, value) pairs, `time` the seconds until the
+response headers (or the error) came, and `chunks` a list of (seconds,
+bytes) pairs. `error` is the message of the error the request (or, with a
+`status`, reading its body) failed with, or None, and `error_type` the name
+of its class; it is CancelledError for a request given up on before its
+response came.
+'''
+
+class NotRecorded(aiohttp.ClientConnectionError):
+  '''a replayed request for a URL that isn't in the archive'''
+
+class RecordedError(aiohttp.ClientConnectionError):
+  '''a replayed error; subclasses are named after the recorded ones'''
+  def __init__(self, message=''):
+    Exception.__init__(self, message)
+
+  def __str__(self):
+    return str(self.args[0]) if self.args else ''
+
+_error_classes = {}
+
+def _original_error(name):
+  for module in (aiohttp, asyncio, builtins):
+    cls = getattr(module, name, None)
+    if isinstance(cls, type) and issubclass(cls, Exception):
+      return cls
+
+def _recorded_error(name):
+  cls = _error_classes.get(name)
+  if cls is None:
+    # keep the bases, e.g. TimeoutError for aiohttp's timeouts
+    original = _original_error(name)
+    bases = (RecordedError,)
+    if original is not None and not issubclass(RecordedError, original):
+      bases += (original,)
+    cls = _error_classes[name] = type(name, bases, {})
+  return cls
+
+def read_archive(path):
+  '''yield the Exchanges in an archive'''
+  with gzip.open(path, 'rb') as f:
+    for line in f:
+      d = json.loads(line)
+      chunks = []
+      for t, size in d.get('chunks', ()):
+        data = f.read(size)
+        if len(data) != size:
+          raise ValueError('truncated archive: %s' % path)
+        chunks.append((t, data))
+      yield Exchange(
+        d['url'], d.get('status'), d.get('reason'),
+        [tuple(h) for h in d.get('headers', ())], d['time'], chunks,
+        d.get('complete', False), d.get('error'), d.get('error_type'),
+      )
+
+class ArchiveWriter:
+  def __init__(self, path, *, compresslevel=6):
+    self._f = gzip.open(path, 'wb', compresslevel=compresslevel)
+
+  def write(self, ex):
+    d = {'url': ex.url, 'time': round(ex.time, 6)}
+    if ex.error is not None:
+      d['error'] = ex.error
+      d['error_type'] = ex.error_type
+    if ex.status is not None:
+      d.update(
+        status = ex.status,
+        reason = ex.reason,
+        headers = [list(h) for h in ex.headers],
+        chunks = [[round(t, 6), len(data)] for t, data in ex.chunks],
+        complete = ex.complete,
+      )
+    self._f.write(json.dumps(d, ensure_ascii=False).encode() + b'\n')
+    for _, data in ex.chunks:
+      self._f.write(data)
+
+  def close(self):
+    self._f.close()
+
+class _RequestContext:
+  '''what session.get returns: awaitable, or an async context manager'''
+  def __init__(self, coro):
+    self._coro = coro
+    self._response = None
+
+  def __await__(self):
+    return self._coro.__await__()
+
+  async def __aenter__(self):
+    self._response = await self._coro
+    return self._response
+
+  async def __aexit__(self, exc_type, exc, tb):
+    self._response.release()
+
+class _Response:
+  # status, reason, headers, url and content are set by subclasses
+  _body = None
+
+  @property
+  def content_length(self):
+    l = self.headers.get('Content-Length')
+    return int(l) if l and l.isdigit() else None
+
+  def get_encoding(self):
+    return get_charset_from_ctype(
+      self.headers.get('Content-Type', '')) or 'utf-8'
+
+  async def read(self):
+    if self._body is None:
+      self._body = await self.content.read()
+    return self._body
+
+  async def text(self, encoding=None, errors='strict'):
+    body = await self.read()
+    return body.decode(encoding or self.get_encoding(), errors)
+
+  async def json(self, *, loads=json.loads, **kwargs):
+    return loads(await self.text())
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    self.release()
+
+class _RecordingContent:
+  def __init__(self, content, start):
+    self._content = content
+    self._start = start
+    self.chunks = []
+    self.complete = False
+    self.error = None
+
+  def _got(self, data, eof):
+    if data:
+      self.chunks.append((time.perf_counter() - self._start, data))
+    if eof:
+      self.complete = True
+    return data
+
+  async def _read(self, read, *args):
+    try:
+      return await read(*args)
+    except _recorded_errors as e:
+      self.error = e
+      raise
+
+  async def readany(self):
+    data = await self._read(self._content.readany)
+    return self._got(data, not data)
+
+  async def read(self, n=-1):
+    data = await self._read(self._content.read, n)
+    return self._got(data, n < 0 or not data)
+
+  def at_eof(self):
+    return self._content.at_eof()
+
+class _RecordingResponse(_Response):
+  def __init__(self, r, url, start, recorder):
+    self._r = r
+    self._url = url
+    self._start = start
+    self._recorder = recorder
+    self._headers_time = time.perf_counter() - start
+    self.status = r.status
+    self.reason = r.reason
+    self.headers = r.headers
+    self.url = r.url
+    self.content = _RecordingContent(r.content, start)
+
+  def _save(self):
+    if self._recorder is None:
+      return
+    content = self.content
+    error = content.error
+    self._recorder._write(Exchange(
+      self._url, self.status, self.reason, list(self.headers.items()),
+      self._headers_time, content.chunks, content.complete,
+      None if error is None else str(error),
+      None if error is None else type(error).__name__,
+    ))
+    self._recorder = None
+
+  def release(self):
+    self._save()
+    self._r.release()
+
+  def close(self):
+    self._save()
+    self._r.close()
+
+class RecordingSession:
+  '''an aiohttp session that records the responses it gets
+
+  Wrap `session`, or a session of its own if None. close() finishes the
+  archive (and closes the session if it's its own).
+  '''
+  def __init__(self, path, session=None, *, compresslevel=6):
+    self._session = session
+    self._our_session = session is None
+    self._writer = ArchiveWriter(path, compresslevel=compresslevel)
+    self.recorded = 0
+
+  @property
+  def session(self):
+    if self._session is None:
+      self._session = aiohttp.ClientSession(headers={
+        'User-Agent': UserAgent,
+      })
+    return self._session
+
+  @property
+  def closed(self):
+    return self._writer is None
+
+  def get(self, url, **kwargs):
+    return _RequestContext(self._get(url, kwargs))
+
+  async def _get(self, url, kwargs):
+    start = time.perf_counter()
+    try:
+      r = await self.session.get(url, **kwargs)
+    except (_recorded_errors + (asyncio.CancelledError,)) as e:
+      # a cancellation, e.g. by a timeout around us, is replayed as a
+      # request that never gets an answer
+      self._write(Exchange(
+        str(url), None, None, [], time.perf_counter() - start, [], False,
+        str(e), type(e).__name__,
+      ))
+      raise
+    return _RecordingResponse(r, str(url), start, self)
+
+  def _write(self, ex):
+    if self._writer is None:
+      logger.warning('response for %s finished after close', ex.url)
+      return
+    self._writer.write(ex)
+    self.recorded += 1
+
+  async def close(self):
+    if self._our_session and self._session is not None:
+      await self._session.close()
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+
+class _ReplayContent:
+  def __init__(self, ex, start, speed, sock_read):
+    self._chunks = ex.chunks
+    self._i = 0
+    self._buf = b''
+    self._start = start
+    self._speed = speed
+    self._sock_read = sock_read
+    # what happens after the last chunk: EOF, an error, or nothing
+    self._eof = ex.complete and ex.error is None
+    self._error = None
+    if ex.error is not None:
+      self._error = _recorded_error(ex.error_type or 'RecordedError')(ex.error)
+
+  async def readany(self):
+    if self._buf:
+      data, self._buf = self._buf, b''
+      return data
+    if self._i == len(self._chunks):
+      if self._eof:
+        return b''
+      if self._error is not None:
+        raise self._error
+      await _stall(self._sock_read)
+    t, data = self._chunks[self._i]
+    self._i += 1
+    if self._speed:
+      await _sleep_until(self._start + t / self._speed)
+    return data
+
+  async def read(self, n=-1):
+    if n < 0:
+      parts = []
+      while True:
+        data = await self.readany()
+        if not data:
+          return b''.join(parts)
+        parts.append(data)
+    data = await self.readany()
+    if len(data) > n:
+      data, self._buf = data[:n], data[n:]
+    return data
+
+  def at_eof(self):
+    return not self._buf and self._i == len(self._chunks) and self._eof
+
+class _ReplayResponse(_Response):
+  def __init__(self, ex, start, speed, sock_read):
+    self.status = ex.status
+    self.reason = ex.reason
+    self.headers = CIMultiDictProxy(CIMultiDict(ex.headers))
+    self.url = URL(ex.url)
+    self.content = _ReplayContent(ex, start, speed, sock_read)
+
+  def release(self):
+    pass
+
+  def close(self):
+    pass
+
+class ReplaySession:
+  '''answer requests from an archive instead of the network
+
+  `archive` is a path or an iterable of Exchanges. With `speed`, responses
+  come at the recorded pace divided by it (so 1 is real time); otherwise as
+  fast as they are read. A URL recorded several times gets its recordings
+  in turn, over again after the last.
+  '''
+  closed = False
+
+  def __init__(self, archive, *, speed=None):
+    if isinstance(archive, str):
+      archive = read_archive(archive)
+    self._exchanges = defaultdict(list)
+    for ex in archive:
+      self._exchanges[ex.url].append(ex)
+    self._next = defaultdict(int)
+    self.speed = speed
+
+  @property
+  def urls(self):
+    '''the URLs in the archive that aren't redirection targets in it'''
+    targets = set()
+    for exs in self._exchanges.values():
+      for ex in exs:
+        if ex.status in (301, 302, 303, 307, 308):
+          location = dict((k.lower(), v) for k, v in ex.headers) \
+                     .get('location')
+          if location:
+            targets.add(str(URL(ex.url).join(URL(location))))
+    return [url for url in self._exchanges if url not in targets]
+
+  def get(self, url, *, timeout=None, **kwargs):
+    sock_read = getattr(timeout, 'sock_read', None)
+    return _RequestContext(self._get(str(url), sock_read))
+
+  async def _get(self, url, sock_read):
+    exs = self._exchanges.get(url)
+    if not exs:
+      raise NotRecorded('not in the archive: %s' % url)
+    i = self._next[url]
+    self._next[url] = (i + 1) % len(exs)
+    ex = exs[i]
+
+    start = asyncio.get_running_loop().time()
+    if self.speed:
+      await _sleep_until(start + ex.time / self.speed)
+    if ex.status is None:
+      if ex.error_type == 'CancelledError':
+        await _stall(None)
+      raise _recorded_error(ex.error_type or 'RecordedError')(ex.error)
+    return _ReplayResponse(ex, start, self.speed, sock_read)
+
+  async def close(self):
+    pass
+
+_recorded_errors = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+async def _stall(sock_read):
+  '''wait for data that won't come, failing after sock_read if given'''
+  if sock_read is None:
+    await asyncio.get_running_loop().create_future()
+  await asyncio.sleep(sock_read)
+  raise aiohttp.SocketTimeoutError('Timeout on reading data from socket')
+
+async def _sleep_until(when):
+  delay = when - asyncio.get_running_loop().time()
+  if delay > 0:
+    await asyncio.sleep(delay)
+
+async def record(args):
+  from .__main__ import main
+  session = RecordingSession(args.archive)
+  try:
+    await main(args.urls, session=session, concurrency=args.concurrency)
+  finally:
+    await session.close()
+  logger.info('recorded %d responses', session.recorded)
+
+async def replay(args):
+  from .__main__ import main
+  session = ReplaySession(args.archive, speed=args.speed)
+  urls = args.urls or session.urls
+  start = time.perf_counter()
+  for _ in range(args.repeat):
+    await main(urls, session=session, concurrency=args.concurrency)
+  elapsed = time.perf_counter() - start
+  n = len(urls) * args.repeat
+  logger.info('replayed %d URLs in %.3fs (%.1f/s)', n, elapsed, n / elapsed)
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog='python -m fetchtitle.replay',
+    description='record fetches to an archive, or replay them from it',
+  )
+  parser.add_argument('-c', '--concurrency', type=int, default=20,
+                      help='fetches at a time (default: %(default)s)')
+  sub = parser.add_subparsers(dest='command', required=True)
+  p = sub.add_parser('record', help='fetch URLs and record the responses')
+  p.add_argument('archive')
+  p.add_argument('urls', nargs='+', metavar='URL')
+  p = sub.add_parser('replay', help='fetch URLs from an archive')
+  p.add_argument('archive')
+  p.add_argument('urls', nargs='*', metavar='URL',
+                 help='default: those requested first-hand in the archive')
+  p.add_argument('--speed', type=float,
+                 help='replay at the recorded pace times this '
+                 '(default: as fast as possible)')
+  p.add_argument('--repeat', type=int, default=1,
+                 help='replay this many times')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+  asyncio.run(record(args) if args.command == 'record' else replay(args))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,236 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextlib
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# priority lanes; lower goes first
+INTERACTIVE = 0
+NORMAL = 5
+BULK = 10
+
+class _HostState:
+  __slots__ = ('active', 'tokens', 'updated', 'blocked_until', 'waiters',
+               'timer', 'queued')
+
+  def __init__(self, tokens, now):
+    self.active = 0
+    self.tokens = tokens
+    self.updated = now
+    self.blocked_until = None
+    # heap of [priority, seq, future]
+    self.waiters = []
+    self.timer = None
+    # seq of the waiter the host is in the ready queue for
+    self.queued = None
+
+class HostScheduler:
+  '''Decide when each request to a host may start
+
+  A host gets at most `per_host` requests at a time, and, with `rate`,
+  at most `rate` requests per second on average in bursts of up to `burst`
+  (a token bucket). After a 429 or 503 response with Retry-After, nothing
+  more is sent to the host until then (at most `max_retry_after` seconds
+  ahead). With `limit`, at most that many requests run at a time in total.
+
+  Waiting requests start in order of priority (lower first; see
+  INTERACTIVE and BULK), then of arrival. Hosts are queued independently,
+  so a busy or throttled host doesn't hold up requests to other ones.
+
+  Give the same scheduler to every TitleFetcher (`scheduler=...`); it is
+  used for each hop and for the requests of URL finders.
+  '''
+  def __init__(self, per_host=4, *, rate=None, burst=1, limit=None,
+               max_retry_after=3600, clock=time.monotonic):
+    self.per_host = per_host
+    self.rate = rate
+    self.burst = burst
+    self.limit = limit
+    self.max_retry_after = max_retry_after
+    self._clock = clock
+    self._hosts = {}
+    self._active = 0
+    # hosts that may start their first waiter: [priority, seq, host]
+    self._ready = []
+    self._seq = itertools.count()
+    self._grants = 0
+
+    self.started = self.waited = self.throttled = 0
+
+  def __len__(self):
+    return len(self._hosts)
+
+  @contextlib.asynccontextmanager
+  async def slot(self, host, priority=NORMAL):
+    '''wait for a request to host to be allowed, and hold it until done'''
+    await self.acquire(host, priority)
+    try:
+      yield
+    finally:
+      self.release(host)
+
+  async def acquire(self, host, priority=NORMAL):
+    h = self._host(host)
+    if not h.waiters and self._may_start(h):
+      self._start(h)
+      return
+
+    fu = asyncio.get_running_loop().create_future()
+    heapq.heappush(h.waiters, [priority, next(self._seq), fu])
+    self.waited += 1
+    self._enqueue(host, h)
+    try:
+      await fu
+    except asyncio.CancelledError:
+      if fu.done() and not fu.cancelled():
+        # granted just as we were cancelled
+        self.release(host)
+      raise
+
+  def release(self, host):
+    h = self._hosts[host]
+    h.active -= 1
+    self._active -= 1
+    self._enqueue(host, h)
+    self._dispatch()
+
+  def retry_after(self, host, delay):
+    '''don't start requests to host for `delay` seconds'''
+    delay = min(delay, self.max_retry_after)
+    if delay <= 0:
+      return
+    h = self._host(host)
+    until = self._clock() + delay
+    if h.blocked_until is None or until > h.blocked_until:
+      logger.info('holding off %s for %.1fs', host, delay)
+      h.blocked_until = until
+      self.throttled += 1
+
+  def blocked_for(self, host):
+    '''seconds until requests to host may start again, or 0'''
+    h = self._hosts.get(host)
+    if h is None or h.blocked_until is None:
+      return 0
+    return max(0, h.blocked_until - self._clock())
+
+  @property
+  def stats(self):
+    return {
+      'hosts': len(self._hosts),
+      'active': self._active,
+      'waiting': sum(len(h.waiters) for h in self._hosts.values()),
+      'started': self.started,
+      'waited': self.waited,
+      'throttled': self.throttled,
+    }
+
+  def _host(self, host):
+    h = self._hosts.get(host)
+    if h is None:
+      h = self._hosts[host] = _HostState(self.burst, self._clock())
+    return h
+
+  def _delay(self, h):
+    '''seconds until h may start a request, ignoring concurrency'''
+    now = self._clock()
+    delay = 0
+    if h.blocked_until is not None:
+      if now < h.blocked_until:
+        delay = h.blocked_until - now
+      else:
+        h.blocked_until = None
+    if self.rate is not None:
+      h.tokens = min(self.burst, h.tokens + (now - h.updated) * self.rate)
+      h.updated = now
+      if h.tokens < 1:
+        delay = max(delay, (1 - h.tokens) / self.rate)
+    return delay
+
+  def _may_start(self, h):
+    return (h.active < self.per_host
+            and (self.limit is None or self._active < self.limit)
+            and not self._delay(h))
+
+  def _start(self, h):
+    h.active += 1
+    self._active += 1
+    if self.rate is not None:
+      h.tokens -= 1
+    self.started += 1
+    self._grants += 1
+    if self._grants % 1000 == 0:
+      self._sweep()
+
+  def _enqueue(self, host, h):
+    # drop waiters that went away
+    while h.waiters and h.waiters[0][2].done():
+      heapq.heappop(h.waiters)
+    if not h.waiters or h.active >= self.per_host or h.timer is not None:
+      return
+    priority, seq, _ = h.waiters[0]
+    if h.queued == seq:
+      return
+    delay = self._delay(h)
+    if delay:
+      h.timer = asyncio.get_running_loop().call_later(
+        delay, self._wake, host, h)
+    else:
+      h.queued = seq
+      heapq.heappush(self._ready, [priority, seq, host])
+
+  def _wake(self, host, h):
+    h.timer = None
+    self._enqueue(host, h)
+    self._dispatch()
+
+  def _dispatch(self):
+    while self._ready and (self.limit is None or self._active < self.limit):
+      priority, seq, host = heapq.heappop(self._ready)
+      h = self._hosts.get(host)
+      if h is None or h.queued != seq:
+        # superseded by a waiter of higher priority
+        continue
+      h.queued = None
+      while h.waiters and h.waiters[0][2].done():
+        heapq.heappop(h.waiters)
+      if not h.waiters or h.waiters[0][1] != seq \
+         or not self._may_start(h):
+        self._enqueue(host, h)
+        continue
+      _, _, fu = heapq.heappop(h.waiters)
+      self._start(h)
+      fu.set_result(None)
+      self._enqueue(host, h)
+
+  def _sweep(self):
+    # forget idle hosts whose bucket has refilled
+    now = self._clock()
+    for host, h in list(self._hosts.items()):
+      if h.active or h.waiters or h.timer is not None \
+         or h.queued is not None:
+        continue
+      if h.blocked_until is not None and h.blocked_until > now:
+        continue
+      if self.rate is not None and \
+         h.tokens + (now - h.updated) * self.rate < self.burst:
+        continue
+      del self._hosts[host]
+
+def parse_retry_after(value):
+  '''seconds to wait from a Retry-After header value, None if invalid'''
+  if not value:
+    return None
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+  try:
+    when = parsedate_to_datetime(value)
+  except (TypeError, ValueError, IndexError):
+    return None
+  if when is None:
+    return None
+  return max(0, when.timestamp() - time.time())
@@ -0,0 +1,126 @@
+'''Convert Results to and from JSON-compatible data'''
+
+import importlib
+
+from . import (
+  Result, MediaType, SingletonFactory,
+  Timeout, TooManyRedirection, TitleTooFaraway, CircuitOpen,
+)
+
+_sentinels = {
+  s.name: s for s in (
+    Timeout, TooManyRedirection, TitleTooFaraway, CircuitOpen,
+  )
+}
+
+def info_to_json(info):
+  if info is None or isinstance(info, (bool, int, float, dict, list)):
+    # URLFinder API responses
+    return {'kind': 'json', 'value': info}
+  elif isinstance(info, str):
+    return {'kind': 'text', 'value': info}
+  elif isinstance(info, MediaType):
+    return {
+      'kind': 'media',
+      'type': info.type,
+      'size': info.size,
+      'dimension': info.dimension,
+    }
+  elif isinstance(info, SingletonFactory):
+    return {'kind': 'sentinel', 'name': info.name}
+  elif isinstance(info, BaseException):
+    return {
+      'kind': 'error',
+      'type': type(info).__name__,
+      'message': str(info),
+    }
+  elif isinstance(info, tuple):
+    return {'kind': 'tuple', 'value': [info_to_json(x) for x in info]}
+  else:
+    return {'kind': 'repr', 'value': repr(info)}
+
+def info_from_json(d):
+  kind = d['kind']
+  if kind in ('json', 'text', 'repr'):
+    return d['value']
+  elif kind == 'media':
+    dimension = d['dimension']
+    if isinstance(dimension, list):
+      dimension = tuple(dimension)
+    return MediaType(d['type'], d['size'], dimension)
+  elif kind == 'sentinel':
+    try:
+      return _sentinels[d['name']]
+    except KeyError:
+      raise ValueError('unknown sentinel %r' % d['name']) from None
+  elif kind == 'error':
+    return Exception('%s: %s' % (d['type'], d['message']))
+  elif kind == 'tuple':
+    return tuple(info_from_json(x) for x in d['value'])
+  else:
+    raise ValueError('unknown info kind %r' % kind)
+
+def finder_name(finder):
+  if finder is None:
+    return
+  if not isinstance(finder, type):
+    finder = type(finder)
+  return '%s:%s' % (finder.__module__, finder.__qualname__)
+
+def finder_from_name(name):
+  '''the finder class named by finder_name(), or None if it is gone'''
+  if not name:
+    return
+  modname, _, qualname = name.partition(':')
+  try:
+    obj = importlib.import_module(modname)
+    for attr in qualname.split('.'):
+      obj = getattr(obj, attr)
+  except (ImportError, AttributeError):
+    return
+  return obj
+
+def stats_to_json(stats):
+  return {
+    'elapsed': stats.elapsed,
+    'cached': stats.cached,
+    'bytes_read': stats.bytes_read,
+    'parser_cpu': stats.parser_cpu,
+    'hops': [{
+      'url': h.url,
+      'dns': h.dns,
+      'connect': h.connect,
+      'ttfb': h.ttfb,
+      'elapsed': h.elapsed,
+      'reused_connection': h.reused_connection,
+      'bytes_read': h.bytes_read,
+      'chunks': h.chunks,
+      'parser_cpu': h.parser_cpu,
+    } for h in stats.hops],
+  }
+
+def result_to_json(result):
+  d = {
+    'info': info_to_json(result.info),
+    'status_code': result.status_code,
+    'url_visited': list(result.url_visited),
+    'finder': finder_name(result.finder),
+  }
+  meta = result.meta
+  if meta is None and not isinstance(result.finder, type):
+    meta = getattr(result.finder, 'meta', None)
+  if meta:
+    d['meta'] = meta
+  if result.stats is not None:
+    d['stats'] = stats_to_json(result.stats)
+  return d
+
+def result_from_json(d):
+  '''rebuild a Result; its finder will be the finder class, not an instance'''
+  return Result(
+    info_from_json(d['info']),
+    d['status_code'],
+    d['url_visited'],
+    finder_from_name(d.get('finder')),
+    meta = d.get('meta'),
+  )
@@ -0,0 +1,263 @@
+'''A long-running server answering title lookups over a local socket
+
+Start it with `python -m fetchtitle.server --socket PATH` (or `--port N` to
+listen on 127.0.0.1). It keeps one session, its connections, caches and
+finders warm between lookups.
+
+The protocol is line-delimited JSON. Each request line is an object like
+`{"url": "https://example.org/", "id": 1}` (a bare URL is accepted too);
+`id` is optional and defaults to the line's position on the connection.
+Results are written back as they finish, one object per line: `id`, `url`
+and the fields of `serialize.result_to_json()`. A line that can't be parsed
+gets an object with `error`, and the `id` it gives or else its position.
+The server closes the connection once the client has shut down its side
+and every result is sent, so e.g.
+
+  echo https://example.org/ | socat - UNIX-CONNECT:PATH
+
+does a lookup. `lookup()` is a client for Python code.
+'''
+
+import os
+import json
+import stat
+import socket
+import signal
+import asyncio
+import logging
+import argparse
+import threading
+
+import aiohttp
+
+from . import TitleFetcher, fetch_many, stats_trace_config
+from .cache import ResultCache, RedirectCache, SQLiteCache
+from .singleflight import SingleFlight
+from .serialize import result_to_json
+
+logger = logging.getLogger(__name__)
+
+class TitleServer:
+  '''serve lookups with a shared session and shared caches
+
+  `concurrency` bounds the connections of the shared session; each client
+  connection may have at most `per_connection` lookups in flight. Other
+  keyword arguments are passed to every TitleFetcher; by default they share
+  a ResultCache, a RedirectCache and a SingleFlight.
+  '''
+  def __init__(self, *, concurrency=100, per_host=8, per_connection=100,
+               fetcher=TitleFetcher, **kwargs):
+    self.concurrency = concurrency
+    self.per_host = per_host
+    self.per_connection = per_connection
+    self.fetcher = fetcher
+    kwargs.setdefault('cache', ResultCache())
+    kwargs.setdefault('redirect_cache', RedirectCache())
+    kwargs.setdefault('singleflight', SingleFlight())
+    self.kwargs = kwargs
+    self.session = None
+    self._server = None
+    self._path = None
+    self.connections = self.requests = 0
+
+  async def start(self, path=None, *, host='127.0.0.1', port=None):
+    '''listen on the Unix socket `path`, or on TCP (host, port)'''
+    self.session = aiohttp.ClientSession(
+      connector = aiohttp.TCPConnector(
+        limit = self.concurrency, limit_per_host = self.per_host,
+      ),
+      headers = {'User-Agent': self.fetcher.user_agent},
+      trace_configs = [stats_trace_config()]
+                      if self.kwargs.get('collect_stats') else None,
+    )
+    if path is not None:
+      _remove_stale_socket(path)
+      self._server = await asyncio.start_unix_server(self._handle, path)
+      os.chmod(path, 0o600)
+      self._path = path
+    else:
+      self._server = await asyncio.start_server(self._handle, host, port)
+
+  @property
+  def addresses(self):
+    return [s.getsockname() for s in self._server.sockets]
+
+  async def serve_forever(self):
+    await self._server.serve_forever()
+
+  async def close(self):
+    if self._server is not None:
+      self._server.close()
+      await self._server.wait_closed()
+    if self._path is not None:
+      _remove_stale_socket(self._path)
+    if self.session is not None:
+      await self.session.close()
+    cache = self.kwargs.get('cache')
+    if hasattr(cache, 'close'):
+      await cache.close()
+
+  async def _handle(self, reader, writer):
+    self.connections += 1
+    # fetch_many index -> (id, url)
+    requests = {}
+
+    def reply(d):
+      writer.write(json.dumps(d, ensure_ascii=False).encode() + b'\n')
+
+    async def urls():
+      n = 0
+      lineno = 0
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        lineno += 1
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          rid, url = _parse_request(line, lineno - 1)
+        except _BadRequest as e:
+          reply({'id': e.id, 'error': str(e)})
+          continue
+        requests[n] = rid, url
+        n += 1
+        self.requests += 1
+        yield url
+
+    try:
+      async for i, r in fetch_many(
+        urls(), concurrency=self.per_connection, per_host=self.per_host,
+        session=self.session, fetcher=self.fetcher, with_index=True,
+        **self.kwargs,
+      ):
+        rid, url = requests.pop(i)
+        d = {'id': rid, 'url': url}
+        d.update(result_to_json(r))
+        reply(d)
+        await writer.drain()
+      await writer.drain()
+    except ConnectionError:
+      logger.debug('client went away')
+    finally:
+      writer.close()
+
+class _BadRequest(ValueError):
+  def __init__(self, message, id):
+    super().__init__(message)
+    self.id = id
+
+def _parse_request(line, lineno):
+  if not line.startswith(b'{'):
+    return lineno, line.decode('utf-8', 'replace')
+  try:
+    d = json.loads(line)
+  except ValueError:
+    raise _BadRequest(
+      'bad request on line %d' % (lineno + 1), lineno) from None
+  rid = d.get('id', lineno)
+  url = d.get('url')
+  if url is None:
+    raise _BadRequest('no url on line %d' % (lineno + 1), rid)
+  if not isinstance(url, str):
+    raise _BadRequest('bad url on line %d' % (lineno + 1), rid)
+  return rid, url
+
+def _remove_stale_socket(path):
+  try:
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+  except FileNotFoundError:
+    pass
+
+def lookup(urls, *, path=None, address=None, timeout=None):
+  '''look up urls with a running server, yielding result objects
+
+  Connect to the Unix socket `path`, or to `address` (a (host, port)
+  tuple). Results arrive in completion order; each has the `id` of its
+  request, which is the position of its URL in `urls`. Use
+  `serialize.result_from_json` to turn them back into Results.
+  '''
+  if path is not None:
+    sock = socket.socket(socket.AF_UNIX)
+    sock.settimeout(timeout)
+    sock.connect(path)
+  else:
+    sock = socket.create_connection(address, timeout)
+
+  def send():
+    try:
+      for i, url in enumerate(urls):
+        sock.sendall(json.dumps({'id': i, 'url': url}).encode() + b'\n')
+      sock.shutdown(socket.SHUT_WR)
+    except OSError:
+      pass
+
+  # send from another thread so that a long list can't fill both ways
+  sender = threading.Thread(target=send, daemon=True)
+  sender.start()
+  try:
+    with sock.makefile('rb') as f:
+      for line in f:
+        yield json.loads(line)
+  finally:
+    sock.close()
+    sender.join()
+
+async def serve(args):
+  from .fixups import fixup
+  from .extrafinders import default_url_finders
+  fixup()
+
+  kwargs = {'url_finders': default_url_finders}
+  if args.cache:
+    kwargs['cache'] = SQLiteCache(args.cache)
+  if args.timeout is not None:
+    kwargs['timeout'] = args.timeout
+  if args.stats:
+    kwargs['collect_stats'] = True
+  server = TitleServer(
+    concurrency=args.concurrency, per_host=args.per_host, **kwargs)
+  await server.start(args.socket, port=args.port)
+  logger.info('listening on %s', ', '.join(map(str, server.addresses)))
+
+  loop = asyncio.get_running_loop()
+  task = asyncio.current_task()
+  for sig in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(sig, task.cancel)
+  try:
+    await server.serve_forever()
+  except asyncio.CancelledError:
+    pass
+  finally:
+    await server.close()
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog='python -m fetchtitle.server',
+    description='answer title lookups over a local socket',
+  )
+  where = parser.add_mutually_exclusive_group(required=True)
+  where.add_argument('-s', '--socket', metavar='PATH',
+                     help='listen on this Unix socket')
+  where.add_argument('-p', '--port', type=int,
+                     help='listen on this port of 127.0.0.1')
+  parser.add_argument('-c', '--concurrency', type=int, default=100,
+                      help='connections to fetch with (default: '
+                      '%(default)s)')
+  parser.add_argument('--per-host', type=int, default=8,
+                      help='connections per host (default: %(default)s)')
+  parser.add_argument('-t', '--timeout', type=float,
+                      help='timeout per URL in seconds')
+  parser.add_argument('--cache', metavar='FILE',
+                      help='keep results in this SQLite database instead '
+                      'of in memory')
+  parser.add_argument('--stats', action='store_true',
+                      help='include timings in results')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(serve(args))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,42 @@
+import asyncio
+
+class SingleFlight:
+  '''Coalesce concurrent calls that share the same key
+
+  The first caller of `do()` for a key starts the work in its own task; other
+  callers arriving before it finishes wait for the same task and get the same
+  result or exception. The task is cancelled only when every caller waiting
+  for it has gone away.
+
+  TitleFetchers sharing a SingleFlight should share their session too, as a
+  hop is fetched with the session of whichever fetcher started it.
+  '''
+  def __init__(self):
+    self._calls = {}
+    self.calls = self.shared = 0
+
+  def __len__(self):
+    return len(self._calls)
+
+  async def do(self, key, func):
+    call = self._calls.get(key)
+    if call is None:
+      fu = asyncio.ensure_future(func())
+      call = self._calls[key] = [fu, 0]
+      fu.add_done_callback(lambda fu: self._forget(key, call))
+      self.calls += 1
+    else:
+      self.shared += 1
+
+    call[1] += 1
+    try:
+      return await asyncio.shield(call[0])
+    finally:
+      call[1] -= 1
+      if not call[1] and not call[0].done():
+        call[0].cancel()
+        self._forget(key, call)
+
+  def _forget(self, key, call):
+    if self._calls.get(key) is call:
+      del self._calls[key]
@@ -0,0 +1,546 @@
+'''Find titles and image dimensions in WARC files, without fetching
+
+Response (and resource) records are run through the content finders
+(`content_finders` by default, which has FastTitleFinder for HTML), with the
+media type from the stored headers, sniffing like TitleFetcher does.
+Bodies are de-chunked and decompressed as they are read, and only as far as
+the finders need. Plain files are memory-mapped; gzipped ones (a gzip member
+per record, as usual, or one for the whole file) are decompressed as a
+stream.
+
+`extract_many()` spreads files over worker processes, splitting large ones
+into ranges; each worker starts at the first record (or gzip member) in its
+range. The command line is `python -m fetchtitle.warc FILE... > out.jsonl`;
+each output line has `file`, `offset` (of the record, or of its gzip
+member), `url`, `date` and the fields of `serialize.result_to_json()`, plus
+`location` for redirections.
+'''
+
+import os
+import sys
+import mmap
+import zlib
+import json
+import logging
+import argparse
+import multiprocessing
+from collections import namedtuple, deque
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+from . import (
+  Result, TitleFetcher, FastTitleFinder, PNGFinder, JPEGFinder, GIFFinder,
+  defaultMediaType, _FinderFeed,
+)
+from .serialize import result_to_json
+
+logger = logging.getLogger(__name__)
+
+WarcRecord = namedtuple('WarcRecord', 'offset headers block')
+
+content_finders = (FastTitleFinder, PNGFinder, JPEGFinder, GIFFinder)
+
+_GZIP_MAGIC = b'\x1f\x8b\x08'
+_READ_SIZE = 1024 * 1024
+# pieces fed to finders; titles are usually near the start
+_CHUNK_SIZE = 16 * 1024
+# for WARC and HTTP headers
+_HEAD_LIMIT = 64 * 1024
+
+class _MmapStream:
+  def __init__(self, f):
+    size = os.fstat(f.fileno()).st_size
+    self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+               if size else b''
+    self._pos = 0
+
+  def sync(self, start, end=None):
+    if start:
+      # a record starting before end ends the pattern before end + 7
+      i = self._mm.find(b'\r\n\r\nWARC/1.', max(0, start - 4),
+                        len(self._mm) if end is None else end + 7)
+      self._pos = len(self._mm) if i < 0 else i + 4
+
+  @property
+  def offset(self):
+    return self._pos
+
+  def read(self, n):
+    data = self._mm[self._pos:self._pos + n]
+    self._pos += len(data)
+    return data
+
+  def skip(self, n):
+    self._pos = min(self._pos + n, len(self._mm))
+
+  def readuntil(self, sep, limit):
+    i = self._mm.find(sep, self._pos, self._pos + limit)
+    if i < 0:
+      return None
+    return self.read(i + len(sep) - self._pos)
+
+  def close(self):
+    if self._mm:
+      self._mm.close()
+
+class _GzipStream:
+  def __init__(self, f):
+    self._f = f
+    self._buf = bytearray()
+    # uncompressed position of _buf[0]
+    self._upos = 0
+    # (uncompressed position, file offset) where members start
+    self._members = deque()
+    self._d = None
+    self._fed = 0
+    self._pending = b''
+
+  def sync(self, start, end=None):
+    if start:
+      start = self._find_member(start, end)
+      if start is None:
+        start = os.fstat(self._f.fileno()).st_size
+    self._f.seek(start)
+    self._members.append((0, start))
+    self._d = zlib.decompressobj(31)
+
+  def _find_member(self, start, end=None):
+    # Only members starting before end matter; looking further would make
+    # every range of a file with few members read the rest of it.
+    f = self._f
+    f.seek(start)
+    pos = start
+    carry = b''
+    while True:
+      chunk = f.read(_READ_SIZE)
+      if not chunk:
+        return None
+      data = carry + chunk
+      base = pos - len(carry)
+      pos += len(chunk)
+      i = data.find(_GZIP_MAGIC)
+      while i >= 0:
+        if end is not None and base + i >= end:
+          return None
+        if base + i >= start and self._is_member(base + i):
+          return base + i
+        i = data.find(_GZIP_MAGIC, i + 1)
+      if end is not None and pos - 2 >= end:
+        return None
+      carry = data[-2:]
+      f.seek(pos)
+
+  def _is_member(self, offset):
+    self._f.seek(offset)
+    try:
+      out = zlib.decompressobj(31).decompress(self._f.read(4096), 16)
+    except zlib.error:
+      return False
+    return out.startswith(b'WARC/')
+
+  @property
+  def offset(self):
+    # the next byte may come from a member not started yet
+    while not self._buf and self._fill():
+      pass
+    members = self._members
+    while len(members) > 1 and members[1][0] <= self._upos:
+      members.popleft()
+    return members[0][1]
+
+  def _fill(self):
+    d = self._d
+    if d.eof:
+      rest = d.unused_data
+      start = self._members[-1][1] + self._fed - len(rest)
+      self._members.append((self._upos + len(self._buf), start))
+      d = self._d = zlib.decompressobj(31)
+      self._fed = 0
+      self._pending = rest
+    data = self._pending or self._f.read(_READ_SIZE)
+    if not data:
+      # the end, or a truncated member
+      return False
+    self._fed += len(data)
+    self._buf += d.decompress(data, _READ_SIZE)
+    self._pending = d.unconsumed_tail
+    self._fed -= len(self._pending)
+    return True
+
+  def read(self, n):
+    buf = self._buf
+    while len(buf) < n and self._fill():
+      pass
+    data = bytes(buf[:n])
+    del buf[:n]
+    self._upos += len(data)
+    return data
+
+  def skip(self, n):
+    buf = self._buf
+    while n > 0:
+      if not buf and not self._fill():
+        break
+      k = min(n, len(buf))
+      del buf[:k]
+      self._upos += k
+      n -= k
+
+  def readuntil(self, sep, limit):
+    start = 0
+    while True:
+      i = self._buf.find(sep, start)
+      if i >= 0:
+        return self.read(i + len(sep))
+      if len(self._buf) > limit:
+        return None
+      start = max(0, len(self._buf) - len(sep) + 1)
+      if not self._fill():
+        return None
+
+  def close(self):
+    pass
+
+class _Block:
+  '''the block of a record, read at most to its end'''
+  def __init__(self, stream, length):
+    self._stream = stream
+    self.remaining = length
+
+  def read(self, n=_CHUNK_SIZE):
+    data = self._stream.read(min(n, self.remaining))
+    self.remaining -= len(data)
+    if not data:
+      self.remaining = 0
+    return data
+
+def _parse_headers(lines):
+  headers = {}
+  for line in lines:
+    name, sep, value = line.partition(b':')
+    if sep:
+      headers[name.strip().lower().decode('latin1')] = \
+        value.strip().decode('latin1')
+  return headers
+
+def iter_records(path, start=0, end=None):
+  '''yield the WarcRecords of a (gzipped) WARC file
+
+  Only records starting in [start, end) are yielded (for a gzipped file,
+  whose gzip member starts there). Each record's block must be read before
+  the next one is asked for; what's left of it is skipped.
+  '''
+  with open(path, 'rb') as f:
+    gzipped = f.read(3) == _GZIP_MAGIC
+    stream = _GzipStream(f) if gzipped else _MmapStream(f)
+    try:
+      stream.sync(start, end)
+      while True:
+        # the blank lines ending the previous record
+        while True:
+          offset = stream.offset
+          data = stream.read(2)
+          if data != b'\r\n':
+            break
+        if not data:
+          return
+        if end is not None and offset >= end:
+          return
+        head = stream.readuntil(b'\r\n\r\n', _HEAD_LIMIT)
+        if head is None:
+          return
+        head = data + head
+        lines = head.split(b'\r\n')
+        if not lines[0].startswith(b'WARC/'):
+          raise ValueError('not a WARC record at %s:%d' % (path, offset))
+        headers = _parse_headers(lines[1:])
+        block = _Block(stream, int(headers.get('content-length', 0)))
+        yield WarcRecord(offset, headers, block)
+        stream.skip(block.remaining)
+    finally:
+      stream.close()
+
+def _dechunk(read, first):
+  '''the data of a chunked body; raw if it doesn't look chunked'''
+  buf = first
+  chunked = False
+  while True:
+    while b'\r\n' not in buf and len(buf) < 1024:
+      more = read()
+      if not more:
+        break
+      buf += more
+    line, sep, rest = buf.partition(b'\r\n')
+    try:
+      size = int(line.split(b';', 1)[0], 16)
+    except ValueError:
+      size = None
+    if not sep or size is None:
+      if chunked:
+        return
+      # not chunked after all
+      while buf:
+        yield buf
+        buf = read()
+      return
+    chunked = True
+    buf = rest
+    if size == 0:
+      return
+    while size > 0:
+      if not buf:
+        buf = read()
+        if not buf:
+          return
+      piece = buf[:size]
+      buf = buf[size:]
+      size -= len(piece)
+      yield piece
+    while len(buf) < 2:
+      more = read()
+      if not more:
+        return
+      buf += more
+    buf = buf[2:]
+
+def _raw(read, first):
+  if first:
+    yield first
+  while True:
+    data = read()
+    if not data:
+      return
+    yield data
+
+def _decode(pieces, encoding):
+  if encoding in ('', 'identity'):
+    yield from pieces
+    return
+  if encoding == 'br' and brotli is not None:
+    d = brotli.Decompressor()
+    for data in pieces:
+      out = d.process(data)
+      if out:
+        yield out
+    return
+  if encoding in ('gzip', 'x-gzip'):
+    # a gzip or zlib header
+    d = zlib.decompressobj(47)
+  elif encoding == 'deflate':
+    d = None
+  else:
+    raise ValueError('unsupported content encoding: %s' % encoding)
+  for data in pieces:
+    if d is None:
+      # "deflate" is zlib, or raw deflate from some servers
+      d = zlib.decompressobj(15 if data[:1] == b'\x78' else -15)
+    while data:
+      out = d.decompress(data, _CHUNK_SIZE)
+      if out:
+        yield out
+      data = d.unconsumed_tail
+    if d.eof:
+      return
+
+def _body(read, first, headers):
+  if 'chunked' in headers.get('transfer-encoding', '').lower():
+    pieces = _dechunk(read, first)
+  else:
+    pieces = _raw(read, first)
+  return _decode(pieces, headers.get('content-encoding', '').strip().lower())
+
+def _match(content_finders, mt, meta_fields):
+  for finder in content_finders:
+    f = finder.match_type(mt)
+    if f:
+      if meta_fields and hasattr(f, 'want_meta'):
+        f.want_meta(meta_fields)
+      return f
+
+def _http_head(block):
+  data = block.read(_CHUNK_SIZE)
+  while True:
+    i = data.find(b'\r\n\r\n')
+    if i >= 0:
+      break
+    more = block.read(_CHUNK_SIZE)
+    if not more or len(data) > _HEAD_LIMIT:
+      raise ValueError('HTTP headers not found')
+    data += more
+  lines = data[:i].split(b'\r\n')
+  parts = lines[0].split(None, 2)
+  if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+    raise ValueError('bad HTTP status line: %r' % lines[0][:100])
+  return int(parts[1]), _parse_headers(lines[1:]), data[i+4:]
+
+def target_uri(record):
+  # some writers wrap it in <>
+  return record.headers.get('warc-target-uri', '').strip('<>')
+
+def extract(record, content_finders=content_finders, meta_fields=None, *,
+            sniff=True):
+  '''a Result for a response or resource record, None for other records'''
+  return _extract(record, content_finders, meta_fields, sniff)[0]
+
+def _extract(record, content_finders, meta_fields, sniff):
+  # the Result, and the headers of the response
+  headers = {}
+  wtype = record.headers.get('warc-type')
+  url = target_uri(record)
+  status = 0
+  try:
+    if wtype == 'response':
+      status, headers, first = _http_head(record.block)
+    elif wtype == 'resource':
+      status = 200
+      headers = {'content-type': record.headers.get('content-type', '')}
+      first = b''
+    else:
+      return None, headers
+
+    ctype = headers.get('content-type', 'text/html')
+    l = headers.get('content-length')
+    l = int(l) if l and l.isdigit() else None
+    mt = defaultMediaType._replace(type=ctype, size=l)
+    feed = _FinderFeed(
+      mt, lambda mt: _match(content_finders, mt, meta_fields),
+      declared='content-type' in headers, sniff=sniff)
+    if not feed.finder and not feed.sniffing:
+      return Result(mt, status, [url], None), headers
+    chunks = _body(record.block.read, first, headers)
+
+    data = None
+    if feed.sniffing:
+      data = b''
+      for piece in chunks:
+        data += piece
+        if len(data) >= TitleFetcher.sniff_bytes:
+          break
+      feed.sniff(data)
+    f = feed.finder
+    if not f:
+      return Result(feed.mt, status, [url], None), headers
+
+    while True:
+      if data is None:
+        data = next(chunks, b'')
+      t = feed.feed(data)
+      if t is not None:
+        return Result(t, status, [url], f), headers
+      if feed.done:
+        break
+      data = None
+    return Result(None, status, [url], f), headers
+
+  except (ValueError, zlib.error) as e:
+    logger.debug('bad record for %s: %r', url, e)
+    return Result(e, status, [url], None), headers
+
+def extract_file(path, start=0, end=None, *,
+                 content_finders=content_finders, meta_fields=None,
+                 sniff=True):
+  '''yield an output dict for each usable record of a WARC file
+
+  See iter_records for `start` and `end`, and extract for other arguments.
+  '''
+  for record in iter_records(path, start, end):
+    r, headers = _extract(record, content_finders, meta_fields, sniff)
+    if r is None:
+      continue
+    d = {
+      'file': path,
+      'offset': record.offset,
+      'url': r.url_visited[0],
+      'date': record.headers.get('warc-date'),
+    }
+    d.update(result_to_json(r))
+    if r.status_code in (301, 302, 303, 307, 308):
+      d['location'] = headers.get('location')
+    yield d
+
+def _work(task):
+  path, start, end, kwargs = task
+  lines = []
+  try:
+    for d in extract_file(path, start, end, **kwargs):
+      lines.append(json.dumps(d, ensure_ascii=False))
+  except (OSError, ValueError) as e:
+    logger.error('error reading %s at %d: %r', path, start, e)
+  return lines
+
+def plan(paths, split_size):
+  '''(path, start, end) ranges to hand out to workers'''
+  if split_size <= 0:
+    raise ValueError('split_size must be positive: %r' % split_size)
+  for path in paths:
+    size = os.path.getsize(path)
+    for start in range(0, max(size, 1), split_size):
+      yield path, start, min(start + split_size, size)
+
+def extract_many(paths, *, processes=None, split_size=64 * 1024 * 1024,
+                 ordered=False, **kwargs):
+  '''yield JSON lines for the records of many WARC files
+
+  Files are split into ranges of `split_size` bytes, processed by
+  `processes` worker processes (all cores by default; none if 1). Lines of
+  a range come together, and ranges in order if `ordered`. Other keyword
+  arguments are passed to extract.
+  '''
+  tasks = ((path, start, end, kwargs)
+           for path, start, end in plan(paths, split_size))
+  if processes == 1:
+    for task in tasks:
+      yield from _work(task)
+    return
+
+  ctx = multiprocessing.get_context('spawn')
+  with ctx.Pool(processes) as pool:
+    it = pool.imap(_work, tasks) if ordered \
+         else pool.imap_unordered(_work, tasks)
+    for lines in it:
+      yield from lines
+
+def _positive_int(s):
+  n = int(s)
+  if n <= 0:
+    raise argparse.ArgumentTypeError('must be positive: %s' % s)
+  return n
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog='python -m fetchtitle.warc',
+    description='find titles and image dimensions in WARC files',
+  )
+  parser.add_argument('files', nargs='+', metavar='FILE',
+                      help='WARC files, gzipped or not')
+  parser.add_argument('-o', '--output', metavar='FILE',
+                      help='write JSONL here instead of to stdout')
+  parser.add_argument('-p', '--processes', type=int,
+                      help='worker processes (default: one per core)')
+  parser.add_argument('--split', type=_positive_int, default=64, metavar='MIB',
+                      help='split files into ranges of this many MiB for '
+                      'workers (default: %(default)s)')
+  parser.add_argument('--ordered', action='store_true',
+                      help='output records in file order')
+  parser.add_argument('--meta', action='append', metavar='FIELD',
+                      help='also collect this <meta> field (repeatable)')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  out = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    for line in extract_many(
+      args.files, processes=args.processes,
+      split_size=args.split * 1024 * 1024, ordered=args.ordered,
+      meta_fields=args.meta,
+    ):
+      out.write(line + '\n')
+  finally:
+    if out is not sys.stdout:
+      out.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,13 @@
+import urllib.request
+
+from fetchtitle.bench import start_server
+
+def test_server_is_up_when_started():
+  server, port = start_server()
+  try:
+    with urllib.request.urlopen(
+      'http://127.0.0.1:%d/plain/1' % port, timeout=5) as r:
+      assert r.status == 200
+  finally:
+    server.terminate()
+    server.join()
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import pickle
+import asyncio
+import subprocess
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from fetchtitle import TitleFetcher, Result, Timeout
+from fetchtitle.cache import ResultCache, SQLiteCache
+from fetchtitle.serialize import result_to_json
+
+from util import serve
+
+PAGE = (b'<html><head><meta property="og:title" content="OG">'
+        b'<title>plain</title></head><body></body></html>')
+
+def page_app(hits):
+  async def page(request):
+    hits.append(request.path)
+    return web.Response(body=PAGE, content_type='text/html')
+  app = web.Application()
+  app.router.add_get('/page', page)
+  return app
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_cache(request, tmp_path):
+  if request.param == 'memory':
+    cache = ResultCache()
+    return lambda: cache
+  return lambda: SQLiteCache(str(tmp_path / 'cache.db'))
+
+def test_meta_survives_the_cache(make_cache):
+  hits = []
+  async def main():
+    async with serve(page_app(hits)) as base, \
+               aiohttp.ClientSession() as session:
+      results = []
+      for meta_fields in (['og:title'], ['og:title'], None, ['OG:Title']):
+        cache = make_cache()
+        results.append(await TitleFetcher(
+          base + '/page', session=session, cache=cache,
+          meta_fields=meta_fields).run())
+        if isinstance(cache, SQLiteCache):
+          await cache.close()
+      return results
+  first, cached, plain, cached_again = asyncio.run(main())
+
+  # without meta fields it is another entry; fields ignore case
+  assert hits == ['/page', '/page']
+  for r in (first, cached, cached_again):
+    assert r.meta == {'og:title': 'OG'}
+    assert result_to_json(r)['meta'] == {'og:title': 'OG'}
+  assert plain.meta is None
+  assert 'meta' not in result_to_json(plain)
+
+def result(info):
+  return Result(info, 200, ['http://example.com/'], None)
+
+def test_sqlite_purge(tmp_path, monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, 'time', lambda: now[0])
+  cache = SQLiteCache(str(tmp_path / 'cache.db'), ttl=10, stale_ttl=100,
+                      max_entries=4)
+
+  async def main():
+    for i in range(5):
+      now[0] = 1000 + i
+      await cache.set('http://example.com/%d' % i, result('%d' % i),
+                      {'etag': '"1"'} if i == 1 else None)
+    # kept for timeout_ttl, longer than ttl here
+    await cache.set('http://example.com/t', result(Timeout))
+
+    # 0 and 2 have expired, 1 is stale but may be revalidated
+    now[0] = 1012.5
+    await cache.purge()
+    assert cache.purged == 2
+    r, validators, fresh = await cache.lookup('http://example.com/1')
+    assert (r.info, validators, fresh) == ('1', {'etag': '"1"'}, False)
+    for i in (0, 2):
+      assert await cache.lookup('http://example.com/%d' % i) is None
+
+    # the ones expiring first go when there are too many
+    now[0] = 1005
+    for i in (5, 6):
+      await cache.set('http://example.com/%d' % i, result('%d' % i))
+    await cache.purge()
+    assert cache.purged == 4
+    assert [i for i in range(7) if await cache.get(
+      'http://example.com/%d' % i) is not None] == [4, 5, 6]
+
+    # purged every purge_every writes
+    cache.purge_every = 2
+    now[0] = 1100
+    await cache.set('http://example.com/7', result('7'))
+    await cache.set('http://example.com/8', result('8'))
+    assert cache.purged == 8
+    await cache.close()
+  asyncio.run(main())
+
+WRITER = """
+import sys, pickle, asyncio
+from fetchtitle import Result
+async def main(cache, name):
+  for i in range(200):
+    url = 'http://example.com/%s/%d' % (name, i)
+    await cache.set(url, Result(name, 200, [url], None))
+  await cache.close()
+asyncio.run(main(pickle.loads(bytes.fromhex(sys.argv[1])), sys.argv[2]))
+"""
+
+def test_sqlite_shared_by_processes(tmp_path):
+  cache = SQLiteCache(str(tmp_path / 'cache.db'), ttl=600)
+
+  async def main():
+    # opened before the others write
+    assert await cache.get('http://example.com/a/0') is None
+    arg = pickle.dumps(cache).hex()
+    writers = [subprocess.Popen(
+      [sys.executable, '-c', WRITER, arg, name],
+      cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ) for name in 'ab']
+    for p in writers:
+      assert await asyncio.get_running_loop().run_in_executor(
+        None, p.wait) == 0
+    for name in 'ab':
+      for i in range(200):
+        r = await cache.get('http://example.com/%s/%d' % (name, i))
+        assert r.info == name
+    await cache.close()
+  asyncio.run(main())
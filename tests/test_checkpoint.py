@@ -0,0 +1,100 @@
+import io
+import os
+import json
+import time
+import threading
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from fetchtitle.__main__ import bulk, Checkpoint
+
+from util import serve, app_with, html
+
+class Interrupted(Exception):
+  pass
+
+class Output(io.StringIO):
+  '''fails after `limit` lines, like a run killed halfway'''
+  def __init__(self, limit=None):
+    super().__init__()
+    self.limit = limit
+
+  def write(self, s):
+    if self.limit is not None and self.getvalue().count('\n') >= self.limit:
+      raise Interrupted
+    return super().write(s)
+
+  def indices(self):
+    return [json.loads(l)['index'] for l in self.getvalue().splitlines()]
+
+def test_checkpoint_marks_in_order():
+  ckpt = Checkpoint(None)
+  for pos in (1, 3, 0):
+    ckpt.mark(pos)
+  assert (ckpt.done, ckpt.ahead) == (2, {3})
+  assert [ckpt.is_done(p) for p in range(5)] == [
+    True, True, False, True, False]
+
+def test_resume_skips_what_was_done(tmp_path):
+  async def page(request):
+    return html('page ' + request.match_info['n'])
+
+  checkpoint = str(tmp_path / 'ckpt.json')
+  async def main():
+    app = web.Application()
+    app.router.add_get('/{n}', page)
+    async with serve(app) as base:
+      lines = ''.join('%s/%d\n' % (base, i) for i in range(20))
+      first = Output(limit=7)
+      with pytest.raises(Interrupted):
+        await bulk(io.StringIO(lines), first, checkpoint=checkpoint,
+                   checkpoint_interval=0, concurrency=4)
+      second = Output()
+      await bulk(io.StringIO(lines), second, checkpoint=checkpoint,
+                 checkpoint_interval=0, concurrency=4)
+      return first, second
+  first, second = asyncio.run(main())
+
+  assert len(first.indices()) == 7
+  assert sorted(first.indices() + second.indices()) == list(range(20))
+  assert Checkpoint(checkpoint).done == 20
+
+class Flushed(io.StringIO):
+  '''what has been flushed so far'''
+  flushed = ''
+
+  def flush(self):
+    self.flushed = self.getvalue()
+
+def test_pipe_input_is_fetched_and_written_as_it_comes():
+  out = Flushed()
+  late = []
+
+  async def page(request):
+    return html('page')
+
+  async def main():
+    async with serve(app_with(page=page)) as base:
+      rfd, wfd = os.pipe()
+      with open(rfd) as r, open(wfd, 'w') as w:
+        def feed():
+          w.write(base + '/page\n')
+          w.flush()
+          for _ in range(300):
+            if out.flushed:
+              break
+            time.sleep(0.1)
+          else:
+            late.append(True)
+          w.write(base + '/page\n')
+          w.close()
+        t = threading.Thread(target=feed)
+        t.start()
+        await bulk(r, out)
+        t.join()
+
+  asyncio.run(main())
+  assert not late
+  assert [json.loads(l)['index'] for l in out.flushed.splitlines()] == [0, 1]
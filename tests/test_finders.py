@@ -0,0 +1,23 @@
+import pytest
+
+from fetchtitle import JPEGFinder, defaultMediaType
+from fetchtitle.bench import _jpeg
+
+JPEG = _jpeg(640, 480, 5)
+
+@pytest.mark.parametrize('size', [1, 2, 5, 9, 1000, 65536, len(JPEG)])
+def test_jpeg_buffers_only_what_it_has_not_walked(size):
+  f = JPEGFinder(defaultMediaType._replace(type='image/jpeg'))
+  most = 0
+  for i in range(0, len(JPEG), size):
+    r = f(JPEG[i:i + size])
+    most = max(most, len(f.buf))
+    if r is not None:
+      break
+  assert r.dimension == (640, 480)
+  assert most < 9
+
+def test_bad_jpeg():
+  f = JPEGFinder(defaultMediaType._replace(type='image/jpeg'))
+  assert f(b'\xff') is None
+  assert f(b'\xd8\xff\xe0\x00\x01').dimension == 'Bad JPEG'
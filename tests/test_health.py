@@ -0,0 +1,123 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from fetchtitle import TitleFetcher, Timeout, CircuitOpen
+from fetchtitle.health import HostHealth
+from fetchtitle.scheduler import HostScheduler
+from fetchtitle.singleflight import SingleFlight
+
+from util import serve, app_with, html
+
+class Clock:
+  now = 0.0
+  def __call__(self):
+    return self.now
+
+def test_circuit_transitions():
+  clock = Clock()
+  h = HostHealth(3, cooldown=10, max_cooldown=25, clock=clock)
+  for _ in range(2):
+    h.failure('a')
+  assert h.allow('a') and not h.is_open('a')
+  # a success resets the count
+  h.success('a')
+  for _ in range(2):
+    h.failure('a')
+  assert h.allow('a')
+
+  h.failure('a')
+  assert h.is_open('a') and not h.allow('a')
+  assert h.allow('b')
+
+  # half-open: one probe at a time
+  clock.now = 10
+  assert h.allow('a')
+  assert not h.allow('a')
+  # the probe fails: open twice as long
+  h.failure('a')
+  clock.now = 29
+  assert not h.allow('a')
+  clock.now = 30
+  assert h.allow('a')
+  h.failure('a')
+  # up to max_cooldown
+  clock.now = 54
+  assert not h.allow('a')
+  clock.now = 55
+  assert h.allow('a')
+  # the probe succeeds: closed
+  h.success('a')
+  assert not h.is_open('a') and h.allow('a') and h.allow('a')
+  assert h.stats['opened'] == 1 and h.stats['probes'] == 3
+
+async def slow(request):
+  await asyncio.sleep(5)
+  return html('late')
+
+def run_slow(timeout, wait_for=None):
+  health = HostHealth(1)
+  async def main():
+    async with serve(app_with(slow=slow)) as base:
+      f = TitleFetcher(base + '/slow', timeout=timeout, host_health=health)
+      try:
+        r = await asyncio.wait_for(f.run(), wait_for)
+      except asyncio.TimeoutError:
+        r = None
+      return r, health.is_open('127.0.0.1')
+  return asyncio.run(main())
+
+def test_our_timeout_counts_against_the_host():
+  r, is_open = run_slow(0.2)
+  assert r.info is Timeout
+  assert is_open
+
+def test_cancellation_from_outside_does_not_count():
+  r, is_open = run_slow(5, wait_for=0.2)
+  assert r is None
+  assert not is_open
+
+def test_open_circuit_answers_at_once():
+  health = HostHealth(1)
+  health.failure('127.0.0.1')
+  async def main():
+    async with serve(app_with(slow=slow)) as base:
+      return await TitleFetcher(base + '/slow', host_health=health).run()
+  assert asyncio.run(main()).info is CircuitOpen
+
+def test_waiting_in_the_scheduler_does_not_count():
+  health = HostHealth(1)
+  scheduler = HostScheduler(1)
+  async def main():
+    async with serve(app_with(slow=slow)) as base:
+      busy = asyncio.ensure_future(TitleFetcher(
+        base + '/slow', host_health=health, scheduler=scheduler).run())
+      await asyncio.sleep(0.1)
+      r = await TitleFetcher(
+        base + '/slow', timeout=0.2, host_health=health,
+        scheduler=scheduler).run()
+      busy.cancel()
+      return r
+  assert asyncio.run(main()).info is Timeout
+  assert not health.is_open('127.0.0.1')
+
+async def stalled(request):
+  res = web.StreamResponse(headers={'Content-Type': 'text/html'})
+  await res.prepare(request)
+  await res.write(b'<html><head>')
+  await asyncio.sleep(5)
+  return res
+
+def test_timeout_of_a_shared_hop_counts_against_the_host():
+  health = HostHealth(1)
+  async def main():
+    async with serve(app_with(stalled=stalled)) as base, \
+               aiohttp.ClientSession() as session:
+      r = await TitleFetcher(
+        base + '/stalled', timeout=0.2, host_health=health, session=session,
+        singleflight=SingleFlight()).run()
+      return r, health.is_open('127.0.0.1')
+  r, is_open = asyncio.run(main())
+  assert r.info is Timeout
+  assert is_open
@@ -0,0 +1,63 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from fetchtitle import TitleFetcher, Timeout
+from fetchtitle.hedging import Hedging
+
+from util import serve, app_with, html, pending_tasks
+
+async def slow(request):
+  await asyncio.sleep(5)
+  return html('late')
+
+def test_cancelled_before_hedging_closes_primary():
+  async def main():
+    async with serve(app_with(slow=slow)) as base, \
+               aiohttp.ClientSession() as session:
+      h = Hedging(initial_delay=10)
+      with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(h.get(session.get, base + '/slow'), 0.2)
+      await asyncio.sleep(0.05)
+      assert not pending_tasks('_call')
+      assert not session.connector._acquired
+  asyncio.run(main())
+
+def test_first_byte_timeout_releases_connections():
+  async def main():
+    async with serve(app_with(slow=slow)) as base, \
+               aiohttp.ClientSession() as session:
+      h = Hedging(initial_delay=10)
+      for _ in range(3):
+        f = TitleFetcher(base + '/slow', session=session, hedging=h,
+                         first_byte_timeout=0.1, timeout=1)
+        r = await f.run()
+        assert r.info is Timeout or isinstance(r.info, asyncio.TimeoutError)
+      await asyncio.sleep(0.05)
+      assert not pending_tasks('_call')
+      assert not session.connector._acquired
+  asyncio.run(main())
+
+def test_hedge_wins_and_primary_is_cancelled():
+  seen = []
+
+  async def first_slow(request):
+    seen.append(1)
+    if len(seen) == 1:
+      await asyncio.sleep(5)
+    return html('t%d' % len(seen))
+
+  async def main():
+    async with serve(app_with(page=first_slow)) as base, \
+               aiohttp.ClientSession() as session:
+      h = Hedging(initial_delay=0.05, other_address=False)
+      r = await h.get(session.get, base + '/page')
+      async with r:
+        assert b'<title>t2</title>' in await r.read()
+      assert (h.hedged, h.hedge_won, h.primary_won) == (1, 1, 0)
+      await asyncio.sleep(0.05)
+      assert not pending_tasks('_call')
+      assert not session.connector._acquired
+  asyncio.run(main())
@@ -0,0 +1,49 @@
+import asyncio
+
+from aiohttp import web
+
+from fetchtitle.multiproc import fetch_sharded, shard_of
+
+from util import serve, app_with, html
+
+async def slow(request):
+  await asyncio.sleep(1)
+  return html('slow')
+
+async def fast(request):
+  return html('fast')
+
+def test_busy_worker_does_not_hold_up_others():
+  async def main():
+    async with serve(app_with(slow=slow, fast=fast)) as base:
+      port = base.rsplit(':', 1)[1]
+      slow_url = 'http://127.0.0.1:%s/slow' % port
+      fast_url = 'http://localhost:%s/fast' % port
+      assert shard_of(slow_url, 2) != shard_of(fast_url, 2)
+      urls = [slow_url] * 2 + [fast_url] * 3
+      return [r.info async for r in fetch_sharded(
+        urls, processes=2, concurrency=1)]
+  titles = asyncio.run(main())
+  assert titles == ['fast'] * 3 + ['slow'] * 2
+
+def test_slow_source_does_not_hold_up_results():
+  first = None
+  late = []
+  async def main():
+    nonlocal first
+    first = asyncio.Event()
+    async with serve(app_with(fast=fast)) as base:
+      async def urls():
+        yield base + '/fast'
+        try:
+          await asyncio.wait_for(first.wait(), 30)
+        except asyncio.TimeoutError:
+          late.append(True)
+        yield base + '/fast'
+      titles = []
+      async for r in fetch_sharded(urls(), processes=2):
+        first.set()
+        titles.append(r.info)
+      return titles
+  assert asyncio.run(main()) == ['fast'] * 2
+  assert not late
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+import aiohttp
+
+from fetchtitle import TitleFetcher
+from fetchtitle.proxies import ProxyPool
+
+from util import serve, app_with, html
+
+class Clock:
+  now = 0.0
+
+  def __call__(self):
+    return self.now
+
+def fail(pool, proxy, n=1):
+  for _ in range(n):
+    assert pool.pick('h', exclude=[p for p in pool.candidates('h')
+                                   if p != proxy]) == proxy
+    pool.report(proxy, 0.1, False)
+
+def test_ejection_doubles_until_it_works():
+  clock = Clock()
+  pool = ProxyPool(['a', 'b'], failures=2, eject_for=10, max_eject=15,
+                   explore=0, clock=clock)
+  fail(pool, 'a')
+  assert not pool.stats['a']['ejected']
+  fail(pool, 'a')
+  assert pool.stats['a']['ejected'] and pool.ejections == 1
+  assert [pool.pick('h') for _ in range(3)] == ['b'] * 3
+  for _ in range(3):
+    pool.report('b', 0.1)
+
+  clock.now = 10
+  assert not pool.stats['a']['ejected']
+  # one more failure after it's back ejects it again, for longer
+  fail(pool, 'a')
+  assert pool.ejections == 2
+  clock.now = 24
+  assert pool.stats['a']['ejected']
+  clock.now = 25
+  fail(pool, 'a')
+  assert pool.stats['a']['ejected'] and pool.ejections == 3
+
+  # working again forgets it all
+  clock.now = 40
+  assert pool.pick('h', exclude=['b']) == 'a'
+  pool.report('a', 0.1, True)
+  fail(pool, 'a')
+  assert not pool.stats['a']['ejected']
+
+def test_all_ejected_picks_the_one_back_first():
+  clock = Clock()
+  pool = ProxyPool(['a', 'b'], failures=1, explore=0, clock=clock)
+  fail(pool, 'a')
+  clock.now = 1
+  fail(pool, 'b')
+  assert pool.pick('h') == 'a'
+
+def use(pool, host, proxy, latency):
+  assert pool.pick(host, exclude=[p for p in pool.candidates(host)
+                                  if p != proxy]) == proxy
+  pool.report(proxy, latency)
+
+def test_faster_proxy_is_preferred_and_hosts_stick():
+  pool = ProxyPool(['a', 'b'], explore=0, stickiness=1.5)
+  use(pool, 'h', 'a', 1.0)
+  use(pool, 'h', 'b', 0.8)
+  assert pool.pick('new') == 'b'
+  pool.report('b', 0.8)
+
+  # within stickiness of the best, a host stays with what it used
+  use(pool, 'h', 'a', 1.0)
+  assert pool.pick('h') == 'a'
+  pool.report('a', 1.0)
+  # but not beyond it
+  use(pool, 'h', 'a', 5.0)
+  assert pool.pick('h') == 'b'
+  pool.report('b', 0.8)
+
+def test_routes():
+  pool = ProxyPool(['a', 'b', None],
+                   routes=[('*.example.cn', ['b']), ('direct.*', [None])])
+  assert pool.candidates('www.EXAMPLE.cn') == ['b']
+  assert pool.candidates('direct.example.com') == [None]
+  assert pool.candidates('example.com') == ['a', 'b', None]
+  # a route's proxies are used even if tried already
+  assert pool.pick('www.example.cn', exclude=['b']) == 'b'
+
+  with pytest.raises(ValueError):
+    ProxyPool(['a'], routes=[('*', ['c'])])
+  with pytest.raises(ValueError):
+    ProxyPool([])
+
+def test_failed_proxy_is_retried_through_another():
+  dead = 'http://127.0.0.1:1'
+
+  async def page(request):
+    return html('direct')
+
+  async def main(pool):
+    async with serve(app_with(page=page)) as base:
+      return await TitleFetcher(base + '/page').run(proxy=pool)
+
+  pool = ProxyPool([dead, None], explore=0)
+  r = asyncio.run(main(pool))
+  assert r.info == 'direct'
+  stats = pool.stats
+  assert stats[dead]['used'] == stats[None]['used'] == 1
+  assert stats[dead]['errors'] > 0 and stats[None]['errors'] == 0
+  assert stats[dead]['inflight'] == stats[None]['inflight'] == 0
+
+  pool = ProxyPool([dead, None], retries=0, explore=0)
+  with pytest.raises(aiohttp.ClientProxyConnectionError):
+    asyncio.run(main(pool))
+  assert pool.stats[None]['used'] == 0
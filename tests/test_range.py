@@ -0,0 +1,68 @@
+import re
+import asyncio
+
+from aiohttp import web
+
+from fetchtitle import TitleFetcher
+from fetchtitle.bench import _jpeg, _page
+
+from util import serve
+
+BIG_JPEG = _jpeg(640, 480, 20)
+PNG = (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + b'\x00\x00\x01\x00' * 2
+       + b'\x08\x06\x00\x00\x00' + b'\0' * 1000)
+
+def ranged(body, content_type, ranges):
+  async def handler(request):
+    ranges.append(request.headers.get('Range'))
+    m = re.fullmatch(r'bytes=(\d+)-(\d+)', request.headers.get('Range', ''))
+    if not m:
+      return web.Response(body=body, content_type=content_type)
+    start, end = int(m.group(1)), min(int(m.group(2)), len(body) - 1)
+    return web.Response(
+      body=body[start:end + 1], status=206, content_type=content_type,
+      headers={'Content-Range': 'bytes %d-%d/%d' % (start, end, len(body))})
+  return handler
+
+def fetch(path, **kwargs):
+  ranges = []
+  async def main():
+    app = web.Application()
+    app.router.add_get('/big.jpg', ranged(BIG_JPEG, 'image/jpeg', ranges))
+    # not what its name says
+    app.router.add_get('/pic.png', ranged(BIG_JPEG, 'image/jpeg', ranges))
+    app.router.add_get('/small.png', ranged(PNG, 'image/png', ranges))
+    app.router.add_get('/', ranged(
+      _page(b'home'), 'text/html', ranges))
+    async with serve(app) as base:
+      return await TitleFetcher(base + path, **kwargs).run()
+  return asyncio.run(main()), ranges
+
+def test_jpeg_with_large_app_segments():
+  assert len(BIG_JPEG) > 1024 * 1024
+  r, ranges = fetch('/big.jpg')
+  assert r.info.dimension == (640, 480)
+  assert ranges == [None]
+
+def test_range_follows_the_type_the_url_suggests():
+  r, ranges = fetch('/small.png', range_requests=True)
+  assert r.info.dimension == (256, 256)
+  assert ranges == ['bytes=0-24']
+
+  r, ranges = fetch('/big.jpg', range_requests=True)
+  assert r.info.dimension == (640, 480)
+  assert ranges == [None]
+
+  r, ranges = fetch('/', range_requests=True)
+  assert r.info == 'home'
+  assert ranges == ['bytes=0-%d' % (1024 * 1024)]
+
+def test_short_range_is_retried_without_it():
+  r, ranges = fetch('/pic.png', range_requests=True)
+  assert r.info.dimension == (640, 480)
+  assert ranges == ['bytes=0-24', None]
+  # the same hop, not a redirection
+  assert len(r.url_visited) == 1
+
+  r, ranges = fetch('/pic.png', range_requests=True, max_follows=1)
+  assert r.info.dimension == (640, 480)
@@ -0,0 +1,44 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from fetchtitle import TitleFetcher
+from fetchtitle.cache import RedirectCache
+
+from util import serve, html
+
+def test_cached_chain_goes_straight_to_its_end():
+  hits = []
+  def moved(to):
+    async def handler(request):
+      hits.append(request.path)
+      raise web.HTTPMovedPermanently(to)
+    return handler
+  async def page(request):
+    hits.append(request.path)
+    return html('end')
+
+  async def main():
+    app = web.Application()
+    app.router.add_get('/a', moved('/b'))
+    app.router.add_get('/b', moved('/c'))
+    app.router.add_get('/c', moved('/page'))
+    app.router.add_get('/page', page)
+    cache = RedirectCache()
+    async with serve(app) as base, aiohttp.ClientSession() as session:
+      results = []
+      for _ in range(2):
+        results.append(await TitleFetcher(
+          base + '/a', session=session, redirect_cache=cache,
+          collect_stats=True).run())
+      return base, results, cache.hits
+  base, (first, second), cache_hits = asyncio.run(main())
+
+  assert hits == ['/a', '/b', '/c', '/page', '/page']
+  assert first.info == second.info == 'end'
+  assert second.url_visited == first.url_visited == [
+    base + p for p in ('/a', '/b', '/c', '/page')]
+  # looked up once, not once per hop
+  assert cache_hits == 1
+  assert [h.url for h in second.stats.hops] == second.url_visited
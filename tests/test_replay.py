@@ -0,0 +1,133 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from fetchtitle import TitleFetcher, Timeout, fetch_many
+from fetchtitle.bench import _jpeg
+from fetchtitle.replay import (
+  RecordingSession, ReplaySession, RecordedError, NotRecorded, Exchange,
+  read_archive,
+)
+
+from util import serve, html
+
+async def page(request):
+  return html('page')
+
+async def moved(request):
+  raise web.HTTPFound('/page')
+
+async def jpeg(request):
+  return web.Response(body=_jpeg(320, 200, 2), content_type='image/jpeg')
+
+def summary(results):
+  return sorted(
+    (r.url_visited[0], r.url_visited[-1], type(r.info).__name__
+     if isinstance(r.info, Exception) else repr(r.info)) for r in results)
+
+def test_replay_gives_what_was_recorded(tmp_path):
+  archive = str(tmp_path / 'run.gz')
+  async def record():
+    app = web.Application()
+    app.router.add_get('/page', page)
+    app.router.add_get('/moved', moved)
+    app.router.add_get('/jpeg', jpeg)
+    async with serve(app) as base:
+      # nothing listens there any more
+      async with serve(web.Application()) as gone:
+        pass
+      urls = [base + '/moved', base + '/jpeg', gone + '/']
+      session = RecordingSession(archive)
+      try:
+        results = [r async for r in fetch_many(urls, session=session)]
+      finally:
+        await session.close()
+      return urls, results
+  urls, recorded = asyncio.run(record())
+
+  exchanges = list(read_archive(archive))
+  assert len(exchanges) == 4
+  assert [ex.error_type for ex in exchanges if ex.error] \
+         == ['ClientConnectorError']
+
+  async def replay():
+    session = ReplaySession(archive)
+    assert sorted(session.urls) == sorted(urls)
+    return [r async for r in fetch_many(urls, session=session)]
+  replayed = asyncio.run(replay())
+
+  assert summary(replayed) == summary(recorded)
+  errors = [r.info for r in replayed if isinstance(r.info, Exception)]
+  assert len(errors) == 1 and isinstance(errors[0], RecordedError)
+  assert type(errors[0]).__name__ == 'ClientConnectorError'
+
+def test_replay_of_unknown_url():
+  async def main():
+    session = ReplaySession([])
+    try:
+      await session.get('http://example.com/')
+    except NotRecorded:
+      return True
+  assert asyncio.run(main())
+
+async def slow_headers(request):
+  await asyncio.sleep(3)
+  return html('late')
+
+async def stalled_body(request):
+  r = web.StreamResponse(headers={'Content-Type': 'text/html'})
+  await r.prepare(request)
+  await r.write(b'<html><head>')
+  await asyncio.sleep(3)
+  return r
+
+def test_replay_times_out_like_the_recording(tmp_path):
+  archive = str(tmp_path / 'run.gz')
+  # (path, fetcher arguments): cancelled by first_byte_timeout, aiohttp's
+  # read timeout before the headers, and during the body
+  cases = [
+    ('/slow?first-byte', dict(first_byte_timeout=0.3, idle_timeout=5)),
+    ('/slow?idle', dict(idle_timeout=0.3)),
+    ('/stall', dict(idle_timeout=0.3)),
+  ]
+  async def fetch(session, base):
+    return [await TitleFetcher(base + path, session=session, **kwargs).run()
+            for path, kwargs in cases]
+
+  async def record():
+    app = web.Application()
+    app.router.add_get('/slow', slow_headers)
+    app.router.add_get('/stall', stalled_body)
+    async with serve(app) as base:
+      session = RecordingSession(archive)
+      try:
+        return base, await fetch(session, base)
+      finally:
+        await session.close()
+  base, recorded = asyncio.run(record())
+  assert [r.info for r in recorded] == [Timeout] * 3
+
+  exchanges = {ex.url[len(base):]: ex for ex in read_archive(archive)}
+  assert exchanges['/slow?first-byte'].error_type == 'CancelledError'
+  assert exchanges['/slow?idle'].error_type == 'SocketTimeoutError'
+  assert exchanges['/stall'].status == 200
+  assert exchanges['/stall'].error_type == 'SocketTimeoutError'
+
+  async def replay():
+    return await fetch(ReplaySession(archive), base)
+  replayed = asyncio.run(replay())
+  assert [r.info for r in replayed] == [Timeout] * 3
+
+def test_incomplete_body_stalls():
+  ex = Exchange('http://example.com/', 200, 'OK',
+                [('Content-Type', 'text/html')], 0, [(0, b'<html><head>')],
+                False, None, None)
+  async def main():
+    r = await ReplaySession([ex]).get(
+      ex.url, timeout=aiohttp.ClientTimeout(sock_read=0.1))
+    assert await r.content.readany() == b'<html><head>'
+    with pytest.raises(asyncio.TimeoutError):
+      await r.content.readany()
+  asyncio.run(main())
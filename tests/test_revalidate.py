@@ -0,0 +1,104 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from fetchtitle import TitleFetcher
+from fetchtitle.cache import ResultCache
+
+from util import serve, html
+
+class Clock:
+  now = 0.0
+
+  def __call__(self):
+    return self.now
+
+def revalidating(path='/page', steps=(0,)):
+  '''fetch path once per clock step, with a cache; (results, fetchers,
+  request headers)'''
+  requests = []
+  version = {'title': 'v1'}
+
+  async def page(request):
+    requests.append(request.headers)
+    etag = '"%s"' % version['title']
+    if request.headers.get('If-None-Match') == etag:
+      return web.Response(status=304, headers={'ETag': etag})
+    return html(version['title'], headers={'ETag': etag})
+
+  async def dated(request):
+    requests.append(request.headers)
+    modified = 'Sat, 17 Oct 2026 00:00:00 GMT'
+    if request.headers.get('If-Modified-Since') == modified:
+      return web.Response(status=304)
+    return html('dated', headers={'Last-Modified': modified})
+
+  async def moved(request):
+    requests.append(request.headers)
+    raise web.HTTPFound('/page')
+
+  clock = Clock()
+  cache = ResultCache(ttl=10, stale_ttl=100, clock=clock)
+
+  async def main():
+    app = web.Application()
+    app.router.add_get('/page', page)
+    app.router.add_get('/dated', dated)
+    app.router.add_get('/moved', moved)
+    results = []
+    fetchers = []
+    async with serve(app) as base, aiohttp.ClientSession() as session:
+      for step in steps:
+        if step == 'change':
+          version['title'] = 'v2'
+          continue
+        clock.now += step
+        f = TitleFetcher(base + path, session=session, cache=cache)
+        results.append(await f.run())
+        fetchers.append(f)
+    return results, fetchers
+
+  results, fetchers = asyncio.run(main())
+  return results, fetchers, requests
+
+def test_expired_entry_is_revalidated():
+  results, fetchers, requests = revalidating(steps=(0, 5, 20, 5))
+  assert [r.info for r in results] == ['v1'] * 4
+  # fetched, cached, revalidated, cached again
+  assert len(requests) == 2
+  assert 'If-None-Match' not in requests[0]
+  assert requests[1]['If-None-Match'] == '"v1"'
+  assert [f.revalidated for f in fetchers] == [False, False, True, False]
+  assert fetchers[2].validators == {'etag': '"v1"'}
+
+def test_changed_page_is_fetched_again():
+  results, fetchers, requests = revalidating(steps=(0, 'change', 20, 5))
+  assert [r.info for r in results] == ['v1', 'v2', 'v2']
+  assert requests[1]['If-None-Match'] == '"v1"'
+  assert not fetchers[1].revalidated
+  assert fetchers[1].validators == {'etag': '"v2"'}
+  assert len(requests) == 2
+
+def test_last_modified_is_used_too():
+  results, fetchers, requests = revalidating('/dated', steps=(0, 20))
+  assert [r.info for r in results] == ['dated'] * 2
+  assert requests[1]['If-Modified-Since'] == 'Sat, 17 Oct 2026 00:00:00 GMT'
+  assert fetchers[1].revalidated
+
+def test_too_stale_is_fetched_unconditionally():
+  results, fetchers, requests = revalidating(steps=(0, 200))
+  assert [r.info for r in results] == ['v1'] * 2
+  assert 'If-None-Match' not in requests[1]
+  assert not fetchers[1].revalidated
+
+def test_last_hop_of_a_redirection_is_revalidated():
+  results, fetchers, requests = revalidating('/moved', steps=(0, 20))
+  assert [r.info for r in results] == ['v1'] * 2
+  assert [r.url_visited[-1].rsplit('/', 1)[1] for r in results] == \
+         ['page'] * 2
+  # /moved, /page, then /moved again and /page conditionally
+  assert len(requests) == 4
+  assert 'If-None-Match' not in requests[2]
+  assert requests[3]['If-None-Match'] == '"v1"'
+  assert fetchers[1].revalidated
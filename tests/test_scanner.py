@@ -0,0 +1,48 @@
+import pytest
+
+from fetchtitle import HtmlTitleParser, HtmlTitleScanner
+
+# (charset from HTTP, document, title); from the cases test() lists
+CASES = {
+  'end tag with a newline': (
+    None, b'<html><head><title>Notification</TITLE\n></head>',
+    'Notification'),
+  'malformed meta': (
+    None, '<meta http-equiv="Content-Type" content="text/html" ; '
+    'charset="UTF-8"><title>中文</title>'.encode(), '中文'),
+  'charref outside ASCII': (
+    None, b'<title>&#x4e2d;&#25991; &amp; &lt;b&gt;</title>',
+    '中文 & <b>'),
+  'charset in HTTP wins': (
+    'utf-8', '<meta charset="gbk"><title>中文</title>'.encode(), '中文'),
+  'HTML5 GBK': (
+    None, '<meta charset="gbk"><title>中文</title>'.encode('gbk'), '中文'),
+  'Big5 and escaped characters': (
+    None, '<meta http-equiv="Content-Type" content="text/html; '
+    'charset=big5"><title>中文&#37507;</title>'.encode('big5'), '中文銃'),
+  'document inside another': (
+    None, '<meta http-equiv="Content-Type" content="text/html; charset=gbk">'
+    '<div><html><head><meta charset="utf-8"><title>中文</title>'
+    .encode('gbk'), '中文'),
+  'tag inside title': (
+    None, b'<title>Parsing <span>XML</span> at the Speed of Light</title>',
+    'Parsing XML at the Speed of Light'),
+  'title in comment and script': (
+    None, b'<!-- <title>no</title> --><script>"<title>no</title>"</script>'
+    b'<title>yes</title>', 'yes'),
+}
+
+def parse(cls, charset, doc, size):
+  p = cls()
+  p.charset = charset
+  for i in range(0, len(doc), size):
+    p.feed(doc[i:i + size])
+  p.feed(b'')
+  return p.result
+
+@pytest.mark.parametrize('size', [1, 2, 7, 64, 1 << 20])
+@pytest.mark.parametrize('case', CASES)
+def test_scanner_agrees_with_parser(case, size):
+  charset, doc, title = CASES[case]
+  assert parse(HtmlTitleScanner, charset, doc, size) == title
+  assert parse(HtmlTitleParser, charset, doc, size) == title
@@ -0,0 +1,125 @@
+import time
+import asyncio
+from email.utils import formatdate
+
+from aiohttp import web
+
+from fetchtitle import TitleFetcher
+from fetchtitle.scheduler import (
+  HostScheduler, parse_retry_after, INTERACTIVE, NORMAL, BULK,
+)
+
+from util import serve, app_with, html
+
+def test_retry_after_is_retried_in_place():
+  hits = []
+  async def limited(request):
+    hits.append(time.monotonic())
+    if len(hits) == 1:
+      return web.Response(status=429, headers={'Retry-After': '1'})
+    return html('ok')
+
+  async def main():
+    async with serve(app_with(l=limited)) as base:
+      return await TitleFetcher(
+        base + '/l', scheduler=HostScheduler(), max_follows=1).run()
+  r = asyncio.run(main())
+  assert r.info == 'ok'
+  assert len(r.url_visited) == 1
+  assert hits[1] - hits[0] >= 0.9
+
+def test_priority_lanes():
+  order = []
+  async def main():
+    s = HostScheduler(1)
+    await s.acquire('a')
+    async def one(name, priority):
+      async with s.slot('a', priority):
+        order.append(name)
+    tasks = [asyncio.ensure_future(one(name, priority)) for name, priority in [
+      ('bulk', BULK), ('normal', NORMAL), ('interactive', INTERACTIVE),
+      ('normal2', NORMAL),
+    ]]
+    await asyncio.sleep(0)
+    assert s.stats['waiting'] == 4
+    s.release('a')
+    await asyncio.gather(*tasks)
+    return s.stats
+  stats = asyncio.run(main())
+  assert order == ['interactive', 'normal', 'normal2', 'bulk']
+  assert stats['started'] == 5 and stats['waited'] == 4
+  assert stats['active'] == stats['waiting'] == 0
+
+def test_busy_host_does_not_hold_up_others():
+  order = []
+  async def main():
+    s = HostScheduler(1)
+    await s.acquire('a')
+    async def one(host):
+      async with s.slot(host):
+        order.append(host)
+    a = asyncio.ensure_future(one('a'))
+    await asyncio.wait_for(one('b'), 1)
+    s.release('a')
+    await a
+  asyncio.run(main())
+  assert order == ['b', 'a']
+
+def test_limit_is_shared_by_hosts():
+  async def main():
+    s = HostScheduler(4, limit=2)
+    await s.acquire('a')
+    await s.acquire('b')
+    c = asyncio.ensure_future(s.acquire('c'))
+    await asyncio.sleep(0.05)
+    assert not c.done()
+    s.release('a')
+    await asyncio.wait_for(c, 1)
+  asyncio.run(main())
+
+def test_token_bucket():
+  async def main():
+    s = HostScheduler(10, rate=10, burst=2)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    times = []
+    async def one():
+      await s.acquire('a')
+      times.append(loop.time() - start)
+      s.release('a')
+    await asyncio.gather(*(one() for _ in range(4)))
+    return times
+  times = asyncio.run(main())
+  assert times[1] < 0.05
+  assert 0.08 < times[2] < 0.15
+  assert 0.18 < times[3] < 0.25
+
+def test_retry_after_holds_off_the_host():
+  async def main():
+    s = HostScheduler(max_retry_after=0.2)
+    s.retry_after('a', 3600)
+    assert 0.15 < s.blocked_for('a') <= 0.2
+    assert s.blocked_for('b') == 0
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with s.slot('b'):
+      assert loop.time() - start < 0.05
+    async with s.slot('a'):
+      waited = loop.time() - start
+    # a shorter delay doesn't shorten it
+    s.retry_after('a', 0.2)
+    s.retry_after('a', 0.01)
+    assert s.blocked_for('a') > 0.15
+    return waited, s.stats
+  waited, stats = asyncio.run(main())
+  assert 0.18 < waited < 0.3
+  assert stats['throttled'] == 2
+
+def test_parse_retry_after():
+  assert parse_retry_after('120') == 120
+  assert parse_retry_after(' 0 ') == 0
+  soon = formatdate(time.time() + 60, usegmt=True)
+  assert 50 < parse_retry_after(soon) <= 60
+  assert parse_retry_after(formatdate(time.time() - 60, usegmt=True)) == 0
+  assert parse_retry_after('soon') is None
+  assert parse_retry_after('') is None
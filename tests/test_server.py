@@ -0,0 +1,39 @@
+import json
+import asyncio
+
+from fetchtitle.server import TitleServer
+
+from util import serve, app_with, html
+
+async def page(request):
+  return html('page')
+
+def test_errors_have_the_request_id():
+  async def main():
+    async with serve(app_with(page=page)) as base:
+      server = TitleServer()
+      await server.start(port=0)
+      try:
+        host, port = server.addresses[0][:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b'\n'.join([
+          b'{"id": "a", "url": "%s/page"}' % base.encode(),
+          b'{"id": "b", "url": 1}',
+          b'{"id": "c"}',
+          b'{"id": "d", ',
+          b'{"url": 1}',
+          b'%s/page' % base.encode(),
+        ]) + b'\n')
+        writer.write_eof()
+        replies = [json.loads(line) async for line in reader]
+        writer.close()
+      finally:
+        await server.close()
+      return replies
+  replies = {d['id']: d for d in asyncio.run(main())}
+  assert sorted(replies, key=str) == [3, 4, 5, 'a', 'b', 'c']
+  assert replies['a']['info']['value'] == replies[5]['info']['value'] == 'page'
+  assert replies['b']['error'] == 'bad url on line 2'
+  assert replies['c']['error'] == 'no url on line 3'
+  assert replies[3]['error'] == 'bad request on line 4'
+  assert replies[4]['error'] == 'bad url on line 5'
@@ -0,0 +1,61 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from fetchtitle import TitleFetcher, FastTitleFinder, PNGFinder
+from fetchtitle.singleflight import SingleFlight
+
+from util import serve, html
+
+def run_together(*kwargs_list, path='/page'):
+  '''fetch path with a fetcher for each kwargs at once; (results, hits)'''
+  hits = []
+  async def page(request):
+    hits.append(request.path)
+    await asyncio.sleep(0.1)
+    return html('shared', headers={'ETag': '"v1"'})
+  async def moved(request):
+    hits.append(request.path)
+    await asyncio.sleep(0.1)
+    raise web.HTTPFound('/page')
+
+  async def main():
+    app = web.Application()
+    app.router.add_get('/page', page)
+    app.router.add_get('/moved', moved)
+    sf = SingleFlight()
+    async with serve(app) as base, aiohttp.ClientSession() as session:
+      fetchers = [TitleFetcher(base + path, session=session, singleflight=sf,
+                               **kwargs) for kwargs in kwargs_list]
+      results = await asyncio.gather(*(f.run() for f in fetchers))
+      return fetchers, results
+  fetchers, results = asyncio.run(main())
+  return fetchers, results, hits
+
+def test_same_config_shares_the_hop():
+  fetchers, results, hits = run_together({}, {}, {})
+  assert hits == ['/page']
+  assert [r.info for r in results] == ['shared'] * 3
+  for f, r in zip(fetchers, results):
+    assert r.url_visited is f.url_visited
+    assert f.validators == {'etag': '"v1"'}
+
+def test_different_config_does_not_share():
+  _, results, hits = run_together(
+    {}, {'meta_fields': ['description']},
+    {'content_finders': (FastTitleFinder, PNGFinder)},
+  )
+  assert hits == ['/page'] * 3
+  assert [r.info for r in results] == ['shared'] * 3
+
+def test_followers_get_hop_stats():
+  fetchers, results, hits = run_together(
+    {'collect_stats': True}, {'collect_stats': True}, path='/moved')
+  assert hits == ['/moved', '/page']
+  for r in results:
+    assert r.info == 'shared'
+    assert [h.url.rsplit('/', 1)[1] for h in r.stats.hops] \
+           == ['moved', 'page']
+    assert r.stats.hops[1].bytes_read > 0
+  assert fetchers[1].validators == {'etag': '"v1"'}
@@ -0,0 +1,43 @@
+import io
+import asyncio
+
+from aiohttp import web
+
+from fetchtitle import TitleFetcher
+from fetchtitle.warc import WarcRecord, _Block, extract
+
+from util import serve
+
+PDF = b'%PDF-1.4\n' + b'0' * 100
+
+async def octet(request):
+  return web.Response(body=PDF, content_type='application/octet-stream')
+
+def fetch(url):
+  async def main():
+    app = web.Application()
+    app.router.add_get('/octet', octet)
+    async with serve(app) as base:
+      return await TitleFetcher(base + url).run()
+  return asyncio.run(main())
+
+def test_generic_type_is_replaced_by_sniffed():
+  r = fetch('/octet')
+  assert r.info.type == 'application/pdf'
+  assert r.finder is None
+
+def record(http):
+  return WarcRecord(0, {
+    'warc-type': 'response',
+    'warc-target-uri': 'http://example.com/',
+  }, _Block(io.BytesIO(http), len(http)))
+
+def test_warc_generic_type_is_replaced_by_sniffed():
+  r = extract(record(
+    b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n\r\n'
+    + PDF))
+  assert r.info.type == 'application/pdf'
+
+def test_warc_missing_type_is_replaced_by_sniffed():
+  r = extract(record(b'HTTP/1.1 200 OK\r\n\r\n' + PDF))
+  assert r.info.type == 'application/pdf'
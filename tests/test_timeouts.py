@@ -0,0 +1,44 @@
+import sys
+import asyncio
+
+from aiohttp import web
+
+from fetchtitle import TitleFetcher, Timeout
+from fetchtitle.__main__ import parse_args
+
+from util import serve, app_with
+
+def test_hops_have_timeouts_by_default():
+  f = TitleFetcher('http://example.com/')
+  assert 0 < f.connect_timeout < f.first_byte_timeout <= f.timeout
+  assert 0 < f.idle_timeout <= f.timeout
+  t = f._hop_timeout()
+  assert t.sock_connect == f.connect_timeout
+  assert t.sock_read == f.idle_timeout
+
+def test_command_line_timeouts(monkeypatch):
+  monkeypatch.setattr(sys, 'argv', ['fetchtitle', 'http://example.com/'])
+  args = parse_args()
+  assert args.connect_timeout == TitleFetcher.connect_timeout
+  assert args.first_byte_timeout == TitleFetcher.first_byte_timeout
+  assert args.idle_timeout == TitleFetcher.idle_timeout
+
+  monkeypatch.setattr(sys, 'argv', [
+    'fetchtitle', '--connect-timeout', '1', '--idle-timeout', '0.5',
+    'http://example.com/'])
+  args = parse_args()
+  assert (args.connect_timeout, args.idle_timeout) == (1, 0.5)
+
+def test_idle_timeout_ends_a_stalled_body():
+  async def stall(request):
+    r = web.StreamResponse(headers={'Content-Type': 'text/html'})
+    await r.prepare(request)
+    await r.write(b'<html><head>')
+    await asyncio.sleep(5)
+    return r
+
+  async def main():
+    async with serve(app_with(stall=stall)) as base:
+      return await TitleFetcher(base + '/stall', idle_timeout=0.2).run()
+  r = asyncio.run(main())
+  assert r.info is Timeout
@@ -0,0 +1,63 @@
+import os
+import sys
+import gzip
+import subprocess
+
+import pytest
+
+from fetchtitle.bench import _page
+from fetchtitle.warc import extract_file, plan, _GzipStream
+
+def warc_record(i):
+  http = (b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n'
+          + _page(b'page %d' % i, body=b'x' * (i * 37 % 400)))
+  head = (b'WARC/1.0\r\nWARC-Type: response\r\n'
+          b'WARC-Target-URI: http://example.com/%d\r\n'
+          b'Content-Length: %d\r\n\r\n' % (i, len(http)))
+  return head + http + b'\r\n\r\n'
+
+RECORDS = [warc_record(i) for i in range(30)]
+
+@pytest.fixture(params=['plain', 'members', 'single'])
+def warc(request, tmp_path):
+  path = tmp_path / 'test.warc'
+  if request.param == 'plain':
+    path.write_bytes(b''.join(RECORDS))
+  elif request.param == 'members':
+    path = path.with_suffix('.warc.gz')
+    path.write_bytes(b''.join(gzip.compress(r) for r in RECORDS))
+  else:
+    path = path.with_suffix('.warc.gz')
+    path.write_bytes(gzip.compress(b''.join(RECORDS)))
+  return str(path)
+
+def titles(dicts):
+  return [(d['offset'], d['url'], d['info']) for d in dicts]
+
+@pytest.mark.parametrize('split_size', [1, 97, 1000, 1 << 20])
+def test_ranges_cover_each_record_once(warc, split_size):
+  whole = titles(extract_file(warc))
+  assert [t[2]['value'] for t in whole] == \
+         ['page %d' % i for i in range(30)]
+  split = []
+  for path, start, end in plan([warc], split_size):
+    split += titles(extract_file(path, start, end))
+  assert split == whole
+
+def test_split_must_be_positive(warc):
+  with pytest.raises(ValueError):
+    list(plan([warc], 0))
+  p = subprocess.run(
+    [sys.executable, '-m', 'fetchtitle.warc', '--split', '0', warc],
+    capture_output=True)
+  assert p.returncode == 2
+  assert b'--split' in p.stderr
+
+def test_member_search_stops_at_range_end(tmp_path):
+  path = tmp_path / 'big.warc.gz'
+  # incompressible, so that the file is large
+  path.write_bytes(gzip.compress(b''.join(RECORDS) + os.urandom(8 << 20)))
+  with open(path, 'rb') as f:
+    s = _GzipStream(f)
+    assert s._find_member(1000, 2000) is None
+    assert f.tell() < 2 << 20
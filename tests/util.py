@@ -0,0 +1,33 @@
+import asyncio
+import contextlib
+
+from aiohttp import web
+
+@contextlib.asynccontextmanager
+async def serve(app):
+  '''run an aiohttp app on a free port of 127.0.0.1, yield its base URL'''
+  runner = web.AppRunner(app, access_log=None, shutdown_timeout=0.1)
+  await runner.setup()
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  await site.start()
+  try:
+    yield 'http://127.0.0.1:%d' % runner.addresses[0][1]
+  finally:
+    await runner.cleanup()
+
+def app_with(**routes):
+  '''an app with GET handlers, e.g. app_with(slow=handler) for /slow'''
+  app = web.Application()
+  for name, handler in routes.items():
+    app.router.add_get('/' + name.replace('_', '-'), handler)
+  return app
+
+def html(title, **kwargs):
+  return web.Response(
+    body=b'<html><head><title>%s</title></head></html>' % title.encode(),
+    content_type='text/html', **kwargs)
+
+def pending_tasks(name):
+  '''tasks still running a coroutine function called `name`'''
+  return [t for t in asyncio.all_tasks()
+          if not t.done() and t.get_coro().__qualname__ == name]